@@ -31,8 +31,11 @@ def get_alignment(x, zs, labels, prior, fp16, hps):
     alignment_hops = {}
     indices_hops = {}
 
-    prior.cuda()
-    empty_cache()
+    if prior.residency is not None:
+        prior.residency.load(prior)
+    else:
+        prior.cuda()
+        empty_cache()
     for start in get_starts(total_length, n_ctx, hop_length):
         end = start + n_ctx
 
@@ -61,7 +64,10 @@ def get_alignment(x, zs, labels, prior, fp16, hps):
         # indices_hop is a list of len=bs, each entry of len hps.n_tokens
         indices_hops[start] = indices_hop
         alignment_hops[start] = alignment_hop
-    prior.cpu()
+    if prior.residency is not None:
+        prior.residency.release(prior)
+    else:
+        prior.cpu()
     empty_cache()
 
     # Combine attn for each hop into attn for full range
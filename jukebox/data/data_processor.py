@@ -5,6 +5,9 @@ from torch.utils.data import DataLoader, Dataset, BatchSampler, RandomSampler
 from jukebox.utils.dist_utils import print_all
 from jukebox.utils.audio_utils import calculate_bandwidth
 from jukebox.data.files_dataset import FilesAudioDataset
+from jukebox.data.packed_dataset import PackedAudioDataset
+from jukebox.data.prefetcher import Prefetcher
+from jukebox.data.song_sampler import SongLocalitySampler
 
 class OffsetDataset(Dataset):
     def __init__(self, dataset, start, end, test=False):
@@ -19,12 +22,20 @@ class OffsetDataset(Dataset):
         return self.end - self.start
 
     def __getitem__(self, item):
-        #HACK
-        return self.dataset.get_item(self.start + item[0], test=self.test)
+        if isinstance(item, (list, tuple)):
+            return self.__getitems__(item)
+        return self.dataset.get_item(self.start + item, test=self.test)
+
+    def __getitems__(self, items):
+        # Whole batch at once, as stacked tensors
+        return self.dataset.get_items([self.start + item for item in items], test=self.test)
 
 class DataProcessor():
     def __init__(self, hps, audio_database):
-        self.dataset = FilesAudioDataset(hps, audio_database)
+        if hps.packed_audio_dir:
+            self.dataset = PackedAudioDataset(hps, audio_database)
+        else:
+            self.dataset = FilesAudioDataset(hps, audio_database)
         duration = 1 if hps.prior else 600
         hps.bandwidth = calculate_bandwidth(self.dataset, hps, duration=duration)
         self.create_datasets(hps)
@@ -33,9 +44,10 @@ class DataProcessor():
         self.print_stats(hps)
 
     def set_epoch(self, epoch):
-        if dist.is_available():
-            self.train_sampler.set_epoch(epoch)
-            self.test_sampler.set_epoch(epoch)
+        if dist.is_available() or self.song_locality:
+            for sampler in [self.train_sampler, self.test_sampler]:
+                sampler = getattr(sampler, 'sampler', sampler)  # Unwrap BatchSampler
+                sampler.set_epoch(epoch)
 
     def create_datasets(self, hps):
         train_len = int(len(self.dataset) * hps.train_test_split)
@@ -43,27 +55,36 @@ class DataProcessor():
         self.test_dataset = OffsetDataset(self.dataset, train_len, len(self.dataset), test=True)
 
     def create_samplers(self, hps):
-        if not dist.is_available():
-            self.train_sampler = BatchSampler(RandomSampler(self.train_dataset), batch_size=hps.bs, drop_last=True)
-            self.test_sampler = BatchSampler(RandomSampler(self.test_dataset), batch_size=hps.bs, drop_last=True)
+        self.song_locality = hps.song_locality > 1
+        if self.song_locality:
+            # Runs of consecutive windows from one song, see song_sampler.py
+            train_sampler = SongLocalitySampler(self.train_dataset, hps.song_locality, hps.bs,
+                                                num_replicas=dist.get_world_size(), rank=dist.get_rank())
+            test_sampler = SongLocalitySampler(self.test_dataset, hps.song_locality, hps.bs,
+                                               num_replicas=dist.get_world_size(), rank=dist.get_rank())
+        elif not dist.is_available():
+            train_sampler = RandomSampler(self.train_dataset)
+            test_sampler = RandomSampler(self.test_dataset)
         else:
-           self.train_sampler = DistributedSampler(self.train_dataset)
-           self.test_sampler = DistributedSampler(self.test_dataset)
+            train_sampler = DistributedSampler(self.train_dataset)
+            test_sampler = DistributedSampler(self.test_dataset)
+        # Sample lists of bs indices, which OffsetDataset fetches as one batch
+        self.train_sampler = BatchSampler(train_sampler, batch_size=hps.bs, drop_last=True)
+        self.test_sampler = BatchSampler(test_sampler, batch_size=hps.bs, drop_last=False)
 
     def create_data_loaders(self, hps):
-        # Loader to load mini-batches
-        if hps.labels:
-            collate_fn = lambda batch: tuple(t.stack([t.from_numpy(b[i]) for b in batch], 0) for i in range(3))
-        else:
-            collate_fn = lambda batch: t.stack([t.from_numpy(b) for b in batch], 0)
+        # Loader to load mini-batches. Batching is done by the samplers and the dataset already
+        # returns stacked tensors, so the loader just passes them through
+        collate_fn = lambda batch: batch
 
-        self.train_loader = DataLoader(self.train_dataset, batch_size=hps.bs, num_workers=hps.nworkers,
-                                       sampler=self.train_sampler, pin_memory=False,
-                                       drop_last=True, collate_fn=collate_fn)
-        self.test_loader = DataLoader(self.test_dataset, batch_size=hps.bs, num_workers=hps.nworkers,
-                                      sampler=self.test_sampler, pin_memory=False,
-                                      drop_last=False, collate_fn=collate_fn)
-        
+        # Pinned, so the prefetcher's copies to the gpu are async. It yields batches on device, preprocessed
+        pin_memory = t.cuda.is_available()
+        self.train_loader = Prefetcher(DataLoader(self.train_dataset, batch_size=None, num_workers=hps.nworkers,
+                                                  sampler=self.train_sampler, pin_memory=pin_memory, collate_fn=collate_fn),
+                                       hps, depth=hps.prefetch)
+        self.test_loader = Prefetcher(DataLoader(self.test_dataset, batch_size=None, num_workers=hps.nworkers,
+                                                 sampler=self.test_sampler, pin_memory=pin_memory, collate_fn=collate_fn),
+                                      hps, depth=hps.prefetch)
 
     def print_stats(self, hps):
         print_all(f"Train {len(self.train_dataset)} samples. Test {len(self.test_dataset)} samples")
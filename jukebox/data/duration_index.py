@@ -0,0 +1,128 @@
+"""
+Persistent metadata index for an audio directory.
+
+Instead of opening every file with PyAV and writing one .dur sidecar per song, we keep
+a single columnar .npz with (path, size, mtime, duration, sample_rate, channels) for all
+files. On startup we scan the directory once, reuse every row whose size and mtime are
+unchanged, probe only new or modified files in a process pool, and save the index back.
+The index lives outside the dataset directory by default, so read-only mounts work.
+"""
+import hashlib
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from jukebox.utils.dist_utils import print_all
+from jukebox.utils.io import get_audio_info
+
+AUDIO_EXTS = ('mp3', 'opus', 'm4a', 'aac', 'wav')
+COLUMNS = ('files', 'sizes', 'mtimes', 'durations', 'sample_rates', 'channels')
+
+
+def default_index_path(audio_files_dir):
+    key = hashlib.sha1(os.path.abspath(audio_files_dir).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(os.path.expanduser("~/.cache"), "jukebox", "durations", f"{key}.npz")
+
+
+def scan_files(audio_files_dir, exts=AUDIO_EXTS):
+    # Same files as librosa.util.find_files (recursive, case-insensitive extensions, sorted absolute paths)
+    # but we also pick up size/mtime from the directory walk.
+    exts = tuple(f'.{ext.lower()}' for ext in exts)
+    files, sizes, mtimes = [], [], []
+    stack = [os.path.abspath(audio_files_dir)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(exts):
+                    stat = entry.stat()
+                    files.append(entry.path)
+                    sizes.append(stat.st_size)
+                    mtimes.append(stat.st_mtime)
+    order = np.argsort(files, kind='stable')
+    return dict(files=np.array(files, dtype=str)[order],
+                sizes=np.array(sizes, dtype=np.int64)[order],
+                mtimes=np.array(mtimes, dtype=np.float64)[order])
+
+
+def load_index(index_path):
+    if not os.path.exists(index_path):
+        return None
+    data = np.load(index_path)
+    return {key: data[key] for key in COLUMNS}
+
+
+def save_index(index_path, index):
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = f'{index_path}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, **index)
+    os.replace(tmp_path, index_path)  # Atomic, so concurrent readers never see a partial index
+
+
+def _probe(file):
+    try:
+        return get_audio_info(file)
+    except Exception as e:
+        print_all(f'Could not read {file}: {e}')
+        return np.nan, 0, 0
+
+
+def build_index(audio_files_dir, index_path=None, nworkers=None, refresh=True):
+    """
+    Returns dict of columns for all audio files in audio_files_dir, updating the index on disk.
+    With refresh=False an existing index is trusted as is, without scanning the directory.
+    """
+    index_path = index_path or default_index_path(audio_files_dir)
+    start_time = time.time()
+    old = load_index(index_path)
+    if old is not None and not refresh:
+        print_all(f"Loaded {len(old['files'])} files from {index_path} without refreshing")
+        return old
+
+    index = scan_files(audio_files_dir)
+    n = len(index['files'])
+    index['durations'] = np.full(n, np.nan, dtype=np.float64)
+    index['sample_rates'] = np.zeros(n, dtype=np.int64)
+    index['channels'] = np.zeros(n, dtype=np.int64)
+
+    stale = np.ones(n, dtype=bool)
+    if old is not None and len(old['files']) > 0:
+        rows = {file: i for i, file in enumerate(old['files'])}
+        old_idx = np.array([rows.get(file, -1) for file in index['files']], dtype=np.int64)
+        found = old_idx >= 0
+        match = np.zeros(n, dtype=bool)
+        match[found] = (old['sizes'][old_idx[found]] == index['sizes'][found]) & \
+                       (old['mtimes'][old_idx[found]] == index['mtimes'][found]) & \
+                       np.isfinite(old['durations'][old_idx[found]])
+        for key in ('durations', 'sample_rates', 'channels'):
+            index[key][match] = old[key][old_idx[match]]
+        stale = ~match
+
+    stale_files = index['files'][stale].tolist()
+    if stale_files:
+        print_all(f"Probing {len(stale_files)} new or modified files of {n}")
+        nworkers = nworkers or os.cpu_count() or 1
+        if nworkers > 1 and len(stale_files) > 1:
+            with Pool(nworkers) as pool:
+                infos = pool.map(_probe, stale_files, chunksize=max(1, len(stale_files) // (4 * nworkers)))
+        else:
+            infos = [_probe(file) for file in stale_files]
+        durations, sample_rates, channels = zip(*infos)
+        index['durations'][stale] = durations
+        index['sample_rates'][stale] = sample_rates
+        index['channels'][stale] = channels
+    if stale_files or old is None or len(old['files']) != n:
+        try:
+            save_index(index_path, index)
+        except OSError as e:
+            print_all(f"Could not save duration index to {index_path}: {e}")
+    print_all(f"Indexed {n} files ({len(stale_files)} probed) in {time.time() - start_time:.2f}s")
+    return index
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(build_index)
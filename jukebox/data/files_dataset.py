@@ -2,15 +2,29 @@ import math
 import os
 import re
 
-import librosa
 import numpy as np
 import pandas as pd
+import torch as t
 
 from torch.utils.data import Dataset
 
-from jukebox.data.labels import Labeller
+from jukebox.data.duration_index import build_index
+from jukebox.data.labels import Labeller, get_relevant_lyric_tokens
+from jukebox.data.midi_cache import MidiCache, get_midi_paths
 from jukebox.utils.dist_utils import print_all
-from jukebox.utils.io import get_duration_sec, load_audio, load_midi
+from jukebox.utils.io import AudioReader, load_audio, load_midi
+
+
+def get_files_and_durations(audio_files_dir, sr, index_path='', refresh=True):
+    # Durations in samples at sr. Could be approximate
+    index = build_index(audio_files_dir, index_path=index_path or None, refresh=refresh)
+    valid = np.isfinite(index['durations'])
+    if not valid.all():
+        print_all(f"Skipping {(~valid).sum()} unreadable files")
+    files = index['files'][valid].tolist()
+    durations = index['durations'][valid] * sr
+    print_all(f"Found {len(files)} files")
+    return files, durations
 
 
 class FilesAudioDataset(Dataset):
@@ -24,26 +38,19 @@ class FilesAudioDataset(Dataset):
         assert hps.sample_length / hps.sr < self.min_duration, f'Sample length {hps.sample_length} per sr {hps.sr} ({hps.sample_length / hps.sr:.2f}) should be shorter than min duration {self.min_duration}'
         self.aug_shift = hps.aug_shift
         self.labels = hps.labels
+        # Keeps recently used files open, so consecutive windows of a song continue decoding instead of seeking
+        self.reader = AudioReader(self.sr, max_open=hps.audio_reader_cache_size) if hps.audio_reader_cache_size else None
         self.init_dataset(hps)
         self.songs = pd.read_csv(audio_database, engine='python')
+        if self.labels:
+            self.init_metadata()
 
         self.midi_paths = self.create_midi_paths(hps)
+        self.midi_cache = MidiCache(hps.midi_cache_dir) if hps.midi_cache_dir else None
 
     def create_midi_paths(self, hps):
         base_dir, _ = os.path.split(hps.audio_files_dir)
-
-        midi_dir = os.path.join(base_dir, "midi_files/")
-        midi_paths = {}
-        for path, subdirs, files in os.walk(midi_dir):
-            for name in files:
-                dir, artist = os.path.split(path)
-
-                artist = '_'.join(artist.lower().split())
-                song = '_'.join(name[:-4].lower().split())
-
-                midi_paths[artist + ' - ' + song] = os.path.join(path, name)
-
-        return midi_paths
+        return get_midi_paths(os.path.join(base_dir, "midi_files/"))
 
     def filter(self, files, durations):
         # Remove files too short or too long
@@ -62,15 +69,14 @@ class FilesAudioDataset(Dataset):
 
     def init_dataset(self, hps):
         # Load list of files and starts/durations
-        files = librosa.util.find_files(f'{hps.audio_files_dir}', ['mp3', 'opus', 'm4a', 'aac', 'wav'])
-        print_all(f"Found {len(files)} files. Getting durations")
-        # cache = dist.get_rank() % 8 == 0 if dist.is_available() else True
-        cache = True
-        durations = np.array([get_duration_sec(file, cache=cache) * self.sr for file in files])  # Could be approximate
+        files, durations = get_files_and_durations(hps.audio_files_dir, self.sr, hps.duration_index, hps.duration_index_refresh)
         self.filter(files, durations)
 
         if self.labels:
-            self.labeller = Labeller(hps.max_bow_genre_size, hps.n_tokens, self.sample_length, v3=hps.labels_v3)
+            self.init_labeller(hps)
+
+    def init_labeller(self, hps):
+        self.labeller = Labeller(hps.max_bow_genre_size, hps.n_tokens, self.sample_length, v3=hps.labels_v3)
 
     def get_index_offset(self, item):
         # For a given dataset item and shift, return song index and offset within song
@@ -97,70 +103,159 @@ class FilesAudioDataset(Dataset):
         offset = offset - start
         return index, offset
 
+    def init_metadata(self):
+        # Resolve the database once into ids aligned with self.files, so labelling a chunk
+        # is an array lookup instead of a scan over self.songs
+        keys = ['Song Name', 'Artist']
+        counts = self.songs.groupby(keys, sort=False).size()
+        first = self.songs.drop_duplicates(keys, keep='first').set_index(keys)['Genre(s)']
+        self.song_lookup = dict(zip(first.index, zip(first.values, counts.reindex(first.index).values)))
+
+        ag_processor, text_processor = self.labeller.ag_processor, self.labeller.text_processor
+        max_genre_words = self.labeller.max_genre_words
+        artist_ids, genre_ids, tokens = {}, {}, {}
+        self.file_artist_ids = np.zeros(len(self.files), dtype=np.int64)
+        self.file_genre_ids = np.full((len(self.files), max_genre_words), -1, dtype=np.int64)
+        self.file_lyric_tokens = []
+        unmatched, ambiguous = [], []
+        for index, filename in enumerate(self.files):
+            n_hits = self.lookup_song(filename)[-1]
+            if n_hits == 0:
+                unmatched.append(filename)
+            elif n_hits > 1:
+                ambiguous.append(filename)
+            artist, genre, lyrics = self.get_metadata(filename, test=False)
+            if artist not in artist_ids:
+                artist_ids[artist] = ag_processor.get_artist_id(artist)
+            if genre not in genre_ids:
+                genre_ids[genre] = ag_processor.get_genre_ids(genre)
+                assert len(genre_ids[genre]) <= max_genre_words, f'Genre {genre} has more than {max_genre_words} words'
+            if lyrics not in tokens:
+                tokens[lyrics] = text_processor.tokenise(text_processor.clean(lyrics))
+            self.file_artist_ids[index] = artist_ids[artist]
+            self.file_genre_ids[index, :len(genre_ids[genre])] = genre_ids[genre]
+            self.file_lyric_tokens.append(tokens[lyrics])
+
+        print_all(f"Matched {len(self.files) - len(unmatched)} of {len(self.files)} files to {len(self.song_lookup)} songs in database. "
+                  f"{len(unmatched)} unmatched (labelled unknown), {len(ambiguous)} ambiguous (using first match)")
+        for name, files in (('Unmatched', unmatched), ('Ambiguous', ambiguous)):
+            if files:
+                print_all(f"{name}: {', '.join(os.path.basename(f) for f in files[:10])}{' ...' if len(files) > 10 else ''}")
+
+    def lookup_song(self, filename):
+        # Files are named "{song name} - {artist}_{suffix}". Returns (artist, name, genre, n_hits)
+        filename = filename.split('/')[-1]
+        filename = filename[::-1]
+        try:
+            _, info = filename.split("_", 1)
+            artist, name = info.split(" - ", 1)
+        except ValueError:
+            return None, None, None, 0
+        artist = artist[::-1]
+        name = name[::-1]
+        genre, n_hits = self.song_lookup.get((name, artist), (None, 0))
+        return artist, name, genre, n_hits
+
     def get_metadata(self, filename, test):
         """
         Insert metadata loading code for your dataset here.
         If artist/genre labels are different from provided artist/genre lists,
-        update labeller accordingly.
+        update labeller accordingly. Called once per file in init_metadata.
 
         Returns:
             (artist, genre, full_lyrics) of type (str, str, str). For
             example, ("unknown", "classical", "") could be a metadata for a
             piano piece.
         """
-        filename = filename.split('/')[-1]
-        filename = filename[::-1]
-        _, info = filename.split("_", 1)
-        artist, name = info.split(" - ", 1)
-        artist = artist[::-1]
-        name = name[::-1]
-        hits = self.songs[self.songs['Song Name'] == name]
-        song = hits[hits['Artist'] == artist]
+        artist, name, genre, n_hits = self.lookup_song(filename)
 
-        if len(song) == 0:
+        if n_hits == 0:
             return 'unknown', 'unknown', ''
         else:
-            song = song.iloc[0]
-            artist = artist = '_'.join(artist.split())
-            genre = '_'.join(re.split(' |/', song["Genre(s)"])).lower()
+            artist = '_'.join(artist.split())
+            genre = '_'.join(re.split(' |/', genre)).lower()
             return artist, genre, ''
 
-    def get_song_chunk(self, index, offset, test=False):
-        filename, total_length = self.files[index], self.durations[index]
-        data, sr = load_audio(filename, sr=self.sr, offset=offset, duration=self.sample_length)
+    def get_y(self, index, total_length, offset):
+        if self.labeller.n_tokens > 0:
+            tokens, _ = get_relevant_lyric_tokens(self.file_lyric_tokens[index], self.labeller.n_tokens,
+                                                  total_length, offset, self.sample_length)
+        else:
+            tokens = []
+        return self.labeller.get_y_from_ids(self.file_artist_ids[index], self.file_genre_ids[index], tokens,
+                                            total_length, offset)
+
+    def get_audio_chunk(self, index, offset):
+        if self.reader is not None:
+            data, sr = self.reader.read(self.files[index], offset=offset, duration=self.sample_length)
+        else:
+            data, sr = load_audio(self.files[index], sr=self.sr, offset=offset, duration=self.sample_length)
         assert data.shape == (
             self.channels, self.sample_length), f'Expected {(self.channels, self.sample_length)}, got {data.shape}'
+        return data.T
+
+    def get_song_chunk(self, index, offset, test=False):
+        filename, total_length = self.files[index], self.durations[index]
+        data = self.get_audio_chunk(index, offset)
         if self.labels:
-            artist, genre, lyrics = self.get_metadata(filename, test)
-            labels = self.labeller.get_label(artist, genre, lyrics, total_length, offset)
+            y = self.get_y(index, total_length, offset)
             midi = self.get_midi_chunk(index, offset)
-            return (data.T, labels['y'], midi)
+            return (data, y, midi)
         else:
-            return data.T
+            return data
 
     def get_item(self, item, test=False):
         index, offset = self.get_index_offset(item)
         return self.get_song_chunk(index, offset, test)
 
+    def get_items(self, items, test=False):
+        # Batched get_item, returning stacked tensors. Chunks are read grouped by file in order
+        # of offset, so windows of one song continue a single decode
+        indices, offsets = zip(*[self.get_index_offset(item) for item in items])
+        indices, offsets = np.array(indices, dtype=np.int64), np.array(offsets, dtype=np.int64)
+        data = None
+        for i in np.lexsort((offsets, indices)):
+            chunk = self.get_audio_chunk(indices[i], offsets[i])
+            if data is None:
+                data = np.empty((len(items), *chunk.shape), dtype=chunk.dtype)
+            data[i] = chunk
+        data = t.from_numpy(data)
+        if not self.labels:
+            return data
+
+        total_lengths = np.array(self.durations, dtype=np.int64)[indices]
+        if self.labeller.n_tokens > 0:
+            tokens = [get_relevant_lyric_tokens(self.file_lyric_tokens[index], self.labeller.n_tokens, total_length,
+                                                offset, self.sample_length)[0]
+                      for index, total_length, offset in zip(indices, total_lengths, offsets)]
+        else:
+            tokens = None
+        y = self.labeller.get_y_batch_from_ids(self.file_artist_ids[indices], self.file_genre_ids[indices], tokens,
+                                               total_lengths, offsets)
+        midi = np.stack([self.get_midi_chunk(index, offset) for index, offset in zip(indices, offsets)])
+        return data, t.from_numpy(y), t.from_numpy(midi)
+
     def __len__(self):
         return int(np.floor(self.cumsum[-1] / self.sample_length))
 
     def __getitem__(self, item):
         return self.get_item(item)
 
-    def get_midi_chunk(self, index, offset):
-        filename, total_length = self.files[index], self.durations[index]
-        filename = os.path.split(filename)[1]
-        info = filename[:-18][::-1]
+    def get_midi_key(self, filename):
+        # "{song} - {artist}_accompaniment.wav" -> "artist - song" as in create_midi_paths
+        info = os.path.split(filename)[1][:-18][::-1]
         artist, song = info.split(" - ", 1)
 
         artist = '_'.join(artist[::-1].lower().split())
         song = '_'.join(song[::-1].lower().split())
-        midi_path = self.midi_paths[artist + ' - ' + song]
+        return artist + ' - ' + song
+
+    def get_midi_chunk(self, index, offset):
+        key = self.get_midi_key(self.files[index])
+        if self.midi_cache is not None and key in self.midi_cache:
+            return self.midi_cache.get_chunk(key, sr=self.sr, offset=offset, duration=self.sample_length)
+        midi_path = self.midi_paths[key]
 
         if not os.path.exists(midi_path):
             raise RuntimeError("IT FAILED")
         return load_midi(midi_path, sr=self.sr, offset=offset, duration=self.sample_length)
-
-
-
@@ -64,7 +64,7 @@ class Labeller():
 
     def get_y_from_ids(self, artist_id, genre_ids, lyric_tokens, total_length, offset):
         assert len(genre_ids) <= self.max_genre_words
-        genre_ids = genre_ids + [-1] * (self.max_genre_words - len(genre_ids))
+        genre_ids = list(genre_ids) + [-1] * (self.max_genre_words - len(genre_ids))
         if self.n_tokens > 0:
             assert len(lyric_tokens) == self.n_tokens
         else:
@@ -73,6 +73,19 @@ class Labeller():
         assert y.shape == self.label_shape, f"Expected {self.label_shape}, got {y.shape}"
         return y
 
+    def get_y_batch_from_ids(self, artist_ids, genre_ids, lyric_tokens, total_lengths, offsets):
+        # Batched get_y_from_ids. genre_ids is [bs, max_genre_words] padded with -1, lyric_tokens is [bs, n_tokens]
+        bs = len(artist_ids)
+        assert genre_ids.shape == (bs, self.max_genre_words), f'Expected {(bs, self.max_genre_words)}, got {genre_ids.shape}'
+        columns = [np.asarray(total_lengths, dtype=np.int64)[:, None], np.asarray(offsets, dtype=np.int64)[:, None],
+                   np.full((bs, 1), self.sample_length, dtype=np.int64), np.asarray(artist_ids, dtype=np.int64)[:, None],
+                   np.asarray(genre_ids, dtype=np.int64)]
+        if self.n_tokens > 0:
+            columns.append(np.asarray(lyric_tokens, dtype=np.int64).reshape(bs, self.n_tokens))
+        ys = np.concatenate(columns, axis=1)
+        assert ys.shape == (bs, *self.label_shape), f"Expected {(bs, *self.label_shape)}, got {ys.shape}"
+        return ys
+
     def get_batch_labels(self, metas, device='cpu'):
         ys, infos = [], []
         for meta in metas:
@@ -0,0 +1,164 @@
+"""
+Precomputed piano rolls for the MIDI conditioning.
+
+load_midi parses the whole MIDI file with pretty_midi and rasterizes the full song for
+every training chunk. build_midi_cache does that once per matched MIDI file and writes the
+rolls (velocities summed over instruments at the dt grid, [T, 128] uint16) back to back
+into one file, plus an index of (key, start, length, n_instruments) keyed by the same
+'artist - song' key as FilesAudioDataset.create_midi_paths. MidiCache.get_chunk is then
+a memmap slice of the chunk's frames, and returns exactly what load_midi returns.
+"""
+import os
+import time
+import numpy as np
+
+from jukebox.utils.dist_utils import print_all
+from jukebox.utils.io import get_midi_roll, get_midi_chunk_from_roll, load_midi
+
+INDEX_FILE = 'index.npz'
+ROLLS_FILE = 'rolls.bin'
+N_NOTES = 128
+
+
+def get_midi_paths(midi_dir):
+    # midi_dir/{artist}/{song}.mid -> {'artist - song': path}, lower case with spaces as underscores
+    midi_paths = {}
+    for path, subdirs, files in os.walk(midi_dir):
+        for name in files:
+            dir, artist = os.path.split(path)
+
+            artist = '_'.join(artist.lower().split())
+            song = '_'.join(name[:-4].lower().split())
+
+            midi_paths[artist + ' - ' + song] = os.path.join(path, name)
+    return midi_paths
+
+
+def build_midi_cache(midi_paths, cache_dir, dt=0.25):
+    """
+    Rasterize every file in midi_paths (dict of key -> path) once into cache_dir.
+    Files pretty_midi can't read are skipped. Returns dict of stats.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    keys, starts, lengths, n_instruments = [], [], [], []
+    total, failed = 0, []
+    start_time = time.time()
+    with open(os.path.join(cache_dir, ROLLS_FILE), 'wb') as f:
+        for i, key in enumerate(sorted(midi_paths)):
+            try:
+                roll, n = get_midi_roll(midi_paths[key], dt)
+            except Exception as e:
+                print_all(f'Could not read {midi_paths[key]}: {e}')
+                failed.append(key)
+                continue
+            assert roll.max(initial=0) <= np.iinfo(np.uint16).max, f'Velocities of {key} overflow uint16'
+            f.write(np.ascontiguousarray(roll, dtype=np.uint16).tobytes())
+            keys.append(key)
+            starts.append(total)
+            lengths.append(len(roll))
+            n_instruments.append(n)
+            total += len(roll)
+            if i % 100 == 0:
+                print_all(f'Cached {i + 1}/{len(midi_paths)} midi files')
+
+    np.savez(os.path.join(cache_dir, INDEX_FILE), keys=np.array(keys, dtype=str),
+             starts=np.array(starts, dtype=np.int64), lengths=np.array(lengths, dtype=np.int64),
+             n_instruments=np.array(n_instruments, dtype=np.int64), dt=dt)
+    stats = dict(files=len(keys), failed=len(failed), frames=total, bytes=total * N_NOTES * 2,
+                 time=time.time() - start_time)
+    print_all(f"Cached {stats['files']} midi files ({stats['failed']} failed), {stats['frames']} frames, "
+              f"{stats['bytes'] / 2**20:.1f} MB in {stats['time']:.1f}s")
+    return stats
+
+
+class MidiCache:
+    """
+    Read side of build_midi_cache. Opens the rolls lazily, so each DataLoader worker maps its own view.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        index = np.load(os.path.join(cache_dir, INDEX_FILE))
+        self.rows = {str(key): i for i, key in enumerate(index['keys'])}
+        self.starts, self.lengths = index['starts'], index['lengths']
+        self.n_instruments = index['n_instruments']
+        self.dt = float(index['dt'])
+        self._rolls = None
+        print_all(f"Found {len(self.rows)} cached midi files in {cache_dir}")
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def get_rolls(self):
+        if self._rolls is None:
+            path = os.path.join(self.cache_dir, ROLLS_FILE)
+            if os.path.getsize(path) == 0:
+                self._rolls = np.zeros((0, N_NOTES), dtype=np.uint16)
+            else:
+                self._rolls = np.memmap(path, dtype=np.uint16, mode='r').reshape(-1, N_NOTES)
+        return self._rolls
+
+    def get_chunk(self, key, sr, offset, duration):
+        # Same as load_midi(midi_paths[key], sr, offset, duration, dt)
+        row = self.rows[key]
+        start, length = self.starts[row], self.lengths[row]
+        roll = self.get_rolls()[start:start + length]
+        return get_midi_chunk_from_roll(roll, self.n_instruments[row], sr, offset, duration, self.dt)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_rolls'] = None
+        return state
+
+
+def test_midi_cache(n_files=20, n_items=200, n_notes=2000, n_instruments=4, song_seconds=240, sr=44100,
+                    sample_length=1048576, seed=0):
+    """
+    Per item latency of load_midi vs MidiCache.get_chunk on a directory of synthetic midi files.
+    """
+    import tempfile
+    import pretty_midi
+    rng = np.random.RandomState(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        midi_dir = os.path.join(tmp, 'midi_files')
+        for i in range(n_files):
+            os.makedirs(os.path.join(midi_dir, f'artist {i % 5}'), exist_ok=True)
+            midi = pretty_midi.PrettyMIDI()
+            for j in range(n_instruments):
+                instrument = pretty_midi.Instrument(program=j)
+                starts = rng.uniform(0, song_seconds, n_notes // n_instruments)
+                for start in starts:
+                    instrument.notes.append(pretty_midi.Note(velocity=int(rng.randint(1, 128)), pitch=int(rng.randint(0, 128)),
+                                                             start=start, end=start + rng.uniform(0.05, 2.0)))
+                midi.instruments.append(instrument)
+            midi.write(os.path.join(midi_dir, f'artist {i % 5}', f'song {i}.mid'))
+
+        midi_paths = get_midi_paths(midi_dir)
+        build_midi_cache(midi_paths, os.path.join(tmp, 'cache'))
+        cache = MidiCache(os.path.join(tmp, 'cache'))
+
+        keys = sorted(midi_paths)
+        items = [(keys[rng.randint(len(keys))], rng.randint(0, (song_seconds - 30) * sr)) for _ in range(n_items)]
+        start_time = time.time()
+        expected = [load_midi(midi_paths[key], sr=sr, offset=offset, duration=sample_length) for key, offset in items]
+        load_time = time.time() - start_time
+
+        start_time = time.time()
+        actual = [cache.get_chunk(key, sr=sr, offset=offset, duration=sample_length) for key, offset in items]
+        cache_time = time.time() - start_time
+
+        assert all(np.array_equal(x, y) for x, y in zip(expected, actual)), 'Cached chunks differ from load_midi'
+        print_all(f'load_midi: {load_time / n_items * 1000:.2f} ms/item')
+        print_all(f'MidiCache: {cache_time / n_items * 1000:.3f} ms/item ({load_time / cache_time:.0f}x)')
+
+
+def run(hps="teeny", **kwargs):
+    from jukebox.hparams import setup_hparams
+    hps = setup_hparams(hps, kwargs)
+    assert hps.midi_cache_dir, 'Pass --midi_cache_dir'
+    base_dir, _ = os.path.split(hps.audio_files_dir)
+    build_midi_cache(get_midi_paths(os.path.join(base_dir, "midi_files/")), hps.midi_cache_dir)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(dict(run=run, test=test_midi_cache))
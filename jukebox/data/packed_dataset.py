@@ -0,0 +1,175 @@
+"""
+Pre-decoded audio shards for FilesAudioDataset.
+
+pack_dataset decodes every song once at the target sr into large raw shard files
+(time-major, [T, C]) plus an index of (file, shard, start, length). PackedAudioDataset
+then serves chunks as np.memmap slices of those shards instead of decoding with PyAV
+on every item. Songs are never split across shards, and the index lengths are exactly
+the durations FilesAudioDataset would use, so get_index_offset/cumsum are unchanged.
+"""
+import os
+import time
+import numpy as np
+
+from jukebox.data.files_dataset import FilesAudioDataset, get_files_and_durations
+from jukebox.utils.dist_utils import print_all
+from jukebox.utils.io import load_audio
+
+INDEX_FILE = 'index.npz'
+DTYPES = {'float16': np.float16, 'int16': np.int16}
+
+
+def shard_path(packed_dir, shard):
+    return os.path.join(packed_dir, f'shard_{shard:05d}.bin')
+
+
+def to_shard_dtype(x, dtype):
+    # x: float32 in [-1, 1]
+    if dtype == 'int16':
+        return (np.clip(x, -1.0, 1.0) * 32767.0).astype(np.int16)
+    return x.astype(np.float16)
+
+
+def pack_dataset(files, durations, packed_dir, sr, channels=2, dtype='float16', shard_size_in_seconds=3600):
+    """
+    Decode files (with durations in samples at sr) into shards in packed_dir.
+    Returns dict of decode stats.
+    """
+    assert dtype in DTYPES, f'Unknown shard dtype {dtype}, expected one of {list(DTYPES)}'
+    assert channels == 2, f'load_audio always decodes to stereo, got channels={channels}'
+    os.makedirs(packed_dir, exist_ok=True)
+    shard_samples = int(shard_size_in_seconds * sr)
+    np_dtype = DTYPES[dtype]
+
+    shards, starts, lengths = [], [], []
+    shard, shard_len, f = 0, 0, None
+    decode_time, total_samples = 0.0, 0
+    for i, (file, duration) in enumerate(zip(files, durations)):
+        duration = int(duration)
+        if f is None or (shard_len > 0 and shard_len + duration > shard_samples):
+            if f is not None:
+                f.close()
+                shard += 1
+            f = open(shard_path(packed_dir, shard), 'wb')
+            shard_len = 0
+        start_time = time.time()
+        data, _ = load_audio(file, sr=sr, offset=0, duration=duration)
+        decode_time += time.time() - start_time
+        assert data.shape == (channels, duration), f'Expected {(channels, duration)}, got {data.shape}'
+        f.write(np.ascontiguousarray(to_shard_dtype(data.T, dtype)).tobytes())
+        shards.append(shard)
+        starts.append(shard_len)
+        lengths.append(duration)
+        shard_len += duration
+        total_samples += duration
+        if i % 100 == 0:
+            print_all(f'Packed {i + 1}/{len(files)} files into {shard + 1} shards')
+    if f is not None:
+        f.close()
+
+    np.savez(os.path.join(packed_dir, INDEX_FILE),
+             files=np.array(files), shards=np.array(shards, dtype=np.int64),
+             starts=np.array(starts, dtype=np.int64), lengths=np.array(lengths, dtype=np.int64),
+             sr=sr, channels=channels, dtype=dtype)
+
+    stats = dict(files=len(files), shards=shard + 1 if files else 0,
+                 seconds=total_samples / sr, decode_time=decode_time,
+                 decode_speed=total_samples / sr / max(decode_time, 1e-9),
+                 bytes=total_samples * channels * np.dtype(np_dtype).itemsize)
+    print_all(f"Packed {stats['files']} files ({stats['seconds']:.0f}s of audio) into {stats['shards']} shards, "
+              f"{stats['bytes'] / 2**30:.2f} GB. Decode speed {stats['decode_speed']:.1f}x realtime")
+    return stats
+
+
+def load_index(packed_dir):
+    index = np.load(os.path.join(packed_dir, INDEX_FILE))
+    return dict(files=[str(f) for f in index['files']], shards=index['shards'], starts=index['starts'],
+                lengths=index['lengths'], sr=int(index['sr']), channels=int(index['channels']),
+                dtype=str(index['dtype']))
+
+
+class PackedAudioDataset(FilesAudioDataset):
+    """
+    Drop-in replacement for FilesAudioDataset that reads from shards written by pack_dataset.
+    """
+    def __init__(self, hps, audio_database):
+        self.packed_dir = hps.packed_audio_dir
+        self._shards = {}
+        super().__init__(hps, audio_database)
+
+    def init_dataset(self, hps):
+        index = load_index(self.packed_dir)
+        assert index['sr'] == self.sr, f"Shards packed at sr {index['sr']}, expected {self.sr}. Re-run pack"
+        assert index['channels'] == self.channels, f"Shards packed with {index['channels']} channels, expected {self.channels}"
+        self.dtype = index['dtype']
+        print_all(f"Found {len(index['files'])} packed files in {self.packed_dir}")
+        self.filter(index['files'], index['lengths'])
+
+        rows = {file: i for i, file in enumerate(index['files'])}
+        keep = np.array([rows[file] for file in self.files], dtype=np.int64)
+        self.file_shards = index['shards'][keep]
+        self.file_starts = index['starts'][keep]
+
+        if self.labels:
+            self.init_labeller(hps)
+
+    def get_shard(self, shard):
+        # Opened lazily so each DataLoader worker maps its own view. Copy-on-write keeps
+        # slices writable for t.from_numpy without ever touching the file.
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(shard_path(self.packed_dir, shard), dtype=DTYPES[self.dtype],
+                                            mode='c').reshape(-1, self.channels)
+        return self._shards[shard]
+
+    def get_audio_chunk(self, index, offset):
+        start = int(self.file_starts[index] + offset)
+        data = self.get_shard(self.file_shards[index])[start:start + self.sample_length]
+        if self.dtype == 'int16':
+            data = data.astype(np.float32) / 32767.0
+        return data  # TC
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+
+def test_packed_loader(hps="teeny", audio_database=None, n_items=100, **kwargs):
+    """
+    Compare decode (PyAV) vs packed (memmap) read throughput on the same items.
+    """
+    from jukebox.hparams import setup_hparams
+    hps = setup_hparams(hps, kwargs)
+    assert hps.packed_audio_dir, 'Pass --packed_audio_dir'
+    packed = PackedAudioDataset(hps, audio_database)
+    n_items = min(n_items, len(packed))
+    items = [packed.get_index_offset(item) for item in range(n_items)]
+
+    start_time = time.time()
+    for index, offset in items:
+        x, _ = load_audio(packed.files[index], sr=packed.sr, offset=offset, duration=packed.sample_length)
+    decode_time = time.time() - start_time
+
+    start_time = time.time()
+    for index, offset in items:
+        y = np.asarray(packed.get_audio_chunk(index, offset), dtype=np.float32)
+    read_time = time.time() - start_time
+
+    seconds = n_items * packed.sample_length / packed.sr
+    print_all(f'Decode: {seconds / decode_time:.1f}x realtime ({decode_time / n_items * 1000:.1f} ms/item)')
+    print_all(f'Packed read: {seconds / read_time:.1f}x realtime ({read_time / n_items * 1000:.3f} ms/item)')
+    print_all(f'Max abs diff of last item: {np.abs(x.T - y).max():.2e}')
+
+
+def run(hps="teeny", **kwargs):
+    from jukebox.hparams import setup_hparams
+    hps = setup_hparams(hps, kwargs)
+    assert hps.packed_audio_dir, 'Pass --packed_audio_dir'
+    files, durations = get_files_and_durations(hps.audio_files_dir, hps.sr, hps.duration_index, hps.duration_index_refresh)
+    pack_dataset(files, durations, hps.packed_audio_dir, hps.sr, channels=hps.channels,
+                 dtype=hps.packed_audio_dtype, shard_size_in_seconds=hps.packed_shard_size_in_seconds)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(run)
@@ -0,0 +1,144 @@
+"""
+Overlap input loading with the training step.
+
+Prefetcher wraps a DataLoader of batches (x, or (x, y, midi)) and yields them on the device
+with audio_preprocess already applied to x. On cuda it keeps up to `depth` batches in flight:
+their pinned host tensors are copied and preprocessed on a side stream while the current
+step runs, and the compute stream only waits on an event for the batch it is about to use.
+On cpu a background thread keeps up to `depth` preprocessed batches ready instead.
+wait_time is how long the last step blocked on input, so it shows when data is the bottleneck.
+"""
+import queue
+import threading
+import time
+from collections import deque
+
+import torch as t
+
+from jukebox.utils.audio_utils import audio_preprocess
+
+
+class Prefetcher:
+    def __init__(self, loader, hps, depth=2, device='cuda'):
+        self.loader = loader
+        self.hps = hps
+        self.depth = max(depth, 1)
+        self.device = t.device(device if t.cuda.is_available() else 'cpu')
+        self.wait_time = 0.0  # Seconds the last step waited for its batch
+        self.total_wait_time = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def stage(self, batch):
+        # Copy to device and preprocess. Tensors should be pinned for the copies to be async
+        if isinstance(batch, (tuple, list)):
+            x, *rest = batch
+            rest = [v.to(self.device, non_blocking=True) for v in rest]
+        else:
+            x, rest = batch, None
+        x = audio_preprocess(x.to(self.device, non_blocking=True), self.hps)
+        return x if rest is None else (x, *rest)
+
+    def record_wait(self, start_time):
+        self.wait_time = time.time() - start_time
+        self.total_wait_time += self.wait_time
+
+    def __iter__(self):
+        self.total_wait_time = 0.0
+        if self.device.type == 'cuda':
+            return self.iter_cuda()
+        return self.iter_cpu()
+
+    def iter_cuda(self):
+        stream = t.cuda.Stream()
+        loader = iter(self.loader)
+        staged = deque()
+
+        def preload():
+            batch = next(loader, None)
+            if batch is None:
+                return
+            batch = tuple(v if v.is_pinned() else v.pin_memory() for v in batch) if isinstance(batch, (tuple, list)) \
+                else (batch if batch.is_pinned() else batch.pin_memory())
+            # Don't overwrite memory the compute stream may still be using
+            stream.wait_stream(t.cuda.current_stream())
+            with t.cuda.stream(stream):
+                batch = self.stage(batch)
+                event = t.cuda.Event()
+                event.record(stream)
+            staged.append((batch, event))
+
+        for _ in range(self.depth):
+            preload()
+        while staged:
+            start_time = time.time()
+            batch, event = staged.popleft()
+            t.cuda.current_stream().wait_event(event)
+            for v in (batch if isinstance(batch, tuple) else (batch,)):
+                v.record_stream(t.cuda.current_stream())  # Allocated on the side stream, used on this one
+            preload()
+            self.record_wait(start_time)
+            yield batch
+
+    def iter_cpu(self):
+        ready = queue.Queue(maxsize=self.depth)
+        done = object()
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    ready.put(self.stage(batch))
+            except Exception as e:
+                ready.put(e)
+            ready.put(done)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        while True:
+            start_time = time.time()
+            batch = ready.get()
+            if batch is done:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            self.record_wait(start_time)
+            yield batch
+        thread.join()
+
+
+def test_prefetcher(n_batches=20, load_time=0.05, step_time=0.05, bs=4, sample_length=44100, depth=2):
+    """
+    Simulated loader and step on cpu. Prefetched, total time should approach max(load_time, step_time) per batch.
+    """
+    from types import SimpleNamespace
+    hps = SimpleNamespace(aug_blend=True, channels=2)
+
+    class SlowLoader:
+        def __len__(self):
+            return n_batches
+
+        def __iter__(self):
+            for _ in range(n_batches):
+                time.sleep(load_time)
+                yield t.randn(bs, sample_length, 2)
+
+    start_time = time.time()
+    for x in SlowLoader():
+        x = audio_preprocess(x, hps)
+        time.sleep(step_time)
+    serial_time = time.time() - start_time
+
+    prefetcher = Prefetcher(SlowLoader(), hps, depth=depth, device='cpu')
+    start_time = time.time()
+    for x in prefetcher:
+        assert x.shape == (bs, sample_length, 1)
+        time.sleep(step_time)
+    prefetch_time = time.time() - start_time
+    print(f'Serial: {serial_time / n_batches * 1000:.1f} ms/step, prefetched: {prefetch_time / n_batches * 1000:.1f} ms/step, '
+          f'data wait {prefetcher.total_wait_time / n_batches * 1000:.1f} ms/step')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_prefetcher)
@@ -0,0 +1,107 @@
+"""
+Song locality aware sampling.
+
+RandomSampler/DistributedSampler make every batch touch bs random songs, so each item pays a
+container open, seek and decode. SongLocalitySampler instead cuts each song's items into runs of
+up to `locality` consecutive windows (at a random phase each epoch), shuffles the runs globally
+and concatenates them. Every item is still seen once per epoch in a random song order, but a
+worker reads a run front to back, so its windows continue one decode (see AudioReader).
+locality=1 is an ordinary shuffle.
+"""
+import math
+import numpy as np
+from torch.utils.data import Sampler
+
+from jukebox.utils.dist_utils import print_all
+
+
+def get_item_songs(dataset, start, end):
+    # Song index of each item in [start, end) of a FilesAudioDataset, as in get_index_offset without aug_shift
+    midpoints = np.arange(start, end, dtype=np.int64) * dataset.sample_length + dataset.sample_length // 2
+    return np.searchsorted(dataset.cumsum, midpoints)
+
+
+class SongLocalitySampler(Sampler):
+    """
+    Sampler over the items of an OffsetDataset. With num_replicas > 1 it replaces DistributedSampler:
+    each rank gets a contiguous slice of the shuffled runs, padded to equal length like DistributedSampler.
+    """
+    def __init__(self, dataset, locality, batch_size, num_replicas=1, rank=0, seed=0):
+        assert locality >= 1, f'Locality should be at least 1, got {locality}'
+        self.songs = get_item_songs(dataset.dataset, dataset.start, dataset.end)
+        self.locality = locality
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = int(math.ceil(len(self.songs) / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+        self.stats = {}
+
+    def get_runs(self, rng):
+        # Items are sorted by song, so each song is a contiguous block of consecutive windows
+        song_starts = np.flatnonzero(np.r_[True, self.songs[1:] != self.songs[:-1]])
+        runs = []
+        for start, end in zip(song_starts, np.r_[song_starts[1:], len(self.songs)]):
+            cuts = np.unique(np.r_[start, np.arange(start + rng.randint(self.locality), end, self.locality), end])
+            runs.extend(zip(cuts[:-1], cuts[1:]))
+        return runs
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        runs = self.get_runs(rng)
+        order = rng.permutation(len(runs))
+        indices = np.concatenate([np.arange(*runs[i]) for i in order]) if runs else np.zeros(0, dtype=np.int64)
+
+        # Pad to make it evenly divisible, then take this rank's contiguous slice
+        indices = np.r_[indices, indices[:self.total_size - len(indices)]]
+        indices = indices[self.rank * self.num_samples:(self.rank + 1) * self.num_samples]
+        assert len(indices) == self.num_samples
+
+        self.log_stats(indices)
+        return iter(indices.tolist())
+
+    def log_stats(self, indices):
+        # Distinct files per batch, vs bs for a plain shuffle
+        n_batches = len(indices) // self.batch_size
+        if n_batches == 0:
+            return
+        batches = self.songs[indices[:n_batches * self.batch_size]].reshape(n_batches, self.batch_size)
+        batches = np.sort(batches, axis=1)
+        distinct = 1 + (batches[:, 1:] != batches[:, :-1]).sum(axis=1)
+        self.stats = dict(epoch=self.epoch, files_per_batch=distinct.mean(), max_files_per_batch=distinct.max(),
+                          items_per_file=self.batch_size / distinct.mean())
+        print_all(f"Epoch {self.epoch}: {self.stats['files_per_batch']:.2f} distinct files per batch of {self.batch_size} "
+                  f"(max {self.stats['max_files_per_batch']}), locality {self.locality}")
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+def test_song_sampler(n_songs=200, min_items=5, max_items=60, bs=16, localities=(1, 2, 4, 8), num_replicas=2):
+    """
+    Distinct files per batch for each locality, and check every item is seen once per epoch across ranks.
+    """
+    from types import SimpleNamespace
+    rng = np.random.RandomState(0)
+    sample_length = 1000
+    durations = rng.randint(min_items, max_items, n_songs) * sample_length + rng.randint(0, sample_length, n_songs)
+    dataset = SimpleNamespace(cumsum=np.cumsum(durations), sample_length=sample_length)
+    n_items = int(dataset.cumsum[-1] // sample_length)
+    offset_dataset = SimpleNamespace(dataset=dataset, start=0, end=n_items)
+    for locality in localities:
+        seen = []
+        for rank in range(num_replicas):
+            sampler = SongLocalitySampler(offset_dataset, locality, bs, num_replicas=num_replicas, rank=rank)
+            sampler.set_epoch(1)
+            seen.extend(sampler)
+        assert set(seen) == set(range(n_items)) and len(seen) - n_items < num_replicas, 'Items missing or repeated'
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_song_sampler)
@@ -347,6 +347,16 @@ DEFAULTS["script"] = Hyperparams(
 
 DEFAULTS["data"] = Hyperparams(
     audio_files_dir='',
+    duration_index='',
+    duration_index_refresh=True,
+    packed_audio_dir='',
+    packed_audio_dtype='float16',
+    packed_shard_size_in_seconds=3600,
+    midi_cache_dir='',
+    audio_reader_cache_size=8,
+    song_locality=1,
+    prefetch=2,
+    bandwidth_cache_dir='~/.cache/jukebox/bandwidth',
     finetune='',
     english_only=False,
     bs=1,
@@ -432,6 +442,7 @@ DEFAULTS["prior_attn_block"] = Hyperparams(
     c_res=0,
     c_attn=0,
     c_mlp=0,
+    attn_chunk_size=0,
 )
 
 DEFAULTS["cond_conv_block"] = Hyperparams(
@@ -478,6 +489,7 @@ DEFAULTS["prime_attn_block"] = Hyperparams(
     prime_c_res=0,
     prime_c_attn=0,
     prime_c_mlp=0,
+    prime_attn_chunk_size=0,
     prime_rel_attn=False,
     prime_posemb_timescale=10000,
 )
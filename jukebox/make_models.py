@@ -11,6 +11,7 @@ from jukebox.hparams import Hyperparams, setup_hparams
 from jukebox.utils.gcs_utils import download
 from jukebox.utils.torch_utils import freeze_model
 from jukebox.utils.dist_utils import print_all
+from jukebox.utils.model_residency import ModelResidency
 from jukebox.vqvae.vqvae import calculate_strides
 import fire
 
@@ -120,7 +121,8 @@ def make_prior(hps, vqvae, device='cuda'):
                         zero_out=hps.zero_out, res_scale=hps.res_scale, pos_init=hps.pos_init,
                         init_scale=hps.init_scale,
                         m_attn=hps.m_attn, m_mlp=hps.m_mlp,
-                        checkpoint_res=hps.c_res if hps.train else 0, checkpoint_attn=hps.c_attn if hps.train else 0, checkpoint_mlp=hps.c_mlp if hps.train else 0)
+                        checkpoint_res=hps.c_res if hps.train else 0, checkpoint_attn=hps.c_attn if hps.train else 0, checkpoint_mlp=hps.c_mlp if hps.train else 0,
+                        attn_chunk_size=hps.attn_chunk_size)
 
     x_cond_kwargs = dict(out_width=hps.prior_width, init_scale=hps.init_scale,
                          width=hps.cond_width, depth=hps.cond_depth, m_conv=hps.cond_m_conv,
@@ -143,7 +145,8 @@ def make_prior(hps, vqvae, device='cuda'):
                             pos_init=hps.prime_pos_init, init_scale=hps.prime_init_scale,
                             m_attn=hps.prime_m_attn, m_mlp=hps.prime_m_mlp,
                             checkpoint_res=hps.prime_c_res if hps.train else 0, checkpoint_attn=hps.prime_c_attn if hps.train else 0,
-                            checkpoint_mlp=hps.prime_c_mlp if hps.train else 0)
+                            checkpoint_mlp=hps.prime_c_mlp if hps.train else 0,
+                            attn_chunk_size=hps.prime_attn_chunk_size)
     else:
         prime_kwargs = dict(use_tokens=hps.use_tokens, prime_loss_fraction=hps.prime_loss_fraction,
                             n_tokens=hps.n_tokens, bins=hps.n_vocab)
@@ -194,6 +197,8 @@ def make_model(model, device, hps, levels=None):
     if levels is None:
         levels = range(len(priors))
     priors = [make_prior(setup_hparams(priors[level], dict()), vqvae, 'cpu') for level in levels]
+    # Priors stay on cpu, and are moved to device while sampling. Levels that fit in model_memory_budget (in GB) stay there
+    ModelResidency(priors, device, hps.get('model_memory_budget', 0.0))
     return vqvae, priors
 
 def save_outputs(model, device, hps):
@@ -1,9 +1,10 @@
+import copy
 import numpy as np
 import torch as t
 import torch.nn as nn
 import torch.nn.functional as F
 
-from jukebox.transformer.ops import filter_logits
+from jukebox.transformer.ops import filter_logits, sample_logits
 from jukebox.transformer.transformer import Transformer
 from jukebox.utils.logger import get_range
 from jukebox.utils.torch_utils import empty_cache
@@ -26,6 +27,32 @@ def split_chunks(length, chunk_size):
     assert sum(chunk_sizes) == length
     return chunk_sizes
 
+
+def _copy_module(module, **modules):
+    # Shallow copy of module with some submodules replaced. copy.copy alone would share _modules with module
+    copied = copy.copy(module)
+    copied._modules = copied._modules.copy()
+    copied._modules.update(modules)
+    return copied
+
+
+def get_layer_draft(prior, n_layers):
+    """
+    Draft for speculative_sample: prior with only its first n_layers transformer layers, sharing their weights.
+    The draft layers have their own kv caches. prior can be a ConditionalAutoregressive2D, or a SimplePrior.
+    """
+    if not hasattr(prior, 'transformer'):
+        return _copy_module(prior, prior=get_layer_draft(prior.prior, n_layers))
+    layers = []
+    for l in prior.transformer._attn_mods[:n_layers]:
+        attn = copy.copy(l.attn)
+        attn.qkv, attn.attn = attn.qkv.__func__.__get__(attn), attn.attn.__func__.__get__(attn) # Bound in __init__
+        attn.del_cache()
+        layers.append(_copy_module(l, attn=attn))
+    transformer = _copy_module(prior.transformer, _attn_mods=nn.ModuleList(layers))
+    transformer.sample_step = None
+    return _copy_module(prior, transformer=transformer)
+
 class MidiEmbedding(nn.Module):
     def __init__(self, out_shape):
         super().__init__()
@@ -54,9 +81,8 @@ class MidiEmbedding(nn.Module):
         self.lin2 = nn.Linear(512, 1024)
 
     def forward(self, midi):
-        x = midi.float().unsqueeze_(0)
-        print(x.shape)
-        
+        x = midi.float().unsqueeze(0)
+
         x = F.relu(self.conv1(x))
         x = self.pool(x)
 
@@ -98,6 +124,9 @@ class PositionEmbedding(nn.Module):
 
 
 class ConditionalAutoregressive2D(nn.Module):
+    debug = False # Validate inputs, cache and shapes on every sampled token. Each check can sync with the device
+    static_sample = False # Sample tokens with Transformer.get_sample_step, a fixed shape step compiled if possible
+
     def __init__(self, input_shape, bins,
                  width=128, depth=2, heads=1,
                  attn_dropout=0.0, resid_dropout=0.0, emb_dropout=0.0, mask=True,
@@ -105,7 +134,7 @@ class ConditionalAutoregressive2D(nn.Module):
                  m_attn=0.25, m_mlp=1,
                  checkpoint_res=0, checkpoint_attn=0, checkpoint_mlp=0,
                  attn_order=0, blocks=None, spread=None, x_cond=False, y_cond=False,
-                 encoder_dims=0, only_encode=False, merged_decoder=False, prime_len=None):
+                 encoder_dims=0, only_encode=False, merged_decoder=False, prime_len=None, attn_chunk_size=0):
         super().__init__()
         self.input_shape = input_shape
         self.input_dims = input_dims = np.prod(input_shape)
@@ -136,7 +165,8 @@ class ConditionalAutoregressive2D(nn.Module):
                                        checkpoint_attn=checkpoint_attn, checkpoint_mlp=checkpoint_mlp,
                                        checkpoint_res=checkpoint_res,
                                        attn_order=attn_order, blocks=blocks, spread=spread,
-                                       encoder_dims=encoder_dims, prime_len=prime_len)
+                                       encoder_dims=encoder_dims, prime_len=prime_len,
+                                       attn_chunk_size=attn_chunk_size)
 
         self.only_encode = only_encode
         self.prime_len = prime_len
@@ -236,33 +266,36 @@ class ConditionalAutoregressive2D(nn.Module):
         else:
             return loss, None
 
-    def get_emb(self, sample_t, n_samples, x, x_cond, y_cond):
+    def get_emb(self, sample_t, n_samples, x, x_cond, y_cond, pos_emb=None):
+        # pos_emb: self.pos_emb(), if the caller computed it once for the whole loop
         N, D = n_samples, self.input_dims
         if sample_t == 0:
             # Fill in start token
-            x = t.empty(n_samples, 1, self.width).cuda()
+            x = t.empty(n_samples, 1, self.width, device=self.x_emb.weight.device)
             if self.y_cond:
                 x[:, 0] = y_cond.view(N, self.width)
             else:
                 x[:, 0] = self.start_token
         else:
-            assert isinstance(x, t.cuda.LongTensor)
-            assert (0 <= x).all() and (x < self.bins).all()
+            if self.debug:
+                assert x.dtype == t.long
+                assert (0 <= x).all() and (x < self.bins).all()
             x = self.x_emb(x)
-        assert x.shape == (n_samples, 1, self.width)
+        if self.debug:
+            assert x.shape == (n_samples, 1, self.width)
         if x_cond.shape == (N, D, self.width):
             cond = x_cond[:, sample_t:sample_t + 1, :]
         else:
             cond = x_cond
-        x = x + self.pos_emb()[sample_t:sample_t + 1] + cond  # Pos emb, dropout is identity at eval time
-        assert x.shape == (n_samples, 1, self.width)
+        if pos_emb is None:
+            pos_emb = self.pos_emb()
+        x = x + pos_emb[sample_t:sample_t + 1] + cond  # Pos emb, dropout is identity at eval time
+        if self.debug:
+            assert x.shape == (n_samples, 1, self.width)
         return x, cond
 
-    def sample(self, n_samples, midi=None,  x_cond=None, y_cond=None, encoder_kv=None, fp16=False, temp=1.0, top_k=0, top_p=0.0,
-               get_preds=False, sample_tokens=None):
-        assert self.training == False
-
-        if sample_tokens is None: sample_tokens = self.input_dims
+    def check_sample_conds(self, n_samples, x_cond, y_cond):
+        # Returns x_cond, zeros if the prior isn't x conditioned
         N, D = n_samples, self.input_dims
         if self.y_cond:
             assert y_cond is not None
@@ -276,91 +309,99 @@ class ConditionalAutoregressive2D(nn.Module):
                 N, 1, self.width), f"Got {x_cond.shape}, expected ({N}, {D}/{1}, {self.width})"
         else:
             assert x_cond is None
-            x_cond = t.zeros((N, 1, self.width), dtype=t.float).cuda()
-
-        with t.no_grad():
-            xs, x = [], None
-            if get_preds:
-                preds = []
-            for sample_t in get_range(range(0, sample_tokens)):
-                x, cond = self.get_emb(sample_t, n_samples, x, x_cond, y_cond)
+            x_cond = t.zeros((N, 1, self.width), dtype=t.float, device=self.x_emb.weight.device)
+        return x_cond
+
+    def sample_loop(self, xs, start, x_cond, y_cond, encoder_kv, midi_cond, fp16, temp, top_k, top_p, generators, preds):
+        # Sample tokens [start, xs.shape[1]) of xs in place, one at a time through the kv cache. Conditioning that's
+        # the same for every token is computed once, and checks that sync with the device only run with self.debug
+        n_samples = xs.shape[0]
+        pos_emb = self.pos_emb()
+        step = None
+        if self.static_sample:
+            step = self.transformer.get_sample_step(n_samples, fp16)
+            step.load_cache(start, encoder_kv)
+        for sample_t in get_range(range(start, xs.shape[1])):
+            x, cond = self.get_emb(sample_t, n_samples, xs[:, sample_t - 1:sample_t], x_cond, y_cond, pos_emb)
+            if self.debug and step is None:
                 self.transformer.check_cache(n_samples, sample_t, fp16)
-                midi_cond = self.midi_emb(midi)
+            if midi_cond is not None:
                 x = x + midi_cond
+            if step is not None:
+                x = step(x)
+            else:
                 x = self.transformer(x, encoder_kv=encoder_kv, sample=True, fp16=fp16)  # Transformer
-                if self.add_cond_after_transformer:
-                    x = x + cond
+            if self.add_cond_after_transformer:
+                x = x + cond
+            if self.debug:
                 assert x.shape == (n_samples, 1, self.width)
-                x = self.x_out(x)  # Predictions
-                if get_preds:
-                    preds.append(x.clone())
-                # Adjust logits
-                x = x / temp
-                x = filter_logits(x, top_k=top_k, top_p=top_p)
-                x = t.distributions.Categorical(logits=x).sample()  # Sample and replace x
+            x = self.x_out(x)  # Predictions
+            if preds is not None:
+                preds.append(x.clone())
+            # Adjust logits
+            x = x / temp
+            x = filter_logits(x, top_k=top_k, top_p=top_p)
+            x = sample_logits(x, generators)  # Sample and replace x
+            if self.debug:
                 assert x.shape == (n_samples, 1)
-                xs.append(x.clone())
+            xs[:, sample_t] = x[:, 0]
 
-            del x
+    def sample(self, n_samples, x_cond=None, y_cond=None, encoder_kv=None, fp16=False, temp=1.0, top_k=0, top_p=0.0,
+               get_preds=False, sample_tokens=None, generators=None, midi=None):
+        assert self.training == False
+
+        if sample_tokens is None: sample_tokens = self.input_dims
+        x_cond = self.check_sample_conds(n_samples, x_cond, y_cond)
+
+        with t.no_grad():
+            preds = [] if get_preds else None
+            xs = t.empty((n_samples, sample_tokens), dtype=t.long, device=self.x_emb.weight.device)
+            midi_cond = self.midi_emb(midi) if midi is not None else None
+            self.sample_loop(xs, 0, x_cond, y_cond, encoder_kv, midi_cond, fp16, temp, top_k, top_p, generators, preds)
             self.transformer.del_cache()
 
-            x = t.cat(xs, dim=1)
             if get_preds:
                 preds = t.cat(preds, dim=1)
-            x = self.postprocess(x, sample_tokens)
+            x = self.postprocess(xs, sample_tokens)
         if get_preds:
             return x, preds
         else:
             return x
 
-    def primed_sample(self, n_samples, x, midi=None, x_cond=None, y_cond=None, encoder_kv=None, fp16=False, temp=1.0, top_k=0,
-                      top_p=0.0, get_preds=False, chunk_size=None, sample_tokens=None):
+    def primed_sample(self, n_samples, x, x_cond=None, y_cond=None, encoder_kv=None, fp16=False, temp=1.0, top_k=0,
+                      top_p=0.0, get_preds=False, chunk_size=None, sample_tokens=None, generators=None, midi=None):
         assert self.training == False
 
         if sample_tokens is None: sample_tokens = self.input_dims
         # Preprocess.
         with t.no_grad():
             x = self.preprocess(x)
-        assert isinstance(x, t.cuda.LongTensor)
-        assert (0 <= x).all() and (x < self.bins).all()
+        if self.debug:
+            assert (0 <= x).all() and (x < self.bins).all()
         assert x.shape[0] == n_samples
-        xs = t.split(x, 1, dim=1)
-        xs = list(xs)
-        assert len(xs) < sample_tokens
-
-        N, D = n_samples, self.input_dims
-        if self.y_cond:
-            assert y_cond is not None
-            assert y_cond.shape == (N, 1, self.width)
-        else:
-            assert y_cond is None
-
-        if self.x_cond:
-            assert x_cond is not None
-            assert x_cond.shape == (N, D, self.width) or x_cond.shape == (
-                N, 1, self.width), f"Got {x_cond.shape}, expected ({N}, {D}/{1}, {self.width})"
-        else:
-            assert x_cond is None
-            x_cond = t.zeros((N, 1, self.width), dtype=t.float).cuda()
+        n_prime = x.shape[1]
+        assert n_prime < sample_tokens
+        x_cond = self.check_sample_conds(n_samples, x_cond, y_cond)
 
         with t.no_grad():
-            if get_preds:
-                preds = []
+            preds = [] if get_preds else None
+            xs = t.empty((n_samples, sample_tokens), dtype=t.long, device=x.device)
+            xs[:, :n_prime] = x
+            midi_cond = self.midi_emb(midi) if midi is not None else None
+            pos_emb = self.pos_emb()
 
             # Fill up key/value cache for past context by runing forward pass.
             # We do so in chunks instead of doing the whole past in one forward pass to reduce max memory usage.
             if chunk_size is None:
-                chunk_size = len(xs)
-            # assert len(xs) % chunk_size == 0, f'expected {len(xs)} to be divisible by {chunk_size}'
-            chunk_sizes = split_chunks(len(xs), chunk_size)
+                chunk_size = n_prime
+            chunk_sizes = split_chunks(n_prime, chunk_size)
             x_primes = []
             start = 0
-            x = None
             for current_chunk_size in get_range(chunk_sizes):
                 xs_prime, conds_prime = [], []
                 for sample_t in range(start, start + current_chunk_size):
-                    x_prime, cond_prime = self.get_emb(sample_t, n_samples, x, x_cond, y_cond)
-                    x = xs[sample_t]
+                    x_prime, cond_prime = self.get_emb(sample_t, n_samples, xs[:, sample_t - 1:sample_t], x_cond, y_cond,
+                                                       pos_emb)
                     xs_prime.append(x_prime)
                     conds_prime.append(cond_prime)
                 start = start + current_chunk_size
@@ -370,8 +411,8 @@ class ConditionalAutoregressive2D(nn.Module):
                 assert cond_prime.shape == (n_samples, current_chunk_size, self.width)
                 del xs_prime
                 del conds_prime
-                midi_cond = self.midi_emb(midi)
-                x_prime = x_prime + midi_cond
+                if midi_cond is not None:
+                    x_prime = x_prime + midi_cond
                 if not get_preds:
                     del cond_prime
                 x_prime = self.transformer(x_prime, encoder_kv=encoder_kv, sample=True, fp16=fp16)
@@ -387,46 +428,131 @@ class ConditionalAutoregressive2D(nn.Module):
 
             if get_preds:
                 x_prime = t.cat(x_primes, dim=1)
-                assert x_prime.shape == (n_samples, len(xs), self.width)
+                assert x_prime.shape == (n_samples, n_prime, self.width)
                 x_prime = self.x_out(x_prime)  # Predictions
                 preds.append(x_prime)
 
             empty_cache()
-            self.transformer.check_cache(n_samples, len(xs), fp16)
-
-            x = xs[-1]
-            assert x.shape == (n_samples, 1)
-            empty_cache()
-            for sample_t in get_range(range(len(xs), sample_tokens)):
-                x, cond = self.get_emb(sample_t, n_samples, x, x_cond, y_cond)
-                self.transformer.check_cache(n_samples, sample_t, fp16)
-                x = self.transformer(x, encoder_kv=encoder_kv, sample=True, fp16=fp16)  # Transformer
-                if self.add_cond_after_transformer:
-                    x = x + cond
-                assert x.shape == (n_samples, 1, self.width)
-                x = self.x_out(x)  # Predictions
-                if get_preds:
-                    preds.append(x)
-                # Adjust logits
-                x = x / temp
-                x = filter_logits(x, top_k=top_k, top_p=top_p)
-                x = t.distributions.Categorical(logits=x).sample()  # Sample and replace x
-                assert x.shape == (n_samples, 1)
-                xs.append(x.clone())
-
-            del x
+            self.transformer.check_cache(n_samples, n_prime, fp16)
+            self.sample_loop(xs, n_prime, x_cond, y_cond, encoder_kv, midi_cond, fp16, temp, top_k, top_p, generators, preds)
             self.transformer.del_cache()
 
-            x = t.cat(xs, dim=1)
             if get_preds:
                 preds = t.cat(preds, dim=1)
-            x = self.postprocess(x, sample_tokens)
+            x = self.postprocess(xs, sample_tokens)
         if get_preds:
             return x, preds
         else:
             return x
 
+    def sample_chunk(self, xs, start, end, x_cond, y_cond, encoder_kv=None, midi_cond=None, fp16=False):
+        # Logits for tokens [start, end) of xs (N, D), from one forward of positions [start, end) through the kv cache
+        n_samples = xs.shape[0]
+        pos_emb = self.pos_emb()
+        embs, conds = zip(*[self.get_emb(sample_t, n_samples, xs[:, sample_t - 1:sample_t], x_cond, y_cond, pos_emb)
+                            for sample_t in range(start, end)])
+        x, cond = t.cat(embs, dim=1), t.cat(conds, dim=1)
+        if midi_cond is not None:
+            x = x + midi_cond
+        x = self.transformer(x, encoder_kv=encoder_kv, sample=True, fp16=fp16)  # Transformer
+        if self.add_cond_after_transformer:
+            x = x + cond
+        return self.x_out(x)  # Predictions
+
+    def speculative_sample(self, n_samples, draft, x=None, midi=None, x_cond=None, y_cond=None, encoder_kv=None,
+                           draft_conds=None, fp16=False, temp=1.0, top_k=0, top_p=0.0, chunk_size=None,
+                           sample_tokens=None, n_draft=4):
+        """
+        Sample (or primed sample, with x) with a draft prior proposing n_draft tokens at a time, which this prior
+        then scores in one chunked forward. A draft token is accepted with probability min(1, p / q) and the first
+        rejected one is resampled from max(p - q, 0), so samples have the same distribution as without a draft.
+        Rows of a batch accept different numbers of tokens, but share the kv cache, so each round keeps the
+        tokens every row accepted, and one more.
+        draft_conds: (x_cond, y_cond, encoder_kv) of the draft, if it has its own conditioning.
+        Returns the samples and a dict of stats.
+        """
+        assert self.training == False and draft.training == False
+        if sample_tokens is None: sample_tokens = self.input_dims
+        N, device = n_samples, self.x_emb.weight.device
+        if draft_conds is None:
+            draft_conds = (x_cond, y_cond, encoder_kv)
+        conds = []
+        for prior, (x_cond, y_cond, encoder_kv) in [(self, (x_cond, y_cond, encoder_kv)), (draft, draft_conds)]:
+            x_cond = prior.check_sample_conds(N, x_cond, y_cond)
+            midi_cond = prior.midi_emb(midi) if midi is not None else None
+            conds.append(dict(x_cond=x_cond, y_cond=y_cond, encoder_kv=encoder_kv, midi_cond=midi_cond, fp16=fp16))
+        conds, draft_conds = conds
+
+        with t.no_grad():
+            xs = t.zeros((N, sample_tokens), dtype=t.long, device=device)
+            n_prime = 0
+            if x is not None:
+                x = self.preprocess(x)
+                n_prime = x.shape[1]
+                assert n_prime < sample_tokens
+                xs[:, :n_prime] = x
+
+            # Fill up the key/value caches of both priors with the past context, in chunks
+            for prior, prior_conds in [(self, conds), (draft, draft_conds)]:
+                prior.transformer.del_cache()
+                for start in range(0, n_prime, chunk_size or max(n_prime, 1)):
+                    prior.sample_chunk(xs, start, min(start + (chunk_size or n_prime), n_prime), **prior_conds)
+            empty_cache()
+
+            get_probs = lambda logits: F.softmax(filter_logits(logits / temp, top_k=top_k, top_p=top_p), dim=-1)
+            sample_t, draft_t = n_prime, n_prime # Positions in the caches of the prior and the draft
+            n_rounds, n_proposed, n_accepted = 0, 0, 0
+            while sample_t < sample_tokens:
+                if self.debug:
+                    self.transformer.check_cache(N, sample_t, fp16)
+                k = min(n_draft, sample_tokens - sample_t - 1)
+                self.transformer.save_cache()
+                draft.transformer.save_cache()
+
+                # Draft k tokens. The draft may be a position behind, if all its tokens were accepted last round
+                qs = []
+                for i in range(k):
+                    q = get_probs(draft.sample_chunk(xs, draft_t, sample_t + i + 1, **draft_conds)[:, -1])
+                    draft_t = sample_t + i + 1
+                    xs[:, sample_t + i] = t.multinomial(q, 1)[:, 0]
+                    qs.append(q)
+
+                # Score them, and the token after, in one forward
+                p = get_probs(self.sample_chunk(xs, sample_t, sample_t + k + 1, **conds))
+                accepted = t.zeros(N, dtype=t.long, device=device)
+                if k > 0:
+                    q = t.stack(qs, dim=1)
+                    drafted = xs[:, sample_t:sample_t + k].unsqueeze(-1)
+                    p_drafted, q_drafted = p[:, :k].gather(-1, drafted)[..., 0], q.gather(-1, drafted)[..., 0]
+                    accept = t.rand_like(p_drafted) * q_drafted < p_drafted
+                    accepted = accept.long().cumprod(dim=1).sum(dim=1)
+                j = int(accepted.min())
+                if j < k:
+                    # Rows that accepted token j keep it, the others resample it from the residual
+                    residual = t.clamp(p[:, j] - q[:, j], min=0)
+                    residual = t.where(residual.sum(dim=-1, keepdim=True) > 0, residual, p[:, j])
+                    xs[:, sample_t + j] = t.where(accepted > j, xs[:, sample_t + j], t.multinomial(residual, 1)[:, 0])
+                else:
+                    xs[:, sample_t + k] = t.multinomial(p[:, k], 1)[:, 0]
+
+                n_rounds += 1
+                n_proposed += N * k
+                n_accepted += int(accepted.sum())
+                sample_t += j + 1
+                draft_t = min(draft_t, sample_t)
+                self.transformer.rewind_cache(sample_t)
+                draft.transformer.rewind_cache(draft_t)
+
+            self.transformer.del_cache()
+            draft.transformer.del_cache()
+            x = self.postprocess(xs, sample_tokens)
+        n_tokens = int(sample_tokens - n_prime)
+        stats = dict(rounds=n_rounds, tokens=n_tokens, acceptance=n_accepted / max(n_proposed, 1),
+                     tokens_per_round=n_tokens / max(n_rounds, 1))
+        return x, stats
+
     def check_sample(self, chunk_size):
+        self.debug = True
         bs, l, d = (4, self.input_dims, self.width)
         prime = int(self.input_dims // 8 * 7)
         enc_l = self.encoder_dims
@@ -478,6 +604,76 @@ def test_prior(input_shape, encoder_dims, blocks, heads, chunk_size):
             # print(f"Checked traced x_cond: {x_cond}, y_cond: {y_cond}")
 
 
+def test_sample_speed(n_ctx=1024, bins=256, width=1024, depth=4, n_samples=4, sample_tokens=512, n_prime=256,
+                      attn_order=2, blocks=16, midi=True, device='cpu'):
+    """
+    Tokens/sec of sample and primed_sample with and without the per token checks of debug, which should give
+    the same tokens. midi conditions on a random piano roll, the midi embedding needs width 1024.
+    """
+    import time
+    t.manual_seed(0)
+    prior = ConditionalAutoregressive2D((n_ctx,), bins, width=width, depth=depth, heads=2, attn_order=attn_order,
+                                        blocks=blocks, x_cond=True).to(device).eval()
+    x_cond = t.randn(n_samples, n_ctx, width, device=device)
+    midi = (t.rand(95, 128, device=device) > 0.9) if midi else None
+    x_prime = t.randint(0, bins, (n_samples, n_prime), device=device)
+    for name, sample in [('sample', lambda: prior.sample(n_samples, x_cond, midi=midi, sample_tokens=sample_tokens)),
+                         ('primed_sample', lambda: prior.primed_sample(n_samples, x_prime, x_cond, midi=midi, chunk_size=64,
+                                                                       sample_tokens=sample_tokens))]:
+        results = []
+        for debug in [True, False]:
+            prior.debug = debug
+            t.manual_seed(1)
+            start_time = time.time()
+            x = sample()
+            results.append((x, time.time() - start_time))
+        (x_debug, debug_time), (x_fast, fast_time) = results
+        assert t.equal(x_debug, x_fast), "Debug and fast sampling differ"
+        n_tokens = sample_tokens - (n_prime if name == 'primed_sample' else 0)
+        print(f"{name}: debug {n_tokens / debug_time:.1f} tokens/sec, fast {n_tokens / fast_time:.1f} tokens/sec")
+    prior.debug = False
+
+
+def test_speculative_sample(n_ctx=512, bins=64, width=128, depth=24, draft_layers=3, n_draft=4, n_samples=4,
+                            attn_order=2, blocks=16, n_check=20000, check_bins=8, check_tokens=3, device='cpu'):
+    """
+    Speculative sampling with the first draft_layers layers as the draft vs sample: acceptance and tokens/sec.
+    Then the token frequencies of n_check short samples from a small prior with a different draft prior,
+    against sample and against the draft on its own, to check the distribution is unchanged.
+    """
+    import time
+    t.manual_seed(0)
+    prior = ConditionalAutoregressive2D((n_ctx,), bins, width=width, depth=depth, heads=2, attn_order=attn_order,
+                                        blocks=blocks).to(device).eval()
+    draft = get_layer_draft(prior, draft_layers)
+
+    start_time = time.time()
+    prior.sample(n_samples)
+    baseline_time = time.time() - start_time
+    start_time = time.time()
+    _, stats = prior.speculative_sample(n_samples, draft, n_draft=n_draft)
+    speculative_time = time.time() - start_time
+    print(f"Baseline: {n_ctx / baseline_time:.1f} tokens/sec. Speculative with {draft_layers}/{depth} layers, "
+          f"n_draft {n_draft}: {n_ctx / speculative_time:.1f} tokens/sec, acceptance {stats['acceptance']:.2f}, "
+          f"{stats['tokens_per_round']:.2f} tokens per forward of the prior")
+
+    def get_freqs(x):
+        return t.stack([t.bincount(x[:, i], minlength=check_bins).float() / len(x) for i in range(check_tokens)])
+    priors = []
+    for seed in [1, 2]:
+        t.manual_seed(seed)
+        priors.append(ConditionalAutoregressive2D((n_ctx,), check_bins, width=32, depth=2, heads=2, attn_order=attn_order,
+                                                  blocks=blocks).to(device).eval())
+        priors[-1].x_emb.weight.data.normal_(std=0.5) # Peaky enough for the draft to be off
+    prior, draft = priors
+    freqs = get_freqs(prior.sample(n_check, sample_tokens=check_tokens))
+    speculative_freqs = get_freqs(prior.speculative_sample(n_check, draft, n_draft=n_draft, sample_tokens=check_tokens)[0])
+    draft_freqs = get_freqs(draft.sample(n_check, sample_tokens=check_tokens))
+    tv = lambda a, b: [round(x, 3) for x in (0.5 * (a - b).abs().sum(dim=-1)).tolist()]
+    print(f"Total variation per position vs sample: speculative {tv(freqs, speculative_freqs)}, "
+          f"draft alone {tv(freqs, draft_freqs)}")
+
+
 if __name__ == '__main__':
     from jukebox.utils.dist_utils import setup_dist_from_mpi
 
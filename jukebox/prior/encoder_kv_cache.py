@@ -0,0 +1,133 @@
+"""
+Cache of the lyric encoder's outputs across windows and samples.
+
+For separated encoder-decoder priors, SimplePrior.sample runs the whole prime_prior over the n_tokens
+lyric tokens of every window, and every attn_func 6 layer projects the result with c_enc_kv. The
+lyric window (see get_relevant_lyric_tokens) is the same for neighbouring windows near the start and
+end of a song, for every window of short lyrics, and for samples with the same lyrics. EncoderKVCache
+keeps both per sample row, keyed by the prior's level, the row's lyric tokens and dtype (and the
+layer index for c_enc_kv), and only computes the rows it doesn't have, once per distinct row. The
+least recently used rows are evicted to stay under max_bytes. Keys don't tell models apart, so a
+cache is for one set of priors (see make_sampling_model).
+"""
+from collections import OrderedDict
+import torch as t
+
+
+class EncoderKVCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # (name, key) -> tuple of rows, least recently used first
+        self.nbytes = 0
+        self.hits, self.misses = {}, {} # By name
+        self.evictions = 0
+
+    def get_rows(self, name, keys, compute):
+        # One row per key, as a tuple of tensors [len(keys), ...]. compute(indices) returns a tuple of tensors with
+        # a row for each of the indices into keys, and is only called for the distinct keys that aren't cached
+        rows, missing = [], {}
+        for i, key in enumerate(keys):
+            entry = self.entries.get((name, key))
+            if entry is not None:
+                self.entries.move_to_end((name, key))
+            elif key not in missing:
+                missing[key] = i
+            rows.append(entry)
+        self.hits[name] = self.hits.get(name, 0) + len(keys) - len(missing)
+        self.misses[name] = self.misses.get(name, 0) + len(missing)
+        if missing:
+            computed = compute(list(missing.values()))
+            new = {key: tuple(x[j:j + 1].clone() for x in computed) for j, key in enumerate(missing)}
+            rows = [new[key] if row is None else row for key, row in zip(keys, rows)]
+            for key, entry in new.items():
+                self.put((name, key), entry)
+        return tuple(t.cat(xs, dim=0) for xs in zip(*rows))
+
+    def put(self, key, entry):
+        nbytes = sum(x.numel() * x.element_size() for x in entry)
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= sum(x.numel() * x.element_size() for x in evicted)
+            self.evictions += 1
+
+    def hit_rate(self, name):
+        total = self.hits.get(name, 0) + self.misses.get(name, 0)
+        return self.hits.get(name, 0) / total if total else 0.0
+
+    def report(self):
+        rates = ", ".join(f"{name} {self.hit_rate(name):.0%} of {self.hits[name] + self.misses[name]} rows"
+                          for name in sorted(self.hits, key=str))
+        return f"Encoder kv cache hits: {rates}. {len(self.entries)} rows in {self.nbytes / 2**20:.0f} MB, {self.evictions} evicted"
+
+
+def get_row_keys(prime, dtype, level):
+    # Cache keys of the rows of prime, the lyric tokens [N, n_tokens] of the prior at level
+    return [(level, tuple(row), str(dtype)) for row in prime.tolist()]
+
+
+def test_encoder_kv_cache(n_samples=4, n_windows=24, n_tokens=64, n_lyrics=(64, 400), width=64, depth=8, decoder_depth=20,
+                          max_mb=2.0, attn_order=10):
+    """
+    A long form run of windows over songs with short and long lyrics, at two levels of a stand in lyric encoder and a
+    decoder Transformer with encoder attention (decoder_depth 20 has two attn_func 6 layers for attn_order 10) that
+    share a cache. Hit rates with max_mb of cache, and outputs and time vs no cache.
+    """
+    import time
+    import numpy as np
+    from jukebox.data.labels import get_relevant_lyric_tokens
+    from jukebox.transformer.transformer import Transformer
+
+    # Two levels of stand in priors with the same lyrics, sharing the cache
+    t.manual_seed(0)
+    models = [(Transformer(width, n_tokens, 2, depth, mask=True).eval(), t.nn.Embedding(80, width),
+               Transformer(width, 64, 2, decoder_depth, mask=True, attn_order=attn_order, blocks=8, encoder_dims=n_tokens).eval())
+              for _ in range(2)]
+    for _, _, decoder in models:
+        for l in decoder._attn_mods:
+            if l.attn.attn_func == 6:
+                t.nn.init.normal_(l.attn.c_proj.w, std=0.02) # Zero until trained, which would hide the encoder
+    songs = [list(np.random.RandomState(i).randint(1, 80, n)) for i, n in enumerate(n_lyrics)]
+    # Samples 2k and 2k + 1 have the same lyrics
+    total_length, duration = 1000, 1000 // 8
+    primes = [t.tensor([get_relevant_lyric_tokens(songs[i // 2 % len(songs)], n_tokens, total_length,
+                                                  window * (total_length - duration) // n_windows, duration)[0]
+                        for i in range(n_samples)]) for window in range(n_windows)]
+    x = t.randn(n_samples, 16, width)
+
+    def sample_windows(cache):
+        outputs = []
+        for level, (encoder, emb, decoder) in enumerate(models):
+            for prime in primes:
+                decoder.del_cache()
+                if cache is None:
+                    encoder_kv = encoder(emb(prime))
+                else:
+                    keys = get_row_keys(prime, t.float, level)
+                    encoder_kv, = cache.get_rows('encoder_kv', keys, lambda rows: (encoder(emb(prime[rows])),))
+                    decoder.set_encoder_kv_cache(cache, keys)
+                outputs.append(decoder(x, encoder_kv=encoder_kv, sample=True))
+            decoder.set_encoder_kv_cache(None)
+            decoder.del_cache()
+        return outputs
+
+    with t.no_grad():
+        start_time = time.time()
+        expected = sample_windows(None)
+        uncached_time = time.time() - start_time
+        cache = EncoderKVCache(int(max_mb * 2**20))
+        start_time = time.time()
+        outputs = sample_windows(cache)
+        cached_time = time.time() - start_time
+    max_diff = max(t.max(t.abs(y - y_expected)).item() for y, y_expected in zip(outputs, expected))
+    print(cache.report())
+    assert max_diff < 1e-5, f"Cached outputs differ by {max_diff}"
+    print(f"{n_windows} windows of {n_samples} samples at {len(models)} levels: {uncached_time:.2f}s without cache, "
+          f"{cached_time:.2f}s with, max diff {max_diff:.1e}")
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_encoder_kv_cache)
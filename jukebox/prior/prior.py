@@ -5,6 +5,7 @@ import jukebox.utils.dist_adapter as dist
 
 from jukebox.transformer.ops import LayerNorm
 from jukebox.prior.autoregressive import ConditionalAutoregressive2D
+from jukebox.prior.encoder_kv_cache import get_row_keys
 from jukebox.prior.conditioners import Conditioner, LabelConditioner
 from jukebox.data.labels import EmptyLabeller, Labeller
 
@@ -53,6 +54,13 @@ class SimplePrior(nn.Module):
         self.encoder = encoder
         self.decoder = decoder
 
+        # ModelResidency that moves the weights while sampling, if any (see make_model)
+        self.residency = None
+        # EncoderKVCache of the lyric encoder's outputs while sampling, if any (see make_sampling_model)
+        self.encoder_kv_cache = None
+        # UpperConditioning of the level above while sampling, if any (see sample_prior_level)
+        self.x_cond_cache = None
+
         # X conditioning
         self.x_cond = (level != (self.levels - 1))
         self.cond_level = level + 1
@@ -231,7 +239,8 @@ class SimplePrior(nn.Module):
             x_out = self.decoder(zs, start_level=start_level, end_level=end_level, bs_chunks=bs_chunks)
         return x_out
 
-    def get_cond(self, z_conds, y):
+    def get_cond(self, z_conds, y, x_cond=None):
+        # x_cond: conditioning from the level above computed already, eg by UpperConditioning, instead of from z_conds
         if y is not None:
             assert y.shape[1] == 4 + self.y_emb.max_bow_genre_size + self.n_tokens, f"Expected {4} + {self.y_emb.max_bow_genre_size} + {self.n_tokens}, got {y.shape[1]}"
             n_labels = y.shape[1] - self.n_tokens
@@ -239,11 +248,15 @@ class SimplePrior(nn.Module):
         else:
             y, prime = None, None
         y_cond, y_pos = self.y_emb(y) if self.y_cond else (None, None)
-        x_cond = self.x_emb(z_conds) if self.x_cond else y_pos
+        if not self.x_cond:
+            x_cond = y_pos
+        elif x_cond is None:
+            x_cond = self.x_emb(z_conds)
         return x_cond, y_cond, prime
 
     def sample(self, n_samples, midi =None, z=None, z_conds=None, y=None, fp16=False, temp=1.0, top_k=0, top_p=0.0,
-               chunk_size=None, sample_tokens=None):
+               chunk_size=None, sample_tokens=None, generators=None, draft=None, n_draft=4, x_cond=None):
+        # With a draft SimplePrior (eg get_layer_draft(prior, n_layers)), samples speculatively, see speculative_sample
         N = n_samples
         if z is not None: assert z.shape[0] == N, f"Expected shape ({N},**), got shape {z.shape}"
         if y is not None: assert y.shape[0] == N, f"Expected shape ({N},**), got shape {y.shape}"
@@ -256,35 +269,75 @@ class SimplePrior(nn.Module):
             name = {True: 'Ancestral', False: 'Primed'}[no_past_context]
             print(f"{name} sampling {n_samples} samples with temp={temp}, top_k={top_k}, top_p={top_p}")
 
+        if draft is not None:
+            assert generators is None, "Speculative sampling draws from the global rng, unset sample_seed"
+
         with t.no_grad():
             # Currently x_cond only uses immediately above layer
-            x_cond, y_cond, prime = self.get_cond(z_conds, y)
+            upper_x_cond = x_cond # Precomputed with self's conditioner, if given
+            x_cond, y_cond, prime = self.get_cond(z_conds, y, upper_x_cond)
+            if draft is not None:
+                # The draft conditions on the same inputs through its own embeddings. A layer draft shares
+                # self's conditioner, so it can reuse the precomputed x_cond, but not the embedded one
+                shared = getattr(draft, 'conditioner_blocks', None) is getattr(self, 'conditioner_blocks', None)
+                draft_x_cond, draft_y_cond, draft_prime = draft.get_cond(z_conds, y, upper_x_cond if shared else None)
             if self.single_enc_dec:
                 # assert chunk_size % self.prime_loss_dims == 0. TODO: Check if needed
+                if draft is not None:
+                    _, draft_x_cond = draft.prior_preprocess([prime] if no_past_context else [prime, z],
+                                                             [None, draft_x_cond])
                 if no_past_context:
                     z, x_cond = self.prior_preprocess([prime], [None, x_cond])
                 else:
                     z, x_cond = self.prior_preprocess([prime, z], [None, x_cond])
                 if sample_tokens is not None:
                     sample_tokens += self.n_tokens
-                z = self.prior.primed_sample(n_samples, z, x_cond, y_cond,midi=midi, fp16=fp16, temp=temp,
-                                             top_k=top_k, top_p=top_p, chunk_size=chunk_size, sample_tokens=sample_tokens)
+                if draft is not None:
+                    z, stats = self.prior.speculative_sample(n_samples, draft.prior, z, midi=midi, x_cond=x_cond,
+                                                             y_cond=y_cond, draft_conds=(draft_x_cond, draft_y_cond, None),
+                                                             fp16=fp16, temp=temp, top_k=top_k, top_p=top_p,
+                                                             chunk_size=chunk_size, sample_tokens=sample_tokens, n_draft=n_draft)
+                else:
+                    z = self.prior.primed_sample(n_samples, z, x_cond, y_cond,midi=midi, fp16=fp16, temp=temp,
+                                                 top_k=top_k, top_p=top_p, chunk_size=chunk_size, sample_tokens=sample_tokens,
+                                                 generators=generators)
                 z = self.prior_postprocess(z)
             else:
                 encoder_kv = self.get_encoder_kv(prime, fp16=fp16, sample=True)
-                if no_past_context:
+                if draft is not None:
+                    draft_encoder_kv = draft.get_encoder_kv(draft_prime, fp16=fp16, sample=True)
+                    z, stats = self.prior.speculative_sample(n_samples, draft.prior, None if no_past_context else z,
+                                                             midi=midi, x_cond=x_cond, y_cond=y_cond, encoder_kv=encoder_kv,
+                                                             draft_conds=(draft_x_cond, draft_y_cond, draft_encoder_kv),
+                                                             fp16=fp16, temp=temp, top_k=top_k, top_p=top_p,
+                                                             chunk_size=chunk_size, sample_tokens=sample_tokens, n_draft=n_draft)
+                elif no_past_context:
                     z = self.prior.sample(n_samples, x_cond, y_cond, encoder_kv, fp16=fp16, temp=temp, top_k=top_k,
-                                          top_p=top_p, sample_tokens=sample_tokens)
+                                          top_p=top_p, sample_tokens=sample_tokens, generators=generators)
                 else:
                     z = self.prior.primed_sample(n_samples, z, x_cond, y_cond, encoder_kv, midi=midi,  fp16=fp16, temp=temp,
-                                             top_k=top_k, top_p=top_p, chunk_size=chunk_size, sample_tokens=sample_tokens)
+                                             top_k=top_k, top_p=top_p, chunk_size=chunk_size, sample_tokens=sample_tokens,
+                                             generators=generators)
+            self.prior.transformer.set_encoder_kv_cache(None) # The keys are for this call's rows
+            if draft is not None and dist.get_rank() == 0:
+                print(f"Speculative: acceptance {stats['acceptance']:.2f}, {stats['tokens_per_round']:.2f} tokens per forward")
             if sample_tokens is None:
                 assert_shape(z, (N, *self.z_shape))
         return z
 
     def get_encoder_kv(self, prime, fp16=False, sample=False):
+        if self.n_tokens != 0 and self.use_tokens and sample and self.encoder_kv_cache is not None:
+            # Only encode the rows whose lyric tokens aren't cached, and cache their c_enc_kv projections too
+            keys = get_row_keys(prime, t.float16 if fp16 else t.float, self.level)
+            encoder_kv, = self.encoder_kv_cache.get_rows('encoder_kv', keys,
+                                                         lambda rows: (self._get_encoder_kv(prime[rows], fp16, sample),))
+            self.prior.transformer.set_encoder_kv_cache(self.encoder_kv_cache, keys)
+            return encoder_kv
+        return self._get_encoder_kv(prime, fp16, sample)
+
+    def _get_encoder_kv(self, prime, fp16=False, sample=False):
         if self.n_tokens != 0 and self.use_tokens:
-            if sample:
+            if sample and self.residency is None: # Otherwise its blocks are streamed in, or resident
                 self.prime_prior.cuda()
             N = prime.shape[0]
             prime_acts = self.prime_prior(prime, None, None, None, fp16=fp16)
@@ -293,7 +346,8 @@ class SimplePrior(nn.Module):
             encoder_kv = self.prime_state_ln(self.prime_state_proj(prime_acts))
             assert encoder_kv.dtype == t.float, f'Expected t.float, got {encoder_kv.dtype}'
             if sample:
-                self.prime_prior.cpu()
+                if self.residency is None:
+                    self.prime_prior.cpu()
                 if fp16:
                     encoder_kv = encoder_kv.half()
         else:
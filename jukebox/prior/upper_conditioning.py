@@ -0,0 +1,136 @@
+"""
+Conditioning from the level above for upsamplers, computed incrementally instead of per window.
+
+SimplePrior.get_cond runs the Conditioner (embedding, DecoderConvBock and LayerNorm) over the
+n_ctx // cond_downsample upper level codes of every window, and consecutive windows overlap by
+n_ctx - hop_length tokens. The convolutions zero pad at the window edges, so an output only differs
+from the same output over the whole upper level sequence within the receptive field of an edge.
+UpperConditioning runs the conditioner over the sequence once, as the windows advance, keeps the
+outputs from the current window on, and only recomputes the receptive_field upper tokens at each
+window edge from the window's codes, which gives the windowed outputs. The first window has no left
+edge and the last no right edge to recompute.
+
+When the edges would cover most of the window (the dilated conditioners of the large upsamplers
+see further than a window), every window is computed as before.
+"""
+import math
+import time
+import torch as t
+import torch.nn as nn
+
+
+def get_receptive_field(conditioner):
+    # Upper level tokens on either side of a position that its outputs can depend on, including through the zero
+    # padding at the sequence edges. Conditioner.cond runs its convolutions in order
+    reach, scale = 0.0, 1 # scale: outputs per upper level token at the current layer
+    for m in conditioner.cond.modules():
+        if isinstance(m, nn.Conv1d):
+            k, d, p = m.kernel_size[0], m.dilation[0], m.padding[0]
+            reach += max(p, d * (k - 1) - p) / scale
+        elif isinstance(m, nn.ConvTranspose1d):
+            k, s, p = m.kernel_size[0], m.stride[0], m.padding[0]
+            reach += (max(p, k - 1 - p) / s + 1) / scale
+            scale *= s
+    return math.ceil(reach) + 1
+
+
+def run_conditioner(conditioner, z):
+    # Conditioner.forward without x_cond, for any number of upper level tokens
+    x = conditioner.x_emb(z.long())
+    x = conditioner.postprocess(conditioner.cond(conditioner.preprocess(x)))
+    return conditioner.ln(x)
+
+
+class UpperConditioning:
+    def __init__(self, conditioner, window_length, downsample, total_length):
+        # window_length, total_length: upper level tokens in a window and in the whole sequence
+        self.conditioner = conditioner
+        self.window_length, self.downsample, self.total_length = window_length, downsample, total_length
+        self.receptive_field = get_receptive_field(conditioner)
+        self.incremental = 4 * self.receptive_field < window_length # Else the edges cost more than the window
+        self.x_cond = None # Sequence outputs for upper level tokens [offset, n_final)
+        self.offset = self.n_final = 0
+        self.time, self.n_windows = 0.0, 0
+
+    def run(self, z):
+        return run_conditioner(self.conditioner, z)
+
+    def extend(self, z, end):
+        # Sequence outputs up to end. Outputs are final once the codes they see are sampled
+        L, R, ds = z.shape[1], self.receptive_field, self.downsample
+        final = L if L == self.total_length else L - R
+        assert final >= end, f"Upper level sampled to {L}, need {end + R} for [{end - self.window_length},{end}]"
+        if self.n_final >= end:
+            return
+        n_final = min(final, max(end, self.n_final + self.window_length)) # Amortise the context
+        start = max(0, self.n_final - R)
+        x = self.run(z[:, start:min(L, n_final + R)])[:, (self.n_final - start) * ds:(n_final - start) * ds]
+        self.x_cond = x if self.x_cond is None else t.cat([self.x_cond, x], dim=1)
+        self.n_final = n_final
+
+    def get(self, z, start, end):
+        # x_cond of the window [start, end) at this level from the upper level codes z [N, L]
+        start_time = time.time()
+        ds, R, W = self.downsample, self.receptive_field, self.window_length
+        s, e = start // ds, end // ds
+        assert e - s == W, f"Expected a window of {W} upper level tokens, got [{s},{e}]"
+        if self.x_cond is not None and (s < self.offset or s > self.n_final or self.x_cond.shape[0] != z.shape[0]):
+            self.x_cond = None # Not the next window, start over
+        if self.x_cond is None:
+            self.offset = self.n_final = s
+        if not self.incremental:
+            x = self.run(z[:, s:e])
+        else:
+            self.extend(z, e)
+            # Drop what windows from here on don't need
+            self.x_cond, self.offset = self.x_cond[:, (s - self.offset) * ds:], s
+            x = self.x_cond[:, :W * ds]
+            # The window pads with zeros where the sequence has codes
+            left = self.run(z[:, s:s + 2 * R])[:, :R * ds] if s > 0 else x[:, :R * ds]
+            right = self.run(z[:, e - 2 * R:e])[:, -R * ds:] if e < self.total_length else x[:, -R * ds:]
+            x = t.cat([left, x[:, R * ds:(W - R) * ds], right], dim=1)
+        if x.is_cuda:
+            t.cuda.synchronize()
+        self.time += time.time() - start_time
+        self.n_windows += 1
+        return x
+
+    def report(self):
+        mode = "incrementally" if self.incremental else \
+            f"per window (receptive field of {self.receptive_field} tokens, window of {self.window_length})"
+        return f"Upper level conditioning computed {mode}: {self.time / max(self.n_windows, 1) * 1000:.1f} ms per window " \
+               f"for {self.n_windows} windows"
+
+
+def test_upper_conditioning(n_samples=2, n_ctx=2048, downsample=4, hop_fraction=0.125, total_length=16384, width=128,
+                            cond_width=128, device='cpu'):
+    """
+    The upsampler windows of a level at hop_fraction for conditioners with and without dilations: max difference from the
+    windowed conditioner and ms per window for both.
+    """
+    from jukebox.prior.conditioners import Conditioner
+    from jukebox.utils.sample_utils import get_starts
+    W = n_ctx // downsample
+    configs = dict(small=dict(depth=3, dilation_growth_rate=1, dilation_cycle=None),
+                   dilated=dict(depth=16, dilation_growth_rate=3, dilation_cycle=8))
+    for name, kwargs in configs.items():
+        t.manual_seed(0)
+        conditioner = Conditioner(input_shape=(W,), bins=256, down_t=int(math.log2(downsample)), stride_t=2, out_width=width,
+                                  init_scale=1.0, zero_out=False, res_scale=True, width=cond_width, m_conv=1.0,
+                                  **kwargs).to(device).eval()
+        z = t.randint(0, 256, (n_samples, total_length // downsample), device=device)
+        starts = get_starts(total_length, n_ctx, int(hop_fraction * n_ctx))
+        cache = UpperConditioning(conditioner, W, downsample, total_length // downsample)
+        max_diff, windowed_time = 0.0, 0.0
+        with t.no_grad():
+            for start in starts:
+                start_time = time.time()
+                expected = conditioner(z[:, start // downsample:start // downsample + W])
+                windowed_time += time.time() - start_time
+                max_diff = max(max_diff, t.max(t.abs(cache.get(z, start, start + n_ctx) - expected)).item())
+        print(f"{name}: {cache.report()}, windowed {windowed_time / len(starts) * 1000:.1f} ms per window, max diff {max_diff:.1e}")
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_upper_conditioning)
@@ -1,4 +1,6 @@
 import os
+import time
+from functools import partial
 import torch as t
 import jukebox.utils.dist_adapter as dist
 
@@ -8,12 +10,43 @@ from jukebox.utils.torch_utils import empty_cache
 from jukebox.utils.audio_utils import save_wav, load_audio
 from jukebox.make_models import make_model
 from jukebox.align import get_alignment
+from jukebox.prior.autoregressive import get_layer_draft
+from jukebox.prior.encoder_kv_cache import EncoderKVCache
+from jukebox.prior.upper_conditioning import UpperConditioning
 from jukebox.save_html import save_html
-from jukebox.utils.sample_utils import split_batch, get_starts
+from jukebox.utils.sample_utils import split_batch, get_starts, get_waves, get_sample_generators, get_row_bytes
 from jukebox.utils.dist_utils import print_once
 from jukebox.utils.io import load_sample_midi
+from jukebox.utils.sample_journal import SampleJournal, load_journal
+from jukebox.vqvae.streaming import StreamingDecoder
 import fire
 
+SAMPLE_MIDI_PATH = r"C:\Users\Yousef\Desktop\UNiz\MidiDataset\Cleaned\acdc\Big Balls.mid"
+
+def get_sample_midi(hps):
+    # Midi chunk to condition on. Pass sample_midi_path=None to sample without one
+    midi_path = hps.get('sample_midi_path', SAMPLE_MIDI_PATH)
+    return load_sample_midi(midi_path) if midi_path is not None else None
+
+def get_draft_kwargs(prior, hps):
+    # Sample speculatively, with the first sample_draft_layers layers of the prior as the draft
+    if hps.get('sample_draft_layers') is None:
+        return {}
+    return dict(draft=get_layer_draft(prior, hps.sample_draft_layers), n_draft=hps.get('sample_n_draft', 4))
+
+def get_x_cond(prior, zs, start, end):
+    # Conditioning on the level above for the window [start, end), if the prior has an UpperConditioning
+    x_cond_cache = getattr(prior, 'x_cond_cache', None)
+    return None if x_cond_cache is None else x_cond_cache.get(zs[prior.level + 1], start, end)
+
+def get_upper_length(prior, end):
+    # Codes of the level above that the window ending at end conditions on
+    length = end // prior.cond_downsample
+    x_cond_cache = getattr(prior, 'x_cond_cache', None)
+    if x_cond_cache is not None and x_cond_cache.incremental:
+        length += x_cond_cache.receptive_field # Until the level above is done
+    return length
+
 # Sample a partial window of length<n_ctx with tokens_to_sample new tokens on level=level
 def sample_partial_window(zs, labels, sampling_kwargs, level, prior, tokens_to_sample, hps):
     z = zs[level]
@@ -52,6 +85,7 @@ def sample_single_window(zs, labels, sampling_kwargs, level, prior, start, hps):
     
     # get z_conds from level above
     z_conds = prior.get_z_conds(zs, start, end)
+    x_cond = get_x_cond(prior, zs, start, end)
 
     # set y offset, sample_length and lyrics tokens
     y = prior.get_y(labels, start)
@@ -64,12 +98,18 @@ def sample_single_window(zs, labels, sampling_kwargs, level, prior, start, hps):
 
     z_list = split_batch(z, n_samples, max_batch_size)
     z_conds_list = split_batch(z_conds, n_samples, max_batch_size)
+    x_cond_list = split_batch(x_cond, n_samples, max_batch_size)
     y_list = split_batch(y, n_samples, max_batch_size)
+    if hps.get('sample_seed') is not None:
+        generators = get_sample_generators(hps.sample_seed, level, start, n_samples, z.device)
+        generators_list = [generators[i:i + max_batch_size] for i in range(0, n_samples, max_batch_size)]
+    else:
+        generators_list = [None] * len(z_list)
     z_samples = []
-    for z_i, z_conds_i, y_i in zip(z_list, z_conds_list, y_list):
-        midi_path = r"C:\Users\Yousef\Desktop\UNiz\MidiDataset\Cleaned\acdc\Big Balls.mid"
-        midi = load_sample_midi(midi_path)
-        z_samples_i = prior.sample(n_samples=z_i.shape[0], z=z_i, z_conds=z_conds_i, y=y_i, **sampling_kwargs, midi=midi)
+    for z_i, z_conds_i, x_cond_i, y_i, generators_i in zip(z_list, z_conds_list, x_cond_list, y_list, generators_list):
+        midi = get_sample_midi(hps)
+        z_samples_i = prior.sample(n_samples=z_i.shape[0], z=z_i, z_conds=z_conds_i, y=y_i, **sampling_kwargs, midi=midi,
+                                   generators=generators_i, x_cond=x_cond_i, **get_draft_kwargs(prior, hps))
         z_samples.append(z_samples_i)
     z = t.cat(z_samples, dim=0)
 
@@ -80,47 +120,197 @@ def sample_single_window(zs, labels, sampling_kwargs, level, prior, start, hps):
     zs[level] = t.cat([zs[level], z_new], dim=1)
     return zs
 
-# Sample total_length tokens at level=level with hop_length=hop_length
-def sample_level(zs, labels, sampling_kwargs, level, prior, total_length, hop_length, hps):
+# Sample the windows of a level in fused batches of up to max_rows rows. Rows are (window, sample) pairs, and
+# windows are batched together when they're in the same wave (see get_waves) and condition on the same number
+# of tokens. With hps.sample_seed set, gives the same codes as sampling the windows one after another.
+def sample_level_batched(zs, labels, sampling_kwargs, level, prior, windows, max_rows, hps, journal=None, stream=None,
+                         upstream=None):
+    n_samples = hps.n_samples
+    kwargs = {k: v for k, v in sampling_kwargs.items() if k not in ['max_batch_size', 'sample_tokens']}
+    midi = get_sample_midi(hps)
+    serial_batches = 0
+    n_batches, n_rows = 0, 0
+    for wave in get_waves(windows, zs[level].shape[1]):
+        if upstream is not None:
+            upstream.wait(zs, get_upper_length(prior, max(start for start, _, _ in wave) + prior.n_ctx))
+        # Rows of the wave, grouped by what they condition on
+        groups = {}
+        for start, sample_tokens, conditioning_tokens in wave:
+            groups.setdefault((sample_tokens, conditioning_tokens), []).append(start)
+            serial_batches += (n_samples + sampling_kwargs['max_batch_size'] - 1) // sampling_kwargs['max_batch_size']
+            print_once(f"Sampling {sample_tokens} tokens for [{start},{start+sample_tokens}]. Conditioning on {conditioning_tokens} tokens")
+        new_zs = {}
+        for (sample_tokens, conditioning_tokens), starts in groups.items():
+            z = t.cat([zs[level][:,start:start + conditioning_tokens] for start in starts], dim=0)
+            z_conds = [prior.get_z_conds(zs, start, start + prior.n_ctx) for start in starts]
+            z_conds = None if z_conds[0] is None else [t.cat(z_cond, dim=0) for z_cond in zip(*z_conds)]
+            x_cond = [get_x_cond(prior, zs, start, start + prior.n_ctx) for start in starts]
+            x_cond = None if x_cond[0] is None else t.cat(x_cond, dim=0)
+            y = [prior.get_y(labels, start) for start in starts]
+            y = None if y[0] is None else t.cat(y, dim=0)
+            generators = None
+            if hps.get('sample_seed') is not None:
+                generators = sum([get_sample_generators(hps.sample_seed, level, start, n_samples, z.device) for start in starts], [])
+            n_group_rows = len(starts) * n_samples
+            empty_cache()
+            z_samples = []
+            for i in range(0, n_group_rows, max_rows):
+                rows = slice(i, i + max_rows)
+                z_samples.append(prior.sample(n_samples=z[rows].shape[0], z=z[rows],
+                                              z_conds=None if z_conds is None else [z_cond[rows] for z_cond in z_conds],
+                                              y=None if y is None else y[rows], midi=midi,
+                                              generators=None if generators is None else generators[rows],
+                                              x_cond=None if x_cond is None else x_cond[rows],
+                                              sample_tokens=sample_tokens, **kwargs, **get_draft_kwargs(prior, hps)))
+                n_batches += 1
+                n_rows += z_samples[-1].shape[0]
+            z_samples = t.cat(z_samples, dim=0)
+            for j, start in enumerate(starts):
+                new_zs[start] = z_samples[j * n_samples:(j + 1) * n_samples, conditioning_tokens:]
+
+        # Windows of a wave sample consecutive tokens, so append them in window order
+        for start, _, _ in wave:
+            zs[level] = t.cat([zs[level], new_zs[start]], dim=1)
+        if journal is not None:
+            journal.update(zs, level, wave[-1][0])
+        if stream is not None:
+            stream.update(zs[level])
+
+    if n_batches > 0:
+        print_once(f"Level {level}: {n_rows} rows in {n_batches} fused batches of up to {max_rows} "
+                   f"(serial {serial_batches} batches of up to {sampling_kwargs['max_batch_size']}), "
+                   f"utilization {n_rows / (n_batches * max_rows):.0%}")
+    return zs
+
+# Sample total_length tokens at level=level with hop_length=hop_length. Windows already in zs are skipped,
+# so a level can be resumed from a journal. With a StreamingDecoder, audio is decoded as windows finish.
+# With an upstream (see sample_pipeline.py), waits for the codes of the level above that each window needs
+def sample_level(zs, labels, sampling_kwargs, level, prior, total_length, hop_length, hps, journal=None, stream=None,
+                 upstream=None):
     print_once(f"Sampling level {level}")
+    if hps.get('sample_memory_budget'):
+        # Fuse windows and samples into batches that fit sample_memory_budget (in GB)
+        max_rows = max(int(hps.sample_memory_budget * 2**30 // get_row_bytes(prior, sampling_kwargs['fp16'])), 1)
+        if total_length >= prior.n_ctx:
+            windows = [(start, prior.n_ctx) for start in get_starts(total_length, prior.n_ctx, hop_length)]
+        else:
+            # As in sample_partial_window
+            current_tokens = zs[level].shape[1]
+            if current_tokens < prior.n_ctx - total_length:
+                windows = [(0, current_tokens + total_length)]
+            else:
+                windows = [(current_tokens - prior.n_ctx + total_length, prior.n_ctx)]
+        return sample_level_batched(zs, labels, sampling_kwargs, level, prior, windows, max_rows, hps, journal, stream,
+                                    upstream)
     if total_length >= prior.n_ctx:
         for start in get_starts(total_length, prior.n_ctx, hop_length):
+            if upstream is not None:
+                upstream.wait(zs, get_upper_length(prior, start + prior.n_ctx))
             zs = sample_single_window(zs, labels, sampling_kwargs, level, prior, start, hps)
+            if journal is not None:
+                journal.update(zs, level, start)
+            if stream is not None:
+                stream.update(zs[level])
     else:
+        if upstream is not None:
+            upstream.wait(zs)
         zs = sample_partial_window(zs, labels, sampling_kwargs, level, prior, total_length, hps)
+        if journal is not None:
+            journal.update(zs, level, None)
     return zs
 
-# Sample multiple levels
-def _sample(zs, labels, sampling_kwargs, priors, sample_levels, hps):
-    alignments = None
-    for level in reversed(sample_levels):
-        prior = priors[level]
+def get_logdir(hps, level=None):
+    if dist.get_world_size() > 1:
+        logdir = f"{hps.name}_rank_{dist.get_rank()}"
+    else:
+        logdir = f"{hps.name}"
+    if level is not None:
+        logdir = f"{logdir}/level_{level}"
+    if not os.path.exists(logdir):
+        os.makedirs(logdir)
+    return logdir
+
+def get_journal_path(hps):
+    return f"{get_logdir(hps)}/journal.pth.tar"
+
+# Sample hps.sample_length of level=level with the prior on the device, and move it back after
+def sample_prior_level(zs, labels, sampling_kwargs, level, prior, hps, journal=None, stream=None, upstream=None):
+    residency = prior.residency
+    if residency is not None:
+        bytes_moved = residency.bytes_moved
+        residency.load(prior)
+        if hps.get('sample_static'):
+            residency.wait(prior) # The static step reads the weights without calling the blocks
+    else:
         prior.cuda()
         empty_cache()
 
-        # Set correct total_length, hop_length, labels and sampling_kwargs for level
-        assert hps.sample_length % prior.raw_to_tokens == 0, f"Expected sample_length {hps.sample_length} to be multiple of {prior.raw_to_tokens}"
-        total_length = hps.sample_length//prior.raw_to_tokens
-        hop_length = int(hps.hop_fraction[level]*prior.n_ctx)
-        zs = sample_level(zs, labels[level], sampling_kwargs[level], level, prior, total_length, hop_length, hps)
-
+    # Set correct total_length, hop_length, labels and sampling_kwargs for level
+    assert hps.sample_length % prior.raw_to_tokens == 0, f"Expected sample_length {hps.sample_length} to be multiple of {prior.raw_to_tokens}"
+    total_length = hps.sample_length//prior.raw_to_tokens
+    hop_length = int(hps.hop_fraction[level]*prior.n_ctx)
+    if hps.get('sample_cond_cache') and prior.x_cond:
+        # Run the conditioner over the level above once as the windows advance, instead of over every window
+        prior.x_cond_cache = UpperConditioning(prior.conditioner_blocks[0], prior.n_ctx // prior.cond_downsample,
+                                               prior.cond_downsample, total_length // prior.cond_downsample)
+    zs = sample_level(zs, labels, sampling_kwargs, level, prior, total_length, hop_length, hps, journal, stream, upstream)
+
+    if residency is not None:
+        residency.release(prior)
+        n_windows = len(get_starts(total_length, prior.n_ctx, hop_length)) if total_length >= prior.n_ctx else 1
+        bytes_moved = residency.bytes_moved - bytes_moved
+        print_once(f"Level {level}: moved {bytes_moved / 2**20:.0f} MB of weights to the device, "
+                   f"{bytes_moved / n_windows / 2**20:.1f} MB per window")
+    else:
         prior.cpu()
-        empty_cache()
+    empty_cache()
+    if getattr(prior, 'encoder_kv_cache', None) is not None and prior.n_tokens > 0:
+        print_once(prior.encoder_kv_cache.report())
+    if getattr(prior, 'x_cond_cache', None) is not None:
+        print_once(f"Level {level}: {prior.x_cond_cache.report()}")
+        prior.x_cond_cache = None
+    return zs
+
+# Sample multiple levels. Progress is journaled after every window, see resume_sample
+def _sample(zs, labels, sampling_kwargs, priors, sample_levels, hps, journal=None):
+    if journal is None:
+        journal = SampleJournal(get_journal_path(hps), labels, sampling_kwargs, sample_levels)
+    alignments = journal.alignments
+    pipelined = hps.get('sample_pipeline', False)
+    levels = [level for level in sample_levels if level not in journal.levels_done]
+    if pipelined and levels:
+        # Sample the levels together, one process per level, see sample_pipeline.py. Not journaled per window
+        from jukebox.sample_pipeline import pipeline_sample, get_pipeline_prior
+        stream = None
+        if hps.get('stream_decode'):
+            stream = StreamingDecoder(priors[levels[0]].decoder.__self__, levels[0], f"{get_logdir(hps, levels[0])}/stream", hps.sr)
+        zs = pipeline_sample(zs, labels, sampling_kwargs, levels, hps, partial(get_pipeline_prior, hps.model, hps), stream)
+        if stream is not None:
+            stream.flush(zs[levels[0]])
+    for level in reversed(sample_levels):
+        if level in journal.levels_done:
+            continue
+        prior = priors[level]
+        logdir = get_logdir(hps, level)
+        stream = None
+        if hps.get('stream_decode') and not pipelined:
+            # Decode finished windows to {logdir}/stream while sampling. prior.decoder is vqvae.decode
+            stream = StreamingDecoder(prior.decoder.__self__, level, f"{logdir}/stream", hps.sr)
+        if not pipelined:
+            zs = sample_prior_level(zs, labels[level], sampling_kwargs[level], level, prior, hps, journal, stream)
+        if stream is not None:
+            stream.flush(zs[level])
 
         # Decode sample
         x = prior.decode(zs[level:], start_level=level, bs_chunks=zs[level].shape[0])
 
-        if dist.get_world_size() > 1:
-            logdir = f"{hps.name}_rank_{dist.get_rank()}/level_{level}"
-        else:
-            logdir = f"{hps.name}/level_{level}"
-        if not os.path.exists(logdir):
-            os.makedirs(logdir)
         t.save(dict(zs=zs, labels=labels, sampling_kwargs=sampling_kwargs, x=x), f"{logdir}/data.pth.tar")
         save_wav(logdir, x, hps.sr)
         if alignments is None and priors[-1] is not None and priors[-1].n_tokens > 0 and not isinstance(priors[-1].labeller, EmptyLabeller):
             alignments = get_alignment(x, zs, labels[-1], priors[-1], sampling_kwargs[-1]['fp16'], hps)
         save_html(logdir, x, zs, labels[-1], alignments, hps)
+        journal.update(zs, level, None, level_done=True, alignments=alignments)
+    journal.close()
     return zs
 
 # Generate ancestral samples given a list of artists and genres
@@ -149,6 +339,14 @@ def primed_sample(x, labels, sampling_kwargs, priors, hps):
     zs = _sample(zs, labels, sampling_kwargs, priors, sample_levels, hps)
     return zs
 
+# Resume a run that was interrupted, from the last window in its journal. Labels and sampling_kwargs are
+# the journaled ones, and the rng states are restored, so the codes are the same as if it had not stopped
+def resume_sample(priors, hps):
+    zs, journal = load_journal(get_journal_path(hps))
+    assert zs[-1].shape[0] == hps.n_samples, f"Expected bs = {hps.n_samples}, got {zs[-1].shape[0]}"
+    zs = _sample(zs, journal.labels, journal.sampling_kwargs, priors, journal.sample_levels, hps, journal)
+    return zs
+
 # Load `duration` seconds of the given audio files to use as prompts
 def load_prompts(audio_files, duration, hps):
     xs = []
@@ -177,11 +375,40 @@ def load_codes(codes_file, duration, priors, hps):
         zs = [z[:,:duration//prior.raw_to_tokens] for z, prior in zip(zs, priors)]
     return zs
 
+# Make the vqvae and priors of model for sampling
+def make_sampling_model(model, device, hps, levels=None):
+    vqvae, priors = make_model(model, device, hps, levels)
+    encoder_kv_cache = EncoderKVCache(int(hps.encoder_kv_cache_mb * 2**20)) if hps.get('encoder_kv_cache_mb') else None
+    for prior in priors:
+        prior.encoder_kv_cache = encoder_kv_cache # Lyric encoder outputs of these priors, keyed by level, across windows and runs
+        prior.prior.debug = hps.get('sample_debug', False) # Per token checks while sampling
+        prior.prior.static_sample = hps.get('sample_static', False) # Fixed shape, compiled single token step
+    return vqvae, priors
+
+def get_sampling_kwargs(model):
+    lower_level_chunk_size = 32
+    lower_level_max_batch_size = 16
+    if model == '1b_lyrics':
+        chunk_size = 32
+        max_batch_size = 16
+    else:
+        chunk_size = 16
+        max_batch_size = 3
+    return [dict(temp=0.99, fp16=True, chunk_size=lower_level_chunk_size, max_batch_size=lower_level_max_batch_size),
+            dict(temp=0.99, fp16=True, chunk_size=lower_level_chunk_size, max_batch_size=lower_level_max_batch_size),
+            dict(temp=0.99, fp16=True, chunk_size=chunk_size, max_batch_size=max_batch_size)]
+
 # Generate and save samples, alignment, and webpage for visualization.
 def save_samples(model, device, hps, sample_hps):
     print(hps)
     from jukebox.lyricdict import poems, gpt_2_lyrics
-    vqvae, priors = make_model(model, device, hps)
+    if hps.get('sample_pipeline'):
+        # The priors are made in the processes of sample_pipeline
+        from jukebox.sample_pipeline import make_pipeline_model
+        vqvae, priors = make_pipeline_model(model, device, hps)
+        hps.model = model
+    else:
+        vqvae, priors = make_sampling_model(model, device, hps)
 
     assert hps.sample_length//priors[-2].raw_to_tokens >= priors[-2].n_ctx, f"Upsampling needs atleast one ctx in get_z_conds. Please choose a longer sample length"
 
@@ -231,17 +458,7 @@ def save_samples(model, device, hps, sample_hps):
     for label in labels:
         assert label['y'].shape[0] == hps.n_samples
 
-    lower_level_chunk_size = 32
-    lower_level_max_batch_size = 16
-    if model == '1b_lyrics':
-        chunk_size = 32
-        max_batch_size = 16
-    else:
-        chunk_size = 16
-        max_batch_size = 3
-    sampling_kwargs = [dict(temp=0.99, fp16=True, chunk_size=lower_level_chunk_size, max_batch_size=lower_level_max_batch_size),
-                       dict(temp=0.99, fp16=True, chunk_size=lower_level_chunk_size, max_batch_size=lower_level_max_batch_size),
-                       dict(temp=0.99, fp16=True, chunk_size=chunk_size, max_batch_size=max_batch_size)]
+    sampling_kwargs = get_sampling_kwargs(model)
 
     if sample_hps.mode == 'ancestral':
         ancestral_sample(labels, sampling_kwargs, priors, hps)
@@ -265,6 +482,8 @@ def save_samples(model, device, hps, sample_hps):
         duration = (int(sample_hps.prompt_length_in_seconds * hps.sr) // top_raw_to_tokens) * top_raw_to_tokens
         x = load_prompts(audio_files, duration, hps)
         primed_sample(x, labels, sampling_kwargs, priors, hps)
+    elif sample_hps.mode == 'resume':
+        resume_sample(priors, hps)
     else:
         raise ValueError(f'Unknown sample mode {sample_hps.mode}.')
 
@@ -278,5 +497,123 @@ def run(model, mode='ancestral', codes_file=None, audio_file=None, prompt_length
     with t.no_grad():
         save_samples(model, device, hps, sample_hps)
 
+
+class StandInPrior:
+    """
+    Stands in for a SimplePrior in the sampling tests. Each new token only depends on its own sample's
+    context, z_conds and y, like the real prior. Raises after crash_after calls to sample. Sleeps for token_time
+    per sampled token, as a stand in for the time on the device.
+    """
+    def __init__(self, n_ctx, cond_downsample, bins, crash_after=None, level=0, levels=2, token_time=0.0):
+        self.n_ctx, self.level, self.levels, self.cond_downsample, self.bins = n_ctx, level, levels, cond_downsample, bins
+        # As if every level above downsamples by cond_downsample too
+        self.raw_to_tokens = cond_downsample ** (level + 1) if cond_downsample is not None else None
+        self.crash_after = crash_after
+        self.token_time = token_time
+        self.residency = None
+        self.x_cond = level != levels - 1
+        self.calls = []
+
+    def cuda(self):
+        return self # Nothing to move
+
+    def cpu(self):
+        return self
+
+    def get_z_conds(self, zs, start, end):
+        from jukebox.prior.prior import SimplePrior
+        return SimplePrior.get_z_conds(self, zs, start, end)
+
+    def get_y(self, labels, start):
+        y = labels['y'].clone()
+        y[:, 1] += start
+        return y
+
+    def sample(self, n_samples, z, z_conds, y, midi=None, generators=None, sample_tokens=None, **kwargs):
+        from jukebox.transformer.ops import sample_logits
+        if self.crash_after is not None and len(self.calls) == self.crash_after:
+            raise RuntimeError('Crashed')
+        self.calls.append(n_samples)
+        h = (0 if z_conds is None else z_conds[0].sum(dim=1) * 7) + y[:, 1]
+        time.sleep(self.token_time * ((sample_tokens or self.n_ctx) - z.shape[1]))
+        for sample_t in range(z.shape[1], sample_tokens or self.n_ctx):
+            logits = t.sin(0.1 * (h + z.sum(dim=1) * 31 + sample_t).float().view(-1, 1, 1) + t.arange(self.bins).float()) * 3
+            z = t.cat([z, sample_logits(logits, generators)], dim=1)
+        return z
+
+
+def test_sample_scheduler(n_samples=5, n_ctx=32, total_length=128, cond_downsample=4, bins=16, max_batch_size=2, max_rows=8):
+    """
+    Serial vs batched sampling of an upsampling level with a stand in prior, for overlapping, non overlapping and
+    partial windows. Codes should be identical, with fewer and fuller batches when windows don't overlap.
+    """
+    t.manual_seed(0)
+    labels = dict(y=t.randint(0, 1000, (n_samples, 4)))
+    z_upper = t.randint(0, bins, (n_samples, total_length // cond_downsample))
+    hps = Hyperparams(n_samples=n_samples, sample_seed=0, sample_midi_path=None)
+    for name, length, hop_length in [('overlapping', total_length, n_ctx // 2), ('non overlapping', total_length, n_ctx),
+                                     ('partial', n_ctx // 2, n_ctx)]:
+        zs = [t.zeros(n_samples, 0, dtype=t.long), z_upper]
+        sampling_kwargs = dict(temp=0.99, fp16=False, chunk_size=8, max_batch_size=max_batch_size)
+        prior = StandInPrior(n_ctx, cond_downsample, bins)
+        z_serial = sample_level([zs[0], zs[1]], labels, sampling_kwargs, 0, prior, length, hop_length, hps)[0]
+        serial_calls = prior.calls
+
+        prior = StandInPrior(n_ctx, cond_downsample, bins)
+        if length >= n_ctx:
+            windows = [(start, n_ctx) for start in get_starts(length, n_ctx, hop_length)]
+        else:
+            windows = [(0, length)]
+        z_batched = sample_level_batched([zs[0], zs[1]], labels, sampling_kwargs, 0, prior, windows, max_rows, hps)[0]
+        assert t.equal(z_serial, z_batched), f"Batched codes differ from serial for {name} windows"
+        print(f"{name} windows: serial {len(serial_calls)} batches of {serial_calls}, "
+              f"batched {len(prior.calls)} batches of {prior.calls}")
+
+
+def test_resume(n_samples=5, n_ctx=32, total_length=256, cond_downsample=4, bins=16, max_batch_size=2, crash_after=10):
+    """
+    Sample a level with the global rng, crash part way, resume from the journal and compare with an uninterrupted run.
+    """
+    import tempfile
+    t.manual_seed(0)
+    labels = dict(y=t.randint(0, 1000, (n_samples, 4)))
+    z_upper = t.randint(0, bins, (n_samples, total_length // cond_downsample))
+    sampling_kwargs = dict(temp=0.99, fp16=False, chunk_size=8, max_batch_size=max_batch_size)
+    with tempfile.TemporaryDirectory() as tmp:
+        hps = Hyperparams(n_samples=n_samples, sample_midi_path=None, name=f'{tmp}/sample')
+
+        t.manual_seed(1)
+        zs = [t.zeros(n_samples, 0, dtype=t.long), z_upper]
+        z_expected = sample_level(zs, labels, sampling_kwargs, 0, StandInPrior(n_ctx, cond_downsample, bins),
+                                  total_length, n_ctx // 2, hps)[0]
+
+        t.manual_seed(1)
+        zs = [t.zeros(n_samples, 0, dtype=t.long), z_upper]
+        journal = SampleJournal(get_journal_path(hps), [labels, labels], [sampling_kwargs, sampling_kwargs], [0])
+        try:
+            sample_level(zs, labels, sampling_kwargs, 0, StandInPrior(n_ctx, cond_downsample, bins, crash_after),
+                         total_length, n_ctx // 2, hps, journal)
+        except RuntimeError:
+            pass
+        journal.close()
+
+        t.manual_seed(2)
+        zs, journal = load_journal(get_journal_path(hps), device='cpu')
+        prior = StandInPrior(n_ctx, cond_downsample, bins)
+        z_resumed = sample_level(zs, journal.labels[0], journal.sampling_kwargs[0], 0, prior, total_length, n_ctx // 2,
+                                 hps, journal)[0]
+        assert t.equal(z_expected, z_resumed), 'Resumed codes differ'
+        print(f"Resumed after {crash_after} batches, with {len(prior.calls)} batches left: codes match")
+
+        # A journal with every level done resumes to its codes, pipelined or not
+        journal.update(zs, 0, None, level_done=True)
+        journal.close()
+        zs, journal = load_journal(get_journal_path(hps), device='cpu')
+        for pipelined in [False, True]:
+            hps.update(sample_pipeline=pipelined, stream_decode=pipelined)
+            zs_done = _sample(list(zs), journal.labels, journal.sampling_kwargs, [None, None], journal.sample_levels, hps, journal)
+            assert t.equal(zs_done[0], z_expected), 'Finished journal resumed to different codes'
+        print("Resumed a finished journal, pipelined and not: nothing left to sample")
+
 if __name__ == '__main__':
     fire.Fire(run)
@@ -0,0 +1,262 @@
+"""
+Sample the levels of a model as a pipeline, one process per level.
+
+_sample samples the top level completely, then level 1, then level 0. A window of an upsampler only
+conditions on the codes of the level above under it though, and sampled codes never change, so the
+window [start, start + n_ctx) can start as soon as the level above has (start + n_ctx) // cond_downsample
+codes (plus the receptive field of an UpperConditioning, see get_upper_length). pipeline_sample runs
+every level at once in its own process, on its own device:
+
+- A level sends the codes of each finished window down to the level below (SpanSender, the stream of
+  sample_level), as numpy arrays so they don't depend on the sending process staying alive.
+- The level below appends them to its copy of the codes above, and before each window waits until
+  it has what the window conditions on (SpanReceiver, the upstream of sample_level). The time it
+  waits is the level's idle time.
+- The main process receives the codes of the bottom level, so with a StreamingDecoder the first audio
+  is decoded while the top level is still sampling.
+
+With sample_seed set, each window draws from its own generators, so the codes are the same as
+sampling the levels one after another. Without it, each process has its own global rng.
+
+python jukebox/sample.py --model=5b_lyrics --name=sample_5b --levels=3 --sample_length_in_seconds=20 \
+--total_sample_length_in_seconds=180 --sr=44100 --n_samples=6 --hop_fraction=0.5,0.5,0.125 --sample_pipeline=True
+"""
+import time
+import traceback
+
+import numpy as np
+import torch as t
+import torch.multiprocessing as mp
+
+from jukebox.hparams import Hyperparams, setup_hparams
+from jukebox.data.labels import EmptyLabeller, Labeller
+from jukebox.prior.prior import SimplePrior
+from jukebox.utils.dist_utils import print_once
+from jukebox.vqvae.vqvae import calculate_strides
+
+
+class SpanSender:
+    # Stream for sample_level that sends the codes sampled since the last update down the pipeline
+    def __init__(self, queue, level, sent=0):
+        self.queue, self.level, self.sent = queue, level, sent
+        self.first_time = None
+
+    def update(self, z):
+        if z.shape[1] > self.sent:
+            self.queue.put((self.sent, z[:, self.sent:].cpu().numpy()))
+            self.sent = z.shape[1]
+            if self.first_time is None:
+                self.first_time = time.time()
+
+    def close(self):
+        self.queue.put(None)
+
+
+class SpanReceiver:
+    # Upstream for sample_level that appends the codes of the level above as they're sent
+    def __init__(self, queue, level):
+        self.queue, self.level = queue, level
+        self.done = False
+        self.idle_time = 0.0
+
+    def receive(self, zs):
+        start_time = time.time()
+        span = self.queue.get()
+        self.idle_time += time.time() - start_time
+        if span is None:
+            self.done = True
+            return
+        start, z = span
+        upper = zs[self.level + 1]
+        assert start == upper.shape[1], f"Level {self.level + 1} sent codes from {start}, have {upper.shape[1]}"
+        zs[self.level + 1] = t.cat([upper, t.from_numpy(z).to(upper.device)], dim=1)
+
+    def wait(self, zs, length=None):
+        # Until the level above has length codes, or all of them for None
+        while not self.done and (length is None or zs[self.level + 1].shape[1] < length):
+            self.receive(zs)
+        if length is not None:
+            assert zs[self.level + 1].shape[1] >= length or self.done, f"Level {self.level + 1} stopped before {length} codes"
+
+
+def to_device(obj, device):
+    if isinstance(obj, t.Tensor):
+        return obj.to(device)
+    elif isinstance(obj, dict):
+        return {k: to_device(v, device) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [to_device(v, device) for v in obj]
+    return obj
+
+
+def run_level(level, get_prior, zs, labels, sampling_kwargs, hps, upstream_queue, downstream_queue, results):
+    # Sample a level of the pipeline, in its own process
+    from jukebox.sample import sample_prior_level
+    sender = SpanSender(downstream_queue, level, zs[level].shape[1])
+    try:
+        prior = get_prior(level)
+        device = 'cuda' if t.cuda.is_available() else 'cpu' # The current device, see get_pipeline_prior
+        zs, labels = to_device(zs, device), to_device(labels, device)
+        receiver = SpanReceiver(upstream_queue, level) if upstream_queue is not None else None
+        ready_time = time.time()
+        with t.no_grad():
+            zs = sample_prior_level(zs, labels, sampling_kwargs, level, prior, hps, stream=sender, upstream=receiver)
+        sender.update(zs[level])
+        results.put((level, zs[level].cpu().numpy(), dict(ready=ready_time, done=time.time(), first=sender.first_time,
+                                                          idle=receiver.idle_time if receiver is not None else 0.0)))
+    except Exception:
+        results.put((level, None, traceback.format_exc()))
+    finally:
+        sender.close() # The level below stops waiting, and fails if it's missing codes
+
+
+def pipeline_sample(zs, labels, sampling_kwargs, sample_levels, hps, get_prior, stream=None, start_method='spawn'):
+    """
+    Sample sample_levels of zs, each in its own process. get_prior(level) makes the prior of a level in its process (see
+    get_pipeline_prior), and has to be picklable. stream is updated with the codes of the lowest level as they arrive,
+    eg a StreamingDecoder. Prints when each level was ready, how long it waited for the level above, and when it was done.
+    """
+    ctx = mp.get_context(start_method)
+    levels = sorted(sample_levels, reverse=True)
+    queues = {level: ctx.Queue() for level in levels} # Codes sent down by each level
+    results = ctx.Queue()
+    start_time = time.time()
+    processes = []
+    for level in levels:
+        upstream = queues.get(level + 1)
+        args = (level, get_prior, to_device(zs, 'cpu'), to_device(labels[level], 'cpu'), sampling_kwargs[level],
+                Hyperparams(hps), upstream, queues[level], results)
+        processes.append(ctx.Process(target=run_level, args=args, daemon=True))
+        processes[-1].start()
+
+    # Codes of the lowest level as they arrive
+    bottom = levels[-1]
+    receiver = SpanReceiver(queues[bottom], bottom - 1)
+    first_time = None
+    while not receiver.done:
+        receiver.receive(zs)
+        if first_time is None and zs[bottom].shape[1] > 0:
+            first_time = time.time()
+        if stream is not None and not receiver.done:
+            stream.update(zs[bottom])
+
+    stats, errors = {}, []
+    for _ in levels:
+        level, z, level_stats = results.get()
+        if z is None:
+            errors.append(f"Level {level} failed:\n{level_stats}")
+            continue
+        zs[level] = t.from_numpy(z).to(zs[level].device)
+        stats[level] = level_stats
+    for process in processes:
+        if errors:
+            process.terminate() # Its codes may never be read
+        process.join()
+    if errors:
+        raise RuntimeError("\n".join(errors))
+
+    for level in levels:
+        s = stats[level]
+        busy = s['done'] - s['ready'] - s['idle']
+        print_once(f"Level {level}: ready after {s['ready'] - start_time:.1f}s, {busy:.1f}s sampling, {s['idle']:.1f}s idle "
+                   f"waiting for codes from above, done after {s['done'] - start_time:.1f}s")
+    print_once(f"Pipeline: first level {bottom} codes after {(first_time or time.time()) - start_time:.1f}s, "
+               f"all levels after {time.time() - start_time:.1f}s")
+    return zs
+
+
+class PipelineLevel:
+    # What the main process of a pipeline uses of a level's prior (lengths, labeller, vqvae encode and decode),
+    # without its weights
+    encode, decode = SimplePrior.encode, SimplePrior.decode
+
+    def __init__(self, hps, vqvae):
+        self.level, self.levels = hps.level, len(vqvae.z_shapes)
+        self.encoder, self.decoder = vqvae.encode, vqvae.decode
+        downsamples = calculate_strides(vqvae.strides_t, vqvae.downs_t)
+        self.n_ctx, self.n_tokens = hps.n_ctx, hps.n_tokens
+        self.cond_downsample = downsamples[self.level + 1] if self.level != self.levels - 1 else None
+        self.raw_to_tokens = np.prod(downsamples[:self.level + 1])
+        self.residency = None
+        if hps.labels:
+            self.labeller = Labeller(hps.max_bow_genre_size, self.n_tokens, self.n_ctx * self.raw_to_tokens, v3=hps.labels_v3)
+        else:
+            self.labeller = EmptyLabeller()
+
+
+def make_pipeline_model(model, device, hps):
+    # The vqvae and PipelineLevels of model for the main process of a pipeline, since each level's prior is made in its
+    # own process (see get_pipeline_prior). A top level with lyrics is made here too, for the alignments
+    from jukebox.make_models import MODELS, make_model
+    _, *prior_names = MODELS[model]
+    levels_hps = [setup_hparams(name, dict()) for name in prior_names]
+    top = len(levels_hps) - 1
+    align = levels_hps[top].labels and levels_hps[top].n_tokens > 0
+    # On the host until it aligns, so it doesn't hold device memory next to the top level's process
+    vqvae, top_prior = make_model(model, device, Hyperparams({**hps, 'model_memory_budget': 0.0}), levels=[top] if align else [])
+    hps.sample_length = vqvae.sample_length
+    priors = [PipelineLevel(level_hps, vqvae) for level_hps in levels_hps]
+    if align:
+        priors[top] = top_prior[0]
+    return vqvae, priors
+
+
+def get_pipeline_prior(model, hps, level):
+    # Prior of a level on its own gpu, staying there. With fewer gpus than levels, levels share them within
+    # the caller's model_memory_budget
+    from jukebox.sample import make_sampling_model
+    n_devices = t.cuda.device_count()
+    assert n_devices > 0, "Pipelined sampling needs a gpu for the priors, sample without --sample_pipeline on the cpu"
+    device = f'cuda:{level % n_devices}'
+    t.cuda.set_device(device) # Priors and labels use the current device
+    if n_devices >= hps.levels:
+        hps = Hyperparams({**hps, 'model_memory_budget': float('inf')})
+    _, (prior,) = make_sampling_model(model, device, hps, levels=[level])
+    return prior
+
+
+def get_stand_in_prior(level, n_ctx, cond_downsample, bins, levels, token_time):
+    from jukebox.sample import StandInPrior
+    return StandInPrior(n_ctx, cond_downsample, bins, level=level, levels=levels, token_time=token_time)
+
+
+def test_sample_pipeline(n_samples=2, levels=3, n_ctx=32, cond_downsample=4, bins=16, top_length=64, token_time=0.01,
+                         start_method='fork'):
+    """
+    Levels of stand in priors that sleep token_time per token (a stand in for the device) sampled one after another, and
+    as a pipeline of cpu processes (forked, since spawning one reimports torch). Codes should be identical, with the first
+    level 0 codes sooner, and the last ones once the slowest level is done.
+    """
+    import queue
+    from functools import partial
+    from jukebox.sample import sample_level
+    from jukebox.utils.sample_utils import get_starts
+    hps = Hyperparams(n_samples=n_samples, sample_seed=0, sample_midi_path=None, hop_fraction=[0.5] * levels,
+                      sample_length=top_length * cond_downsample ** levels)
+    t.manual_seed(0)
+    labels = [dict(y=t.randint(0, 1000, (n_samples, 4))) for _ in range(levels)]
+    sampling_kwargs = [dict(temp=0.99, fp16=False, chunk_size=8, max_batch_size=n_samples) for _ in range(levels)]
+    get_prior = partial(get_stand_in_prior, n_ctx=n_ctx, cond_downsample=cond_downsample, bins=bins, levels=levels,
+                        token_time=token_time)
+
+    zs = [t.zeros(n_samples, 0, dtype=t.long) for _ in range(levels)]
+    sender = SpanSender(queue.Queue(), 0) # When the first level 0 window is done
+    start_time = time.time()
+    for level in reversed(range(levels)):
+        total_length = hps.sample_length // cond_downsample ** (level + 1)
+        zs = sample_level(zs, labels[level], dict(sampling_kwargs[level]), level, get_prior(level), total_length,
+                          n_ctx // 2, hps, stream=sender if level == 0 else None)
+    print(f"Serial: first level 0 codes after {sender.first_time - start_time:.1f}s, "
+          f"all levels after {time.time() - start_time:.1f}s")
+
+    pipeline_zs = pipeline_sample([t.zeros(n_samples, 0, dtype=t.long) for _ in range(levels)], labels, sampling_kwargs,
+                                  list(range(levels)), hps, get_prior, start_method=start_method)
+    for level in range(levels):
+        assert t.equal(zs[level], pipeline_zs[level]), f"Pipeline codes differ at level {level}"
+    n_windows = sum(len(get_starts(hps.sample_length // cond_downsample ** (level + 1), n_ctx, n_ctx // 2)) for level in range(levels))
+    print(f"Codes match for {levels} levels, {n_windows} windows")
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_sample_pipeline)
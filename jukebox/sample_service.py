@@ -0,0 +1,504 @@
+"""
+Long lived sampling service.
+
+sample.py's run makes the vqvae and priors for every invocation, and samples the metas hard coded
+in save_samples. SampleService keeps the models loaded and samples jobs submitted over http:
+
+    POST /jobs                                {"metas": [{"artist", "genre", "lyrics"}, ...], "mode", "seed",
+                                               "codes_file", "audio_file", "prompt_length_in_seconds",
+                                               "sample_length_in_seconds"} -> {"id"}
+    GET  /jobs/{id}                           status of the job
+    GET  /jobs/{id}/events                    json lines of progress, until the job is done or failed
+    GET  /jobs/{id}/level_{level}/item_{i}.wav
+    GET  /metrics                             queue depth, batch occupancy and job latencies
+
+mode is ancestral (default), continue or upsample (from codes_file), or primed (from audio_file), as
+in sample.py. A job samples its levels top down like _sample, and its codes, audio and wavs are saved
+to {name}/jobs/{id}/level_{level}. One worker thread runs a level at a time, for a batch of the oldest
+waiting job and the other waiting jobs at the same level with the same code lengths, up to
+max_batch_size samples in all. Every job gets a seed (a random one if it doesn't give one), and each
+sample draws from generators seeded by its job's seed and its index in the job (see
+get_sample_generators), so a job's codes don't depend on what it was batched with.
+
+python jukebox/sample_service.py --model=5b_lyrics --name=service --levels=3 --sample_length_in_seconds=20 \
+--total_sample_length_in_seconds=180 --sr=44100 --n_samples=1 --hop_fraction=0.5,0.5,0.125 --port=8000
+"""
+import json
+import os
+from collections import deque
+import random
+import socketserver
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import torch as t
+import fire
+
+from jukebox.hparams import Hyperparams
+from jukebox.sample import make_sampling_model, get_sampling_kwargs, sample_prior_level, load_codes, load_prompts
+from jukebox.utils.audio_utils import save_wav
+from jukebox.utils.dist_utils import print_once
+
+MODES = ['ancestral', 'continue', 'upsample', 'primed']
+
+
+class SampleJob:
+    def __init__(self, job_id, request, sample_length, seed):
+        self.id = job_id
+        self.request = request
+        self.metas = request['metas']
+        self.n_samples = len(self.metas)
+        self.mode = request.get('mode', 'ancestral')
+        self.sample_length = sample_length
+        self.seed = seed
+        self.zs, self.labels = None, None # Set by SampleService.prepare
+        self.levels = None # Levels left to sample, top down
+        self.status = 'queued'
+        self.events = []
+        self.cond = threading.Condition()
+        self.submit_time = time.time()
+        self.start_time = None # First batch
+        self.end_time = None
+
+    def publish(self, status, **event):
+        with self.cond:
+            self.status = status
+            self.events.append(dict(status=status, time=time.time() - self.submit_time, **event))
+            self.cond.notify_all()
+
+    def iter_events(self):
+        # All events so far, then new ones as they're published, until the job is done or failed
+        i = 0
+        while True:
+            with self.cond:
+                while i == len(self.events):
+                    self.cond.wait()
+                event = self.events[i]
+            i += 1
+            yield event
+            if event['status'] in ['done', 'failed']:
+                return
+
+
+class BatchProgress:
+    # Stands in for a StreamingDecoder in sample_level, to publish the tokens sampled after every window
+    def __init__(self, jobs, level, total_length):
+        self.jobs, self.level, self.total_length = jobs, level, total_length
+
+    def update(self, z):
+        for job in self.jobs:
+            job.publish('sampling', level=self.level, tokens=z.shape[1], total=self.total_length)
+
+
+class SampleService:
+    def __init__(self, priors, hps, sampling_kwargs, max_batch_size=8, batch_wait=0.0, device='cuda', max_finished_jobs=1000,
+                 finished_ttl=3600.0):
+        # batch_wait: seconds to wait for more jobs to batch with, after a job arrives to an idle queue. Finished jobs
+        # can be looked up for finished_ttl seconds, and only the last max_finished_jobs of them (their files stay)
+        self.priors = priors
+        self.hps = hps
+        self.sampling_kwargs = sampling_kwargs
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.device = device
+        self.logdir = f"{hps.name}/jobs"
+        self.jobs = {}
+        self.waiting = [] # Jobs waiting for their next level, oldest first
+        self.cond = threading.Condition()
+        self.closed = False
+        self.n_jobs = 0
+        self.n_batches, self.n_batch_samples = 0, 0
+        self.max_finished_jobs, self.finished_ttl = max_finished_jobs, finished_ttl
+        self.finished = deque() # Finished and failed jobs, oldest first
+        self.latencies, self.queue_waits = deque(maxlen=max_finished_jobs), deque(maxlen=max_finished_jobs) # Of the last finished jobs
+        self.worker = threading.Thread(target=self.run_worker, daemon=True)
+        self.worker.start()
+
+    def submit(self, request):
+        # Check the request and queue it. Models only run on the worker thread
+        metas = request.get('metas')
+        if not metas or not all(isinstance(meta, dict) for meta in metas):
+            raise ValueError("Expected a non empty list of metas")
+        mode = request.get('mode', 'ancestral')
+        if mode not in MODES:
+            raise ValueError(f"Unknown sample mode {mode}, expected one of {MODES}")
+        if mode in ['continue', 'upsample'] and request.get('codes_file') is None:
+            raise ValueError(f"Mode {mode} needs a codes_file")
+        if mode == 'primed' and (request.get('audio_file') is None or request.get('prompt_length_in_seconds') is None):
+            raise ValueError("Mode primed needs an audio_file and prompt_length_in_seconds")
+        top_raw_to_tokens = self.priors[-1].raw_to_tokens
+        sample_length = self.hps.sample_length
+        if request.get('sample_length_in_seconds') is not None:
+            sample_length = int(request['sample_length_in_seconds'] * self.hps.sr) // top_raw_to_tokens * top_raw_to_tokens
+        if sample_length // self.priors[-2].raw_to_tokens < self.priors[-2].n_ctx:
+            raise ValueError(f"Upsampling needs atleast one ctx in get_z_conds. Please choose a longer sample length")
+        seed = request.get('seed')
+        with self.cond:
+            if self.closed:
+                raise ValueError("The service is closed")
+            job = SampleJob(f'{self.n_jobs}', request, sample_length, random.getrandbits(31) if seed is None else int(seed))
+            self.n_jobs += 1
+            self.evict()
+            self.jobs[job.id] = job
+            job.publish('queued', seed=job.seed)
+            self.waiting.append(job)
+            self.cond.notify_all()
+        return job
+
+    def get_hps(self, n_samples, sample_length):
+        hps = Hyperparams(self.hps)
+        hps.n_samples, hps.sample_length = n_samples, sample_length
+        return hps
+
+    def prepare(self, job):
+        # Labels and starting codes of the job, as in save_samples
+        hps = self.get_hps(job.n_samples, job.sample_length)
+        total_length = hps.get('total_sample_length_in_seconds', 0) * hps.sr or job.sample_length
+        metas = [dict(dict(total_length=total_length, offset=0), **meta) for meta in job.metas]
+        job.labels = [prior.labeller.get_batch_labels(metas, self.device) for prior in self.priors]
+        top_raw_to_tokens = self.priors[-1].raw_to_tokens
+        duration = None
+        if job.request.get('prompt_length_in_seconds') is not None:
+            duration = (int(job.request['prompt_length_in_seconds'] * hps.sr) // top_raw_to_tokens) * top_raw_to_tokens
+        if job.mode == 'ancestral':
+            job.zs = [t.zeros(job.n_samples, 0, dtype=t.long, device=self.device) for _ in self.priors]
+        elif job.mode in ['continue', 'upsample']:
+            job.zs = load_codes(job.request['codes_file'], duration, self.priors, hps)
+        else:
+            x = load_prompts(job.request['audio_file'].split(','), duration, hps)
+            job.zs = self.priors[-1].encode(x, start_level=0, end_level=len(self.priors), bs_chunks=x.shape[0])
+        n_levels = len(self.priors) - 1 if job.mode == 'upsample' else len(self.priors)
+        job.levels = list(reversed(range(n_levels)))
+
+    def get_batch_key(self, job):
+        # Jobs with the same key can be sampled together
+        return job.levels[0], job.sample_length, tuple(z.shape[1] for z in job.zs)
+
+    def next_batch(self):
+        # Blocks until there's a job, and returns the jobs of the next batch, or None once closed
+        with self.cond:
+            while not self.waiting and not self.closed:
+                self.cond.wait()
+            if not self.waiting:
+                return None
+            only_new = all(job.levels is None for job in self.waiting)
+        if self.batch_wait > 0 and only_new:
+            time.sleep(self.batch_wait) # Give other new jobs a chance to join them
+        with self.cond:
+            new_jobs = [job for job in self.waiting if job.levels is None]
+        for job in new_jobs:
+            try:
+                self.prepare(job)
+            except Exception as e:
+                self.fail([job], e)
+        with self.cond:
+            self.waiting = [job for job in self.waiting if job.status != 'failed']
+            if not self.waiting:
+                return []
+            key = self.get_batch_key(self.waiting[0])
+            batch, n_samples = [], 0
+            for job in self.waiting:
+                if job.levels is not None and self.get_batch_key(job) == key and \
+                        (not batch or n_samples + job.n_samples <= self.max_batch_size):
+                    batch.append(job)
+                    n_samples += job.n_samples
+            self.waiting = [job for job in self.waiting if job not in batch]
+        return batch
+
+    def sample_batch(self, batch):
+        # Sample the next level of the jobs in batch together, then split the codes and audio back
+        level = batch[0].levels[0]
+        prior = self.priors[level]
+        n_samples = sum(job.n_samples for job in batch)
+        hps = self.get_hps(n_samples, batch[0].sample_length)
+        hps.sample_seed = [(job.seed, i) for job in batch for i in range(job.n_samples)]
+        zs = [t.cat([job.zs[l] for job in batch], dim=0) for l in range(len(self.priors))]
+        labels = dict(y=t.cat([job.labels[level]['y'] for job in batch], dim=0),
+                      info=sum([job.labels[level]['info'] for job in batch], []))
+        for job in batch:
+            if job.start_time is None:
+                job.start_time = time.time()
+            job.publish('sampling', level=level, tokens=job.zs[level].shape[1], total=job.sample_length // prior.raw_to_tokens,
+                        batch_size=n_samples)
+        progress = BatchProgress(batch, level, batch[0].sample_length // prior.raw_to_tokens)
+        zs = sample_prior_level(zs, labels, dict(self.sampling_kwargs[level]), level, prior, hps, stream=progress)
+        x = prior.decode(zs[level:], start_level=level, bs_chunks=n_samples)
+
+        start = 0
+        for job in batch:
+            samples = slice(start, start + job.n_samples)
+            start += job.n_samples
+            job.zs = [z[samples].clone() for z in zs] # Not views that keep the whole batch alive
+            logdir = f"{self.logdir}/{job.id}/level_{level}"
+            os.makedirs(logdir, exist_ok=True)
+            t.save(dict(zs=job.zs, labels=job.labels, sampling_kwargs=self.sampling_kwargs, x=x[samples]), f"{logdir}/data.pth.tar")
+            save_wav(logdir, x[samples], hps.sr)
+            job.levels = job.levels[1:]
+            job.publish('level_done', level=level, wavs=[f"/jobs/{job.id}/level_{level}/item_{i}.wav" for i in range(job.n_samples)])
+
+    def fail(self, jobs, e):
+        for job in jobs:
+            job.end_time = time.time()
+            with self.cond:
+                self.retire(job)
+            job.publish('failed', error=repr(e))
+
+    def retire(self, job):
+        # With self.cond held, once a job is done or failed. Its codes and labels move off the device
+        if job.zs is not None:
+            job.zs = [z.cpu() for z in job.zs]
+        if job.labels is not None:
+            job.labels = [dict(labels, y=labels['y'].cpu()) for labels in job.labels]
+        self.finished.append(job)
+        self.evict()
+
+    def evict(self):
+        # Forget the finished jobs past max_finished_jobs or finished_ttl, with self.cond held
+        while self.finished and (len(self.finished) > self.max_finished_jobs or
+                                 time.time() - self.finished[0].end_time > self.finished_ttl):
+            del self.jobs[self.finished.popleft().id]
+
+    def run_worker(self):
+        with t.no_grad():
+            while True:
+                batch = self.next_batch()
+                if batch is None:
+                    return
+                if not batch:
+                    continue
+                try:
+                    self.sample_batch(batch)
+                except Exception as e:
+                    print_once(f"Batch of jobs {[job.id for job in batch]} failed: {e!r}")
+                    self.fail(batch, e)
+                    continue
+                with self.cond:
+                    self.n_batches += 1
+                    self.n_batch_samples += sum(job.n_samples for job in batch)
+                    for job in batch:
+                        if job.levels:
+                            self.waiting.append(job)
+                        else:
+                            job.end_time = time.time()
+                            self.latencies.append(job.end_time - job.submit_time)
+                            self.queue_waits.append(job.start_time - job.submit_time)
+                            self.retire(job)
+                    self.waiting.sort(key=lambda job: job.submit_time) # The oldest job goes first
+                for job in batch:
+                    if not job.levels:
+                        job.publish('done', latency=job.end_time - job.submit_time)
+
+    def metrics(self):
+        with self.cond:
+            def summary(xs):
+                return dict(mean=float(np.mean(xs)), p50=float(np.percentile(xs, 50)), p90=float(np.percentile(xs, 90)),
+                            max=float(np.max(xs))) if xs else None
+            statuses = [job.status for job in self.jobs.values()]
+            return dict(queue_depth=len(self.waiting),
+                        queued_samples=sum(job.n_samples for job in self.waiting),
+                        jobs={status: statuses.count(status) for status in set(statuses)},
+                        batches=self.n_batches,
+                        batch_occupancy=self.n_batch_samples / (self.n_batches * self.max_batch_size) if self.n_batches else None,
+                        mean_batch_size=self.n_batch_samples / self.n_batches if self.n_batches else None,
+                        latency=summary(self.latencies), queue_wait=summary(self.queue_waits))
+
+    def close(self):
+        # Finish the jobs that were submitted and stop the worker
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.worker.join()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    service = None # Set by serve
+
+    def send_json(self, obj, code=200):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            return self.send_json(dict(error=f"Unknown path {self.path}"), 404)
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job = self.service.submit(request)
+        except (ValueError, TypeError) as e:
+            return self.send_json(dict(error=str(e)), 400)
+        self.send_json(dict(id=job.id, seed=job.seed))
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['metrics']:
+            return self.send_json(self.service.metrics())
+        if len(parts) < 2 or parts[0] != 'jobs' or parts[1] not in self.service.jobs:
+            return self.send_json(dict(error=f"Unknown path {self.path}"), 404)
+        job = self.service.jobs[parts[1]]
+        if len(parts) == 2:
+            return self.send_json(dict(id=job.id, status=job.status, seed=job.seed, levels_left=job.levels))
+        if parts[2:] == ['events']:
+            # No content length, the events end when the connection closes
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            for event in job.iter_events():
+                self.wfile.write((json.dumps(event) + '\n').encode())
+                self.wfile.flush()
+            return
+        if len(parts) == 4 and parts[2].startswith('level_') and parts[2][6:].isdigit() and \
+                parts[3].startswith('item_') and parts[3].endswith('.wav') and parts[3][5:-4].isdigit():
+            path = f"{self.service.logdir}/{job.id}/{parts[2]}/{parts[3]}"
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    body = f.read()
+                self.send_response(200)
+                self.send_header('Content-Type', 'audio/wav')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+        self.send_json(dict(error=f"Unknown path {self.path}"), 404)
+
+    def log_message(self, format, *args):
+        pass # Don't mix request logs with the sampling logs
+
+
+class ServiceServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(service, host='localhost', port=8000):
+    # Returns the server, with serve_forever running on a thread. port=0 picks a free port
+    handler = type('Handler', (ServiceHandler,), dict(service=service))
+    server = ServiceServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print_once(f"Sampling service on http://{host}:{server.server_address[1]}")
+    return server
+
+
+# Client
+def submit_job(url, request):
+    data = json.dumps(request).encode()
+    with urllib.request.urlopen(urllib.request.Request(f"{url}/jobs", data=data, headers={'Content-Type': 'application/json'})) as f:
+        return json.loads(f.read())
+
+def get_events(url, job_id):
+    # Yields the events of a job as they happen
+    with urllib.request.urlopen(f"{url}/jobs/{job_id}/events") as f:
+        for line in f:
+            yield json.loads(line)
+
+def get_wav(url, path):
+    with urllib.request.urlopen(f"{url}{path}") as f:
+        return f.read()
+
+def get_metrics(url):
+    with urllib.request.urlopen(f"{url}/metrics") as f:
+        return json.loads(f.read())
+
+
+def run(model, port=8000, host='localhost', max_batch_size=8, batch_wait=0.0, max_finished_jobs=1000, finished_ttl=3600.0,
+        dist_port=29500, **kwargs):
+    from jukebox.utils.dist_utils import setup_dist_from_mpi
+    rank, local_rank, device = setup_dist_from_mpi(port=dist_port)
+    hps = Hyperparams(**kwargs)
+    vqvae, priors = make_sampling_model(model, device, hps)
+    service = SampleService(priors, hps, get_sampling_kwargs(model), max_batch_size, batch_wait, device, max_finished_jobs,
+                            finished_ttl)
+    server = serve(service, host, port)
+    try:
+        service.worker.join()
+    except KeyboardInterrupt:
+        server.shutdown()
+        service.close()
+
+
+def test_sample_service(n_jobs=4, samples_per_job=(1, 2, 1, 3), max_batch_size=4, n_ctx=32, bins=16, top_length=64):
+    """
+    Jobs submitted together over http with a local client, coalesced into batches, vs each job on its own.
+    Codes should match, and the metrics show fewer, fuller batches. Finished jobs are then evicted.
+    """
+    import tempfile
+    from jukebox.sample import StandInPrior
+
+    class StandInLevel(StandInPrior):
+        # A level of stand in priors, with the labeller, decode and device moves that the service uses
+        def __init__(self, level, levels, raw_to_tokens, cond_downsample):
+            super().__init__(n_ctx, cond_downsample, bins)
+            self.level, self.levels, self.raw_to_tokens, self.residency = level, levels, raw_to_tokens, None
+            self.labeller = self
+
+        def get_batch_labels(self, metas, device):
+            y = t.tensor([[sum(map(ord, meta['artist'] + meta['genre'])), meta['offset'], meta['total_length'], 0] for meta in metas])
+            return dict(y=y.to(device), info=[dict(meta) for meta in metas])
+
+        def sample(self, n_samples, z, z_conds, y, **kwargs):
+            if z_conds is None: # Top level
+                z_conds = [t.zeros(n_samples, 1, dtype=t.long)]
+            return super().sample(n_samples, z, z_conds, y, **kwargs)
+
+        def decode(self, zs, start_level, bs_chunks):
+            return t.sin(zs[0].float().repeat_interleave(self.raw_to_tokens, dim=1)).unsqueeze(-1)
+
+        def cuda(self):
+            return self
+
+        def cpu(self):
+            return self
+
+    priors = [StandInLevel(0, 2, 4, 4), StandInLevel(1, 2, 16, None)]
+    requests = [dict(metas=[dict(artist=f'artist {i}', genre='genre', lyrics='')] * n, seed=i)
+                for i, n in enumerate(samples_per_job[:n_jobs])]
+    with tempfile.TemporaryDirectory() as tmp:
+        hps = Hyperparams(name=tmp, sr=16, sample_length=top_length * 16, hop_fraction=[0.5, 0.5], sample_midi_path=None)
+        results = {}
+        for name, batch_wait in [('alone', None), ('coalesced', 0.5)]:
+            service = SampleService(priors, hps, [dict(temp=0.99, fp16=False, chunk_size=8, max_batch_size=2)] * 2,
+                                    max_batch_size, batch_wait or 0.0, device='cpu')
+            server = serve(service, port=0)
+            url = f"http://localhost:{server.server_address[1]}"
+            start_time = time.time()
+            if batch_wait is None:
+                # One job at a time
+                ids = []
+                for request in requests:
+                    ids.append(submit_job(url, request)['id'])
+                    events = list(get_events(url, ids[-1]))
+                    assert events[-1]['status'] == 'done', events[-1]
+            else:
+                ids = [submit_job(url, request)['id'] for request in requests]
+                for job_id in ids:
+                    events = list(get_events(url, job_id))
+                    assert events[-1]['status'] == 'done', events[-1]
+                wav = get_wav(url, events[-2]['wavs'][0])
+                with open(f"{tmp}/jobs/{ids[-1]}/level_0/item_0.wav", 'rb') as f:
+                    assert wav == f.read()
+            elapsed = time.time() - start_time
+            metrics = get_metrics(url)
+            results[name] = [service.jobs[job_id].zs for job_id in ids]
+            assert all(z._base is None for zs in results[name] for z in zs), 'Finished jobs keep views of their batch'
+            with service.cond:
+                service.max_finished_jobs = 1
+                service.evict()
+                assert len(service.jobs) == 1 and list(service.jobs) == [job.id for job in service.finished]
+                service.finished_ttl = 0.0
+                service.evict()
+                assert not service.jobs and not service.finished
+            server.shutdown()
+            service.close()
+            print(f"{name}: {metrics['batches']} batches, occupancy {metrics['batch_occupancy']:.0%}, "
+                  f"latency mean {metrics['latency']['mean']:.2f}s max {metrics['latency']['max']:.2f}s, {elapsed:.2f}s in all")
+        for job_alone, job_coalesced in zip(results['alone'], results['coalesced']):
+            assert all(t.equal(z, z_c) for z, z_c in zip(job_alone, job_coalesced)), 'Coalesced codes differ'
+        print(f"Codes of {n_jobs} jobs match")
+
+
+if __name__ == '__main__':
+    fire.Fire(run)
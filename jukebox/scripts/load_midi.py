@@ -2,6 +2,8 @@ import pretty_midi
 import os
 import numpy as np
 
+from jukebox.utils.io import get_midi_notes, rasterize_notes
+
 
 dt = 0.25
 def sec_to_idx(t, dt=0.25):
@@ -12,27 +14,16 @@ def load_midi(path, dt=0.25):
 	midi_format = pretty_midi.PrettyMIDI(path)
 
 	duration = midi_format.get_end_time()
-	info = np.zeros((len(midi_format.instruments), int(duration/dt) + 1, 200))
-	for i, instrument in enumerate(midi_format.instruments):
-		for note in instrument.notes:
-			start = sec_to_idx(note.start)
-			end = sec_to_idx(note.end)
-			
-			if start == end:
-				info[i, start, note.pitch] = note.velocity
-			else:
-				info[i, start:end, note.pitch] = note.velocity
-			
-			print(note, note.start, note.end, start, end, note.pitch) 
-			
+	n_instruments = len(midi_format.instruments)
+	info = rasterize_notes(*get_midi_notes(midi_format), n_instruments, 0, int(duration/dt) + 1, dt, pitch_range=(0, 200))
 
 	print("Number of instruments:", len(midi_format.instruments))
 	print("Midi Length (sec):", duration)
 	print("time step (dt):", dt)
 	print("Midi Length (idx):", sec_to_idx(duration))
-	print("Matrix Shape (before averaging across instruements) :",info.shape)
+	print("Matrix Shape (before averaging across instruements) :", (n_instruments,) + info.shape)
 	 
-	info = np.average(info, axis=0)
+	info = info / max(n_instruments, 1)
 	print("Matrix Shape (after averaging across instruements) :", info.shape)
 
 	return info
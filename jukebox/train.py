@@ -16,7 +16,7 @@ print('Half')
 from jukebox.hparams import setup_hparams
 from jukebox.make_models import make_vqvae, make_prior, restore_opt, save_checkpoint
 from jukebox.utils.logger import init_logging
-from jukebox.utils.audio_utils import audio_preprocess, audio_postprocess
+from jukebox.utils.audio_utils import audio_postprocess
 from jukebox.utils.torch_utils import zero_grad, count_parameters
 from jukebox.utils.dist_utils import print_once, allreduce, allgather
 from jukebox.utils.ema import CPUEMA, FusedEMA, EMA
@@ -163,18 +163,14 @@ def evaluate(model, orig_model, logger, metrics, data_processor, hps):
 
     with t.no_grad():
         for i, x in logger.get_range(data_processor.test_loader):
+            # Already on device and preprocessed by the prefetcher
             if isinstance(x, (tuple, list)):
                 x, y, midi = x
                 #print('midi', midi)
             else:
                 y = None
 
-            x = x.to('cuda', non_blocking=True)
-            if y is not None:
-                y = y.to('cuda', non_blocking=True)
-                midi = midi.to('cuda', non_blocking=True)
-
-            x_in = x = audio_preprocess(x, hps)
+            x_in = x
             log_input_output = (i==0)
 
             if hps.prior:
@@ -188,6 +184,7 @@ def evaluate(model, orig_model, logger, metrics, data_processor, hps):
             for key, val in _metrics.items():
                 _metrics[key] = val.item()
             _metrics["loss"] = loss = loss.item() # Make sure to call to free graph
+            _metrics["data_wait"] = data_processor.test_loader.wait_time
 
             # Average and log
             for key, val in _metrics.items():
@@ -209,22 +206,18 @@ def train(model, orig_model, opt, shd, scalar, ema, logger, metrics, data_proces
     model.train()
     orig_model.train()
     if hps.prior:
-        _print_keys = dict(l="loss", bpd="bpd", gn="gn", g_l="gen_loss", p_l="prime_loss")
+        _print_keys = dict(l="loss", bpd="bpd", gn="gn", g_l="gen_loss", p_l="prime_loss", dw="data_wait")
     else:
-        _print_keys = dict(l="loss", sl="spectral_loss", rl="recons_loss", e="entropy", u="usage", uc="used_curr", gn="gn", pn="pn", dk="dk")
+        _print_keys = dict(l="loss", sl="spectral_loss", rl="recons_loss", e="entropy", u="usage", uc="used_curr", gn="gn", pn="pn", dk="dk", dw="data_wait")
 
     for i, x in logger.get_range(data_processor.train_loader):
+        # Already on device and preprocessed by the prefetcher
         if isinstance(x, (tuple, list)):
             x, y, midi = x
         else:
             y = None
 
-        x = x.to('cuda', non_blocking=True)
-        if y is not None:
-            y = y.to('cuda', non_blocking=True)
-            midi = midi.to('cuda', non_blocking=True)
-
-        x_in = x = audio_preprocess(x, hps)
+        x_in = x
         log_input_output = (logger.iters % hps.save_iters == 0)
 
         if hps.prior:
@@ -260,6 +253,7 @@ def train(model, orig_model, opt, shd, scalar, ema, logger, metrics, data_proces
         _metrics["loss"] = loss = loss.item() * hps.iters_before_update # Make sure to call to free graph
         _metrics["gn"] = grad_norm
         _metrics["lr"] = lr
+        _metrics["data_wait"] = data_processor.train_loader.wait_time # Seconds this step waited for input
         _metrics["lg_loss_scale"] = np.log2(scale)
 
         # Average and log
@@ -1,5 +1,6 @@
 # Factored attention
 import math
+from collections import OrderedDict
 import numpy as np
 import torch as t
 import torch.nn as nn
@@ -12,20 +13,31 @@ def repeat(x, n, dim):
         dim = len(x.shape) - 1
     return x.view(int(np.prod(x.shape[:dim+1])), 1, int(np.prod(x.shape[dim+1:]))).repeat(1,n,1).view(*x.shape[:dim], n * x.shape[dim], *x.shape[dim+1:])
 
+MASK_CACHE_SIZE = 16
+_mask_cache = OrderedDict()
+
 def get_mask(mask, q_l, kv_l, blocks, spread, device, sample, sample_t):
-    # returns a mask of shape 1 x 1 x q_l x kv_l or None if masking is not needed.
+    # returns a bool mask of shape 1 x 1 x q_l x kv_l, True at positions to mask out, or None if masking is not needed.
+    # Masks are cached (LRU), so callers must not modify them.
     if mask is None or q_l == 1:
         return None
     offset = sample_t - q_l if sample else max(kv_l - q_l, 0)
+    key = (mask, q_l, kv_l, offset if mask != 'summary' else 0, blocks, str(device))
+    if key in _mask_cache:
+        _mask_cache.move_to_end(key)
+        return _mask_cache[key]
     if mask == 'autoregressive':
         # Masked dense
-        mask = t.ones(q_l, kv_l, device=device).tril(offset)
+        allowed = t.ones(q_l, kv_l, device=device).tril(offset)
     elif mask == 'summary':
         # Masked summary
-        mask = t.nn.functional.pad(t.ones(q_l, q_l, device=device).tril().view(q_l, blocks, q_l // blocks)[:,:-1,-kv_l//blocks:],(0,0,1,0),value=1).contiguous().view(q_l, kv_l)
+        allowed = t.nn.functional.pad(t.ones(q_l, q_l, device=device).tril().view(q_l, blocks, q_l // blocks)[:,:-1,-kv_l//blocks:],(0,0,1,0),value=1).contiguous().view(q_l, kv_l)
     elif mask == 'prime':
-        mask = t.ones(q_l, kv_l, device=device).tril(offset)
-    return mask.view(1,1,q_l,kv_l)
+        allowed = t.ones(q_l, kv_l, device=device).tril(offset)
+    _mask_cache[key] = (allowed == 0).view(1,1,q_l,kv_l)
+    if len(_mask_cache) > MASK_CACHE_SIZE:
+        _mask_cache.popitem(last=False)
+    return _mask_cache[key]
 
 class FactoredAttention(nn.Module):
     def __init__(self, n_in, n_ctx, n_state, n_head,
@@ -34,7 +46,7 @@ class FactoredAttention(nn.Module):
                  zero_out=False, init_scale=1.0,
                  checkpoint_attn=0,
                  attn_func=0, blocks=None, spread=None,
-                 encoder_dims=None, prime_len=None):
+                 encoder_dims=None, prime_len=None, attn_chunk_size=0):
         super().__init__()
         self.n_in = n_in
         self.n_ctx = n_ctx # NOTE: n_ctx could be different within operations. This is complete n_ctx
@@ -71,10 +83,16 @@ class FactoredAttention(nn.Module):
             assert n_ctx % blocks == 0
             self.block_ctx = n_ctx // blocks
         self.checkpoint_attn = checkpoint_attn # 0: None, 1: Attn after heads split, 2: Attn
+        self.attn_chunk_size = attn_chunk_size # 0: Full score matrix, else blocks of queries and keys with online softmax
 
         self.sample_t = 0
         self.cache = {}
+        self.cache_buffers = {}
+        self.saved_cache = None # (sample_t, cache, appended keys and values) from save_cache, for rewind_cache
         self.encoder_dims = encoder_dims
+        self.encoder_kv_cache = None # EncoderKVCache for the c_enc_kv projections while sampling, see set_encoder_kv_cache
+        self.encoder_kv_keys = None # Cache keys of the rows of encoder_kv
+        self.encoder_kv_layer = None # Index of the layer in its Transformer, for the cache keys
         self.prime_len = prime_len
         self.record_attn = False
         self.w = None
@@ -90,11 +108,10 @@ class FactoredAttention(nn.Module):
         w = w.float()
         if self.mask:
             # Generate appropriate mask to mask out all positions before current
-            # Might take up lot of memory for dense, so can cache it
+            # Cached across calls, and applied in place to avoid full size temporaries
             mask = get_mask(self.attn_mask, q.size(-2), k.size(-1), self.blocks, self.spread, w.device, sample, self.sample_t)
             if mask is not None:
-                #print(mask)
-                w = w * mask + -1e9 * (1 - mask)
+                w = w.masked_fill_(mask, -1e9)
             w = F.softmax(w, dim=-1).type(wtype)
         else:
             w = F.softmax(w, dim=-1).type(wtype)
@@ -107,6 +124,62 @@ class FactoredAttention(nn.Module):
         a = t.matmul(w, v)
         return a
 
+    def _chunked_attn(self, q, k, v, sample):
+        # Same as _attn, but over blocks of attn_chunk_size queries, each attending to blocks of attn_chunk_size keys
+        # with a running max and sum (online softmax), so the q_l x kv_l score matrix is never materialized.
+        # When training, each query block is recomputed in the backward pass instead of keeping its scores.
+        q_l, kv_l = q.size(-2), k.size(-1)
+        scale = 1. / math.sqrt(math.sqrt(self.n_state // self.n_head))
+        if self.training:
+            q, k = q * scale, k * scale
+        offset, mask = None, None
+        if self.mask and q_l > 1:
+            if self.attn_mask == 'summary':
+                # kv_l is only blocks * spread here, so the cached mask is small
+                mask = get_mask(self.attn_mask, q_l, kv_l, self.blocks, self.spread, q.device, sample, self.sample_t)
+            elif self.attn_mask is not None:
+                offset = self.sample_t - q_l if sample else max(kv_l - q_l, 0)
+        a = []
+        for start in range(0, q_l, self.attn_chunk_size):
+            end = min(start + self.attn_chunk_size, q_l)
+            # Keys after end - 1 + offset are masked for every query in the block, so skip them
+            kv_end = kv_l if offset is None else min(kv_l, end + offset)
+            f = lambda q, k, v, start=start: self._online_softmax_attn(q, k, v, scale, start, offset, mask)
+            a.append(checkpoint(f, (q[..., start:end, :], k[..., :kv_end], v[..., :kv_end, :]), (),
+                                t.is_grad_enabled() and q.requires_grad))
+        return t.cat(a, dim=-2)
+
+    def _online_softmax_attn(self, q, k, v, scale, start, offset, mask):
+        q_l, kv_l = q.size(-2), k.size(-1)
+        a, w_max, w_sum = None, None, None
+        for kv_start in range(0, kv_l, self.attn_chunk_size):
+            kv_end = min(kv_start + self.attn_chunk_size, kv_l)
+            w = t.matmul(q, k[..., kv_start:kv_end])
+            if not self.training:
+                w.mul_(scale*scale)
+            wtype = w.dtype
+            w = w.float()
+            if offset is not None and kv_end - 1 > start + offset:
+                rows = t.arange(start, start + q_l, device=w.device).view(-1, 1)
+                cols = t.arange(kv_start, kv_end, device=w.device).view(1, -1)
+                w = w.masked_fill_(cols > rows + offset, -1e9)
+            elif mask is not None:
+                w = w.masked_fill_(mask[..., start:start + q_l, kv_start:kv_end], -1e9)
+            block_max = w.detach().max(dim=-1, keepdim=True)[0]
+            if w_max is None:
+                w_max = block_max
+                w = t.exp(w - w_max)
+                w_sum = w.sum(dim=-1, keepdim=True)
+                a = t.matmul(self.attn_dropout(w.type(wtype)), v[..., kv_start:kv_end, :]).float()
+            else:
+                new_max = t.max(w_max, block_max)
+                correction = t.exp(w_max - new_max)
+                w = t.exp(w - new_max)
+                w_sum = w_sum * correction + w.sum(dim=-1, keepdim=True)
+                a = a * correction + t.matmul(self.attn_dropout(w.type(wtype)), v[..., kv_start:kv_end, :]).float()
+                w_max = new_max
+        return (a / w_sum).type(wtype)
+
     def merge_heads(self, x):
         x = x.permute(0, 2, 1, 3).contiguous()
         new_x_shape = (*x.size()[:-2], x.size(-2) * x.size(-1))
@@ -124,11 +197,12 @@ class FactoredAttention(nn.Module):
         query = self.split_heads(query)
         key = self.split_heads(key, k=True)
         value = self.split_heads(value)
+        attn = self._chunked_attn if self.attn_chunk_size and query.size(-2) > self.attn_chunk_size and not self.record_attn else self._attn
         if self.checkpoint_attn == 1 and not sample:
-            a = checkpoint(lambda q,k,v,s=sample: self._attn(q,k,v,s), (query, key, value),
+            a = checkpoint(lambda q,k,v,s=sample: attn(q,k,v,s), (query, key, value),
                        (), True)
         else:
-            a = self._attn(query,key,value,sample)
+            a = attn(query,key,value,sample)
         a = self.merge_heads(a)
         return a
 
@@ -153,9 +227,7 @@ class FactoredAttention(nn.Module):
         blocks, block_ctx = self.blocks, self.block_ctx # block_ctx is l // blocks for complete l ie l = n_ctx. Sampling has less l
         bs, l, d = v.shape # For sample, q_l = 1, k_l = v_l = sample_t
         if sample:
-            block_l = (l - 1) % block_ctx
-            k = k[:,block_l::block_ctx,:]
-            v = v[:,block_l::block_ctx,:]
+            # k, v are already the keys and values of the current column, see _append_column_cache
             return self.dense_attn(q, k, v, sample).view(bs, 1, d)
         else:
             ql = q.shape[1]
@@ -233,21 +305,26 @@ class FactoredAttention(nn.Module):
         query, key, value = x.chunk(3, dim=2)
         if sample:
             self.sample_t += curr_ctx
-            key, value = self._append_cache(key, value)
-            l_cache = self._suff_cache_len()
-            if self._cache_len() > l_cache:
-                self._slice_cache(-l_cache)
+            if self.saved_cache is not None and self.attn_func in [1, 3]:
+                self.saved_cache[2].append((key, value))
+            if self.attn_func == 2:
+                key, value = self._append_column_cache(key, value)
+            else:
+                key, value = self._append_cache(key, value)
+                l_cache = self._suff_cache_len()
+                if self._cache_len() > l_cache:
+                    self._slice_cache(-l_cache)
             if curr_ctx > 1:
                 if self.attn_func != 0:
                     query = self._pad_to_block_ctx(query, query=True)
-                    key = self._pad_to_block_ctx(key)
-                    value = self._pad_to_block_ctx(value)
+                    key = self._pad_to_block_ctx(key).contiguous() # Cache is a strided view into its buffer
+                    value = self._pad_to_block_ctx(value).contiguous()
                     assert key.shape[1] % self.block_ctx == 0
                     assert query.shape[1] % self.block_ctx == 0
                 assert key.shape[1] == value.shape[1]
                 assert query.shape[1] <= key.shape[1]
                 sample = False
-            else:
+            elif self.attn_func != 2:
                 key = self.cache['key']
                 value = self.cache['value']
         return query, key, value, sample
@@ -275,7 +352,13 @@ class FactoredAttention(nn.Module):
         assert encoder_kv is not None
         query = x
         if sample:
-            if self.sample_t == 0:
+            if self.sample_t == 0 and self.encoder_kv_cache is not None:
+                # Rows with lyrics projected before come from the cache
+                assert len(self.encoder_kv_keys) == encoder_kv.shape[0], f'{len(self.encoder_kv_keys)} keys for {encoder_kv.shape[0]} rows'
+                keys = [(self.encoder_kv_layer, key, str(x.dtype)) for key in self.encoder_kv_keys]
+                self.cache['key'], self.cache['value'] = self.encoder_kv_cache.get_rows(
+                    'c_enc_kv', keys, lambda rows: self.c_enc_kv(encoder_kv[rows].type_as(x)).chunk(2, dim=2))
+            elif self.sample_t == 0:
                 self.cache['key'], self.cache['value'] = self.c_enc_kv(encoder_kv.type_as(x)).chunk(2, dim=2)
             key, value = self.cache['key'], self.cache['value']
             self.sample_t += curr_ctx
@@ -323,7 +406,11 @@ class FactoredAttention(nn.Module):
             return F.pad(x, (0, 0, offset, pad))
 
     def _cache_len(self):
-        return 0 if 'key' not in self.cache else self.cache['key'].shape[1]
+        if 'key' not in self.cache:
+            return 0
+        elif self.attn_func == 2:
+            return self.sample_t
+        return self.cache['key'].shape[1]
 
     def _suff_cache_len(self):
         """
@@ -352,39 +439,113 @@ class FactoredAttention(nn.Module):
         else:
             raise NotImplementedError()
 
+    def _max_cache_len(self):
+        # Largest _suff_cache_len over a window, ie the size of the preallocated cache buffers
+        if self.attn_func == 0:
+            return self.n_ctx
+        elif self.attn_func == 1:
+            return self.block_ctx
+        elif self.attn_func == 3:
+            return 2 * self.block_ctx
+        elif self.attn_func == 7:
+            return self._prime_len
+        else:
+            raise NotImplementedError()
+
+    def _write_cache(self, name, x):
+        # Make self.cache[name] a view of the first x.shape[1] positions of its buffer, holding x
+        buffer = self.cache_buffers[name]
+        if x.data_ptr() != buffer.data_ptr():
+            if x._base is buffer:
+                x = x.clone() # Overlaps the region we write to
+            buffer[:, :x.shape[1]].copy_(x)
+        self.cache[name] = buffer[:, :x.shape[1]]
+
     def _slice_cache(self, start, end=None):
-        self.cache['key'] = self.cache['key'][:, start:end]
-        self.cache['value'] = self.cache['value'][:, start:end]
+        self._write_cache('key', self.cache['key'][:, start:end])
+        self._write_cache('value', self.cache['value'][:, start:end])
 
     def _append_cache(self, key, value):
+        # The cache lives in buffers of _max_cache_len allocated on the first append, and new keys
+        # and values are written in place. Only when they don't fit (a new block for attn_func 1 and 3,
+        # or a chunk larger than the buffer), we return a concatenated copy, which the caller
+        # then slices back into the buffer
         if 'key' not in self.cache:
-            self.cache['key'] = key
-            self.cache['value'] = value
+            bs, _, d = key.shape
+            l = self._max_cache_len()
+            self.cache_buffers = dict(key=key.new_empty(bs, l, d), value=value.new_empty(bs, l, d))
+            self.cache['key'], self.cache['value'] = key[:, :0], value[:, :0]
+        l, curr_ctx = self._cache_len(), key.shape[1]
+        if l + curr_ctx <= self.cache_buffers['key'].shape[1]:
+            self.cache_buffers['key'][:, l:l + curr_ctx].copy_(key)
+            self.cache_buffers['value'][:, l:l + curr_ctx].copy_(value)
+            self.cache['key'] = self.cache_buffers['key'][:, :l + curr_ctx]
+            self.cache['value'] = self.cache_buffers['value'][:, :l + curr_ctx]
         else:
-            old_key, old_value = key, value
-            key = t.cat([self.cache['key'], key], dim=1)
-            value = t.cat([self.cache['value'], value], dim=1)
-            del self.cache['key']
-            del self.cache['value']
-            del old_key
-            del old_value
-            self.cache['key'] = key
-            self.cache['value'] = value
+            self.cache['key'] = t.cat([self.cache['key'], key], dim=1)
+            self.cache['value'] = t.cat([self.cache['value'], value], dim=1)
         return self.cache['key'], self.cache['value']
 
+    def _append_column_cache(self, key, value):
+        # Column attention only attends to earlier positions in the same column (position % block_ctx),
+        # so the cache is bucketed by column as [bs, block_ctx, blocks, d] and a sampled token gets its
+        # column as one contiguous slice. Chunks get the whole context in order instead
+        bs, curr_ctx, d = key.shape
+        if 'key' not in self.cache:
+            self.cache['key'] = key.new_empty(bs, self.block_ctx, self.n_ctx // self.block_ctx, d)
+            self.cache['value'] = value.new_empty(bs, self.block_ctx, self.n_ctx // self.block_ctx, d)
+        start = self.sample_t - curr_ctx
+        if curr_ctx == 1:
+            col, row = start % self.block_ctx, start // self.block_ctx
+            self.cache['key'][:, col, row] = key[:, 0]
+            self.cache['value'][:, col, row] = value[:, 0]
+            return self.cache['key'][:, col, :row + 1], self.cache['value'][:, col, :row + 1]
+        pos = t.arange(start, self.sample_t, device=key.device)
+        self.cache['key'][:, pos % self.block_ctx, pos // self.block_ctx] = key
+        self.cache['value'][:, pos % self.block_ctx, pos // self.block_ctx] = value
+        return self.cache['key'].transpose(1, 2).reshape(bs, -1, d)[:, :self.sample_t], \
+               self.cache['value'].transpose(1, 2).reshape(bs, -1, d)[:, :self.sample_t]
+
     def del_cache(self):
         self.sample_t = 0
-        if 'key' in self.cache:
-            del self.cache['key']
-        if 'value' in self.cache:
-            del self.cache['value']
         self.cache = {}
+        self.cache_buffers = {}
+        self.saved_cache = None
+
+    def save_cache(self):
+        # Remember the cache at the current sample_t, so rewind_cache can drop positions sampled after it.
+        # Row (1) and previous row (3) caches drop old blocks as they go, so keep a copy of them and log their appends
+        cache = {name: v.clone() for name, v in self.cache.items()} if self.attn_func in [1, 3] else None
+        self.saved_cache = (self.sample_t, cache, [])
+
+    def rewind_cache(self, sample_t):
+        # Drop the cache of positions >= sample_t, eg rejected draft tokens in speculative sampling
+        saved_t, cache, appended = self.saved_cache
+        assert saved_t <= sample_t <= self.sample_t, f"Can't rewind to {sample_t}, saved at {saved_t} and at {self.sample_t}"
+        self.saved_cache = None
+        if sample_t == 0:
+            self.del_cache()
+            return
+        end = sample_t - self.sample_t
+        self.sample_t = sample_t
+        if self.attn_func in [1, 3]:
+            # Positions up to the old sample_t, ending with the appended ones
+            for i, name in enumerate(['key', 'value']):
+                x = t.cat([cache[name], *[kv[i] for kv in appended]], dim=1) if cache else t.cat([kv[i] for kv in appended], dim=1)
+                x = x[:, :x.shape[1] + end] if end < 0 else x
+                self._write_cache(name, x[:, -self._suff_cache_len():])
+        elif self.attn_func in [0, 7]:
+            # Caches of position [0, sample_t) in their buffers
+            for name in ['key', 'value']:
+                self.cache[name] = self.cache[name][:, :self._suff_cache_len()]
+        # Column (2) caches are indexed by position, and the encoder (6) cache doesn't depend on it
 
     def check(self):
+        device = next(self.parameters()).device
         blocks = self.blocks or 1
         spread = self.spread or 1
         bs, l, d = (4, self.n_ctx, self.n_in)
-        x = t.randn(bs, l, d).cuda()
+        x = t.randn(bs, l, d).to(device)
         x.requires_grad = True
         x_out = self.forward(x) # bs, l, d
         loss = x_out.mean(dim = -1) # bs, l
@@ -409,6 +570,30 @@ class FactoredAttention(nn.Module):
         assert (len(pos_grad) == len(exp_pos_grad)) and (pos_grad == exp_pos_grad).all(), \
             f"Expected pos grad {exp_pos_grad} got {pos_grad} for attn_func {self.attn_func} pos {pos} l {l} blocks {blocks}"
 
+    def check_chunked_attn(self, chunk_size):
+        # Chunked online softmax vs the full score matrix, for the forward, gradients and primed sampling
+        device = next(self.parameters()).device
+        t.manual_seed(42)
+        bs, l, d = (4, self.n_ctx, self.n_in)
+        x = t.randn(bs, l, d).to(device)
+        encoder_kv = t.randn(bs, self.encoder_dims, d).to(device) if self.attn_func == 6 else None
+        outputs = []
+        for attn_chunk_size in [0, chunk_size]:
+            self.attn_chunk_size = attn_chunk_size
+            x_in = x.clone().requires_grad_()
+            self.zero_grad()
+            y = self.forward(x_in, encoder_kv=encoder_kv)
+            y.pow(2).mean().backward()
+            with t.no_grad():
+                self.del_cache()
+                # Summary attention can't sample
+                y_sample = self.forward(x, encoder_kv=encoder_kv, sample=True) if self.attn_func not in [4, 5] else y
+                self.del_cache()
+            outputs.append((y.detach(), x_in.grad, self.c_attn.w.grad.clone(), y_sample))
+        for name, full, chunked in zip(['forward', 'input grad', 'weight grad', 'primed sample'], *outputs):
+            max_err = t.max(t.abs(full - chunked))
+            assert max_err <= 1e-5, f"Max {name} err is {max_err} for attn_func {self.attn_func} chunk_size {chunk_size}"
+
     def check_cache(self, n_samples, sample_t, fp16):
         assert self.sample_t == sample_t, f"{self.sample_t} != {sample_t}"
         if sample_t == 0:
@@ -416,16 +601,22 @@ class FactoredAttention(nn.Module):
         else:
             dtype = {True: t.float16, False: t.float32}[fp16]
             l_cache = self._suff_cache_len()
-            assert self.cache['key'].shape == (n_samples, l_cache, self.n_state)
-            assert self.cache['value'].shape == (n_samples, l_cache, self.n_state)
+            assert self._cache_len() == l_cache, f"{self._cache_len()} != {l_cache}"
+            if self.attn_func == 2:
+                shape = (n_samples, self.block_ctx, self.n_ctx // self.block_ctx, self.n_state) # Bucketed by column
+            else:
+                shape = (n_samples, l_cache, self.n_state)
+            assert self.cache['key'].shape == shape, f"Expected {shape}, got {self.cache['key'].shape}"
+            assert self.cache['value'].shape == shape, f"Expected {shape}, got {self.cache['value'].shape}"
             assert self.cache['key'].dtype == dtype, f"Expected {dtype}, got {self.cache['key'].dtype}"
             assert self.cache['value'].dtype == dtype, f"Expected {dtype}, got {self.cache['value'].dtype}"
 
     def check_sample(self):
+        device = next(self.parameters()).device
         t.manual_seed(42)
         bs, l, d = (4, self.n_ctx, self.n_in)
         prime = 5
-        x = t.randn(bs, l, d).cuda()
+        x = t.randn(bs, l, d).to(device)
         xs = t.chunk(x, l, dim=1)
         assert self.sample_t == 0
         assert self.cache == {}
@@ -434,7 +625,7 @@ class FactoredAttention(nn.Module):
             enc_l = self.encoder_dims
             encoder_kv = None
             if self.attn_func == 6:
-                encoder_kv = t.randn(bs, enc_l, d).cuda()
+                encoder_kv = t.randn(bs, enc_l, d).to(device)
 
             # Normal path
             x_out_normal = self.forward(x, encoder_kv=encoder_kv)
@@ -455,6 +646,7 @@ class FactoredAttention(nn.Module):
         assert max_err < 1e-8, f"Max prime sampling err is {max_err} {[i for i in range(prime) if t.max(t.abs(x_out_sample - x_out_normal)[:,i,:]) > 1e-8]}"
 
     def check_chunks(self, chunk_size):
+        device = next(self.parameters()).device
         t.manual_seed(42)
         bs, l, d = (4, self.n_ctx, self.n_in)
         enc_l = self.encoder_dims
@@ -462,9 +654,9 @@ class FactoredAttention(nn.Module):
         n_chunks = l // chunk_size
         with t.no_grad():
             encoder_kv = None
-            x = t.randn(bs, l, d).cuda()
+            x = t.randn(bs, l, d).to(device)
             if self.attn_func == 6:
-                encoder_kv = t.randn(bs, enc_l, d).cuda()
+                encoder_kv = t.randn(bs, enc_l, d).to(device)
 
             self.del_cache()
             y_forw = self.forward(x, encoder_kv=encoder_kv, sample=False)
@@ -488,6 +680,117 @@ class FactoredAttention(nn.Module):
             assert max_err <= 1e-6, f"Max err is {max_err} {[i for i in range(l) if t.max(t.abs(y_forw - y_forw_in_chunks)[:, i, :]) > 1e-6]}"
 
 
+def test_mask_cache(n_ctx=2048, n_in=64, n_head=2, bs=2, attn_funcs=(0, 1, 5), blocks=16, n_steps=5, device='cpu'):
+    """
+    Training step (forward + backward) of masked attention layers with the cached bool masks and in place
+    masked_fill_, vs rebuilding the float mask and applying it with w * mask + -1e9 * (1 - mask) every call.
+    Reports time, and peak memory on cuda or total bytes allocated on cpu.
+    """
+    import time
+    import types
+    device = t.device(device)
+
+    def rebuilt_attn(self, q, k, v, sample):
+        scale = 1. / math.sqrt(math.sqrt(self.n_state // self.n_head))
+        w = t.matmul(q * scale, k * scale).float()
+        q_l, kv_l = q.size(-2), k.size(-1)
+        offset = max(kv_l - q_l, 0)
+        if self.attn_mask == 'summary':
+            mask = t.nn.functional.pad(t.ones(q_l, q_l, device=w.device).tril().view(q_l, self.blocks, q_l // self.blocks)[:,:-1,-kv_l//self.blocks:],(0,0,1,0),value=1).contiguous().view(q_l, kv_l)
+        else:
+            mask = t.ones(q_l, kv_l, device=w.device).tril(offset)
+        mask = mask.view(1,1,q_l,kv_l)
+        w = w * mask + -1e9 * (1 - mask)
+        return t.matmul(F.softmax(w, dim=-1).type(v.dtype), v)
+
+    def step(attn, x):
+        attn.zero_grad()
+        attn(x).pow(2).mean().backward()
+        return attn.c_attn.w.grad.clone()
+
+    def measure(attn, x):
+        if device.type == 'cuda':
+            t.cuda.synchronize()
+            t.cuda.reset_peak_memory_stats()
+            start_mem = t.cuda.memory_allocated()
+        start = time.time()
+        for _ in range(n_steps):
+            step(attn, x)
+        if device.type == 'cuda':
+            t.cuda.synchronize()
+        elapsed = (time.time() - start) / n_steps
+        if device.type == 'cuda':
+            mem = t.cuda.max_memory_allocated() - start_mem
+        else:
+            with t.profiler.profile(activities=[t.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+                step(attn, x)
+            mem = sum(max(e.self_cpu_memory_usage, 0) for e in prof.key_averages())
+        return elapsed, mem
+
+    for attn_func in attn_funcs:
+        t.manual_seed(0)
+        attn = FactoredAttention(n_in, n_ctx, n_in, n_head, mask=True, attn_func=attn_func, blocks=blocks, spread=1).to(device)
+        x = t.randn(bs, n_ctx, n_in, device=device)
+        _mask_cache.clear()
+        grad = step(attn, x)
+        cached_time, cached_mem = measure(attn, x)
+
+        attn._attn = types.MethodType(rebuilt_attn, attn)
+        rebuilt_grad = step(attn, x)
+        rebuilt_time, rebuilt_mem = measure(attn, x)
+        del attn._attn
+
+        max_err = t.max(t.abs(grad - rebuilt_grad))
+        assert max_err < 1e-6, f"Max grad err is {max_err} for attn_func {attn_func}"
+        memory = 'peak memory' if device.type == 'cuda' else 'allocated'
+        print(f"attn_func {attn_func}: rebuilt masks {rebuilt_time * 1000:.1f} ms/step, {rebuilt_mem / 2**20:.1f} MB {memory}; "
+              f"cached masks {cached_time * 1000:.1f} ms/step, {cached_mem / 2**20:.1f} MB {memory}")
+
+
+def _chunked_attn_step(n_ctx, n_in, n_head, bs, attn_func, blocks, attn_chunk_size, n_steps, device):
+    # One configuration of test_chunked_attn, in its own process so cpu peak memory (max rss) isn't shared
+    import resource
+    import time
+    t.manual_seed(0)
+    attn = FactoredAttention(n_in, n_ctx, n_in, n_head, mask=True, attn_func=attn_func, blocks=blocks,
+                             attn_chunk_size=attn_chunk_size).to(device)
+    x = t.randn(bs, n_ctx, n_in, device=device)
+    if device == 'cuda':
+        t.cuda.synchronize()
+        t.cuda.reset_peak_memory_stats()
+        start_mem = t.cuda.memory_allocated()
+    else:
+        start_mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    attn(x).pow(2).mean().backward()
+    start = time.time()
+    for _ in range(n_steps):
+        attn.zero_grad()
+        attn(x).pow(2).mean().backward()
+    if device == 'cuda':
+        t.cuda.synchronize()
+        mem = t.cuda.max_memory_allocated() - start_mem
+    else:
+        mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - start_mem
+    return (time.time() - start) / n_steps, mem
+
+
+def test_chunked_attn(n_ctxs=(1024, 2048, 4096), attn_chunk_size=256, n_in=64, n_head=2, bs=2, attn_func=0, blocks=16,
+                      n_steps=3, device='cpu'):
+    """
+    Training step time and peak memory of one attention layer with the full score matrix vs attn_chunk_size blocks.
+    On cpu peak memory is the growth of max rss, which includes the parameter gradients.
+    """
+    import multiprocessing as mp
+    pool = mp.get_context('spawn').Pool(1, maxtasksperchild=1)
+    for n_ctx in n_ctxs:
+        (full_time, full_mem), (chunked_time, chunked_mem) = [
+            pool.apply(_chunked_attn_step, (n_ctx, n_in, n_head, bs, attn_func, blocks, chunk_size, n_steps, device))
+            for chunk_size in [0, attn_chunk_size]]
+        print(f"n_ctx {n_ctx}: full {full_time * 1000:.1f} ms/step, {full_mem / 2**20:.1f} MB peak; "
+              f"attn_chunk_size {attn_chunk_size} {chunked_time * 1000:.1f} ms/step, {chunked_mem / 2**20:.1f} MB peak")
+    pool.close()
+
+
 if __name__ == '__main__':
     from jukebox.utils.dist_utils import setup_dist_from_mpi
     setup_dist_from_mpi(port=29600)
@@ -507,4 +810,5 @@ if __name__ == '__main__':
         attn.training = False
         attn.check_sample()
         attn.check_chunks(chunk_size)
+        attn.check_chunked_attn(512)
         print(f"Checked attn_func: {attn_func}")
@@ -140,3 +140,17 @@ def filter_logits(logits, top_k=0, top_p=0.0, filter_value=-float('Inf')):
         indices_to_remove = t.zeros_like(logits, dtype=t.uint8).scatter_(dim=-1, index=sorted_indices, src=sorted_indices_to_remove)
         logits[indices_to_remove] = filter_value
     return logits
+
+def sample_logits(logits, generators=None):
+    """ Sample from the categorical distribution given by logits over the last dim
+        Args:
+            generators: None to use the global rng, or one t.Generator per row of logits. Each row then draws
+                        from its own generator, so its samples don't depend on the other rows in the batch.
+    """
+    if generators is None:
+        return t.distributions.Categorical(logits=logits).sample()
+    assert len(generators) == logits.shape[0], f"Expected {logits.shape[0]} generators, got {len(generators)}"
+    cdf = t.cumsum(F.softmax(logits.float(), dim=-1), dim=-1)
+    u = t.stack([t.rand(cdf.shape[1:-1], generator=g, device=g.device) for g in generators]).to(cdf.device)
+    x = (cdf < u.unsqueeze(-1) * cdf[..., -1:]).sum(dim=-1)
+    return t.clamp(x, max=logits.shape[-1] - 1)
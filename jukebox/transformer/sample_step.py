@@ -0,0 +1,227 @@
+"""
+Fixed shape single token step of a Transformer, for sampling.
+
+Transformer.forward(sample=True) grows and slices its kv caches as it goes, so every token has
+different shapes and runs layer by layer from Python. StaticSampleStep keeps one preallocated
+buffer per layer instead, and a token only writes its keys and values at an index computed on
+the device from the position tensor p:
+
+    attn_func 0 (dense):        [N, n_ctx, d], attends to positions <= p
+    attn_func 1 (row):          [N, block_ctx, d] of the current block, attends to <= p % block_ctx
+    attn_func 2 (column):       [N, n_ctx, d], attends to the rows <= p // block_ctx of column p % block_ctx
+    attn_func 3 (previous row): [N, 2 * block_ctx, d], two blocks used alternately, attends to the other one
+    attn_func 6 (encoder):      [N, encoder_dims, d], the encoder keys and values, attends to all
+    attn_func 7 (prime):        [N, prime_len, d], attends to positions <= p
+
+Positions that can't be attended to are masked, so every step has the same shapes and no host
+syncs. That lets torch.compile capture the whole step in one graph (with cuda graphs on gpu)
+instead of thousands of small kernel launches. If torch.compile isn't available or fails, the
+step runs eagerly. load_cache copies the caches the Transformer filled while priming.
+"""
+import math
+import torch as t
+import torch.nn.functional as F
+
+from jukebox.transformer.ops import memory_efficient_quick_gelu
+from jukebox.utils.dist_utils import print_once
+
+SAMPLE_STEP_ATTN_FUNCS = [0, 1, 2, 3, 6, 7]
+
+
+def quick_gelu(x):
+    # Same as ops.quick_gelu, without the script function and autograd.Function that torch.compile can't trace
+    return x * t.sigmoid(1.702 * x)
+
+
+def layer_norm(ln, x):
+    # Same as ops.LayerNorm, whose numel check against a numpy int breaks torch.compile's graph
+    return F.layer_norm(x.float(), ln.normalized_shape, ln.weight, ln.bias, ln.eps).type_as(x)
+
+
+class StaticSampleStep:
+    def __init__(self, transformer, n_samples, fp16=False, compile=True):
+        self.transformer = transformer
+        self.n_samples = n_samples
+        self.fp16 = fp16
+        self.layers = list(transformer._attn_mods)
+        for l in self.layers:
+            assert l.attn.attn_func in SAMPLE_STEP_ATTN_FUNCS, f"attn_func {l.attn.attn_func} can't sample"
+        param = next(transformer.parameters())
+        self.device, self.dtype = param.device, t.float16 if fp16 else t.float
+        self.p = t.zeros((), dtype=t.long, device=self.device) # Position of the token being sampled
+        self.buffers = [self.get_buffers(l.attn) for l in self.layers]
+        self.forward = self._forward
+        if compile and hasattr(t, 'compile'):
+            mode = 'reduce-overhead' if self.device.type == 'cuda' else None
+            self.forward = t.compile(self._forward, mode=mode, dynamic=False)
+        self.compiled = self.forward is not self._forward
+
+    def get_buffers(self, attn):
+        N, d = self.n_samples, attn.n_state
+        length = {0: lambda: attn.n_ctx,
+                  1: lambda: attn.block_ctx,
+                  2: lambda: attn.n_ctx,
+                  3: lambda: 2 * attn.block_ctx,
+                  6: lambda: attn.encoder_dims,
+                  7: lambda: attn._prime_len}[attn.attn_func]()
+        return dict(key=t.zeros(N, length, d, device=self.device, dtype=self.dtype),
+                    value=t.zeros(N, length, d, device=self.device, dtype=self.dtype))
+
+    def load_cache(self, sample_t, encoder_kv=None):
+        # Start at position sample_t, with the caches of the Transformer at sample_t (empty for 0)
+        for l, buffers in zip(self.layers, self.buffers):
+            attn = l.attn
+            assert attn.sample_t == sample_t, f"{attn.sample_t} != {sample_t}"
+            if attn.attn_func == 6:
+                if 'key' in attn.cache:
+                    key, value = attn.cache['key'], attn.cache['value']
+                else:
+                    key, value = attn.c_enc_kv(encoder_kv.type(self.dtype)).chunk(2, dim=2)
+                buffers['key'].copy_(key)
+                buffers['value'].copy_(value)
+                continue
+            for name, buffer in buffers.items():
+                buffer.zero_() # Previous row attention reads zeros in the first block
+                if sample_t == 0:
+                    continue
+                cache = attn.cache[name]
+                if attn.attn_func == 2:
+                    # The column cache is [N, block_ctx, blocks, d], ie by column
+                    buffer.view(self.n_samples, attn.blocks, attn.block_ctx, -1).copy_(cache.transpose(1, 2))
+                    buffer[:, sample_t:] = 0 # Never written, and a masked nan would still make the output nan
+                    continue
+                # Positions of the cache, which ends at sample_t, except for the prime cache which starts at 0
+                pos = t.arange(sample_t - cache.shape[1], sample_t, device=self.device)
+                index = {0: lambda: pos,
+                         1: lambda: pos % attn.block_ctx,
+                         3: lambda: (pos // attn.block_ctx) % 2 * attn.block_ctx + pos % attn.block_ctx,
+                         7: lambda: t.arange(cache.shape[1], device=self.device)}[attn.attn_func]()
+                buffer[:, index] = cache
+        self.p.fill_(sample_t)
+
+    def attn(self, attn, x, buffers):
+        p, bc, N = self.p, getattr(attn, 'block_ctx', None), self.n_samples
+        if attn.attn_func == 6:
+            q, k, v = attn.c_attn(x), buffers['key'], buffers['value']
+            valid = None
+        else:
+            q, key, value = attn.c_attn(x).chunk(3, dim=2)
+            if attn.attn_func in [0, 1, 7]:
+                if attn.attn_func == 0:
+                    index = p
+                elif attn.attn_func == 1:
+                    index = p % bc
+                else:
+                    index = t.clamp(p, max=attn._prime_len - 1)
+                positions = t.arange(buffers['key'].shape[1], device=x.device)
+                valid = positions <= index
+                if attn.attn_func == 7:
+                    # The prime cache stops at prime_len
+                    keep = p >= attn._prime_len
+                    key = t.where(keep, buffers['key'].index_select(1, index.view(1)), key)
+                    value = t.where(keep, buffers['value'].index_select(1, index.view(1)), value)
+                buffers['key'].index_copy_(1, index.view(1), key)
+                buffers['value'].index_copy_(1, index.view(1), value)
+                k, v = buffers['key'], buffers['value']
+            elif attn.attn_func == 2:
+                buffers['key'].index_copy_(1, p.view(1), key)
+                buffers['value'].index_copy_(1, p.view(1), value)
+                column = t.arange(attn.blocks, device=x.device) * bc + p % bc
+                k, v = buffers['key'].index_select(1, column), buffers['value'].index_select(1, column)
+                valid = t.arange(attn.blocks, device=x.device) <= p // bc
+            elif attn.attn_func == 3:
+                block = p // bc
+                buffers['key'].index_copy_(1, (block % 2 * bc + p % bc).view(1), key)
+                buffers['value'].index_copy_(1, (block % 2 * bc + p % bc).view(1), value)
+                prev = (block + 1) % 2 * bc + t.arange(bc, device=x.device) # Zeros in the first block
+                k, v = buffers['key'].index_select(1, prev), buffers['value'].index_select(1, prev)
+                valid = None
+        q, k, v = attn.split_heads(q), attn.split_heads(k), attn.split_heads(v)
+        if hasattr(F, 'scaled_dot_product_attention'):
+            # Same scale as FactoredAttention._attn. Inductor's own attention pattern matching fails on the explicit form
+            a = F.scaled_dot_product_attention(q, k, v, attn_mask=None if valid is None else valid.view(1, -1))
+        else:
+            # Same as FactoredAttention._attn for a single query
+            scale = 1. / math.sqrt(math.sqrt(attn.n_state // attn.n_head))
+            w = t.matmul(q, k.transpose(-1, -2)) * (scale * scale)
+            wtype = w.dtype
+            w = w.float()
+            if valid is not None:
+                w = w.masked_fill(~valid, -1e9)
+            w = F.softmax(w, dim=-1).type(wtype)
+            a = t.matmul(w, v)
+        return attn.c_proj(attn.merge_heads(a))
+
+    def _forward(self, x):
+        if self.fp16:
+            x = x.half()
+        for l, buffers in zip(self.layers, self.buffers):
+            a = self.attn(l.attn, layer_norm(l.ln_0, x), buffers)
+            mlp = l.mlp
+            act = quick_gelu if mlp.act is memory_efficient_quick_gelu else mlp.act
+            m = mlp.c_proj(act(mlp.c_fc(layer_norm(l.ln_1, x + a))))
+            if l.res_scale == 1.0:
+                x = x + a + m
+            else:
+                x = x + l.res_scale * (a + m)
+        return x.float()
+
+    def __call__(self, x):
+        # x: [N, 1, n_in] input of the token at self.p. Returns the output and moves to the next position
+        try:
+            x = self.forward(x)
+        except Exception as e:
+            if not self.compiled:
+                raise
+            print_once(f"Compiling the sample step failed, sampling eagerly: {e}")
+            self.forward, self.compiled = self._forward, False
+            x = self.forward(x)
+        self.p.add_(1)
+        return x
+
+
+def test_sample_step(n_in=128, n_ctx=1024, n_head=2, depth=16, blocks=16, n_samples=4, n_prime=300, attn_orders=(2, 10, 12),
+                     compile=True):
+    """
+    Fixed shape step vs the eager Transformer sampling loop, after priming n_prime positions: max output difference
+    for every attn_order, and tokens/sec eager, static and compiled.
+    """
+    import time
+    from jukebox.transformer.transformer import Transformer
+    for attn_order in attn_orders:
+        t.manual_seed(0)
+        encoder_dims = 64 if attn_order == 10 else 0
+        transformer = Transformer(n_in, n_ctx, n_head, depth, mask=True, attn_order=attn_order, blocks=blocks,
+                                  encoder_dims=encoder_dims, prime_len=100).eval()
+        x = t.randn(n_samples, n_ctx, n_in)
+        encoder_kv = t.randn(n_samples, encoder_dims, n_in) if encoder_dims else None
+        results = {}
+        for name in ['eager', 'static', 'compiled'] if compile else ['eager', 'static']:
+            with t.no_grad():
+                transformer.del_cache()
+                if n_prime > 0:
+                    transformer(x[:, :n_prime], encoder_kv=encoder_kv, sample=True)
+                step = None
+                if name != 'eager':
+                    step = StaticSampleStep(transformer, n_samples, compile=name == 'compiled')
+                    step.load_cache(n_prime, encoder_kv)
+                    start_time = time.time()
+                    step(x[:, n_prime:n_prime + 1]) # Compiles
+                    warmup_time = time.time() - start_time
+                    step.load_cache(n_prime, encoder_kv)
+                start_time = time.time()
+                ys = [step(x[:, i:i + 1]) if step is not None else
+                      transformer(x[:, i:i + 1], encoder_kv=encoder_kv, sample=True) for i in range(n_prime, n_ctx)]
+                elapsed = time.time() - start_time
+            results[name] = (t.cat(ys, dim=1), (n_ctx - n_prime) / elapsed)
+            if step is not None:
+                print(f"  {name}: first step {warmup_time:.1f}s{'' if name == 'static' or step.compiled else ' (fell back to eager)'}")
+        transformer.del_cache()
+        y_eager = results['eager'][0]
+        print(f"attn_order {attn_order}: " + ", ".join(f"{name} {speed:.1f} tokens/sec" +
+              ("" if name == 'eager' else f" (max diff {t.max(t.abs(y - y_eager)):.1e})") for name, (y, speed) in results.items()))
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_sample_step)
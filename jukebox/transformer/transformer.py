@@ -6,6 +6,7 @@ import jukebox.utils.dist_adapter as dist
 
 from jukebox.transformer.ops import Conv1D, ACT_FNS, LayerNorm
 from jukebox.transformer.factored_attention import FactoredAttention
+from jukebox.transformer.sample_step import StaticSampleStep
 from jukebox.utils.checkpoint import checkpoint
 
 def _convert_mlp_traced(l):
@@ -37,7 +38,7 @@ class ResAttnBlock(nn.Module):
                  m_attn = 0.25, m_mlp = 1.,
                  checkpoint_attn = 0, checkpoint_mlp = 0,
                  attn_func=0, blocks=None, spread=None,
-                 encoder_dims=None, prime_len=None):
+                 encoder_dims=None, prime_len=None, attn_chunk_size=0):
         super().__init__()
         self.attn = FactoredAttention(n_in=n_in, n_ctx=n_ctx, n_state=int(m_attn * n_in), n_head=n_head,
                                       attn_dropout=attn_dropout, resid_dropout=resid_dropout,
@@ -45,7 +46,8 @@ class ResAttnBlock(nn.Module):
                                       zero_out=zero_out, init_scale=init_scale,
                                       checkpoint_attn=checkpoint_attn,
                                       attn_func=attn_func, blocks=blocks, spread=spread,
-                                      encoder_dims=encoder_dims, prime_len=prime_len)
+                                      encoder_dims=encoder_dims, prime_len=prime_len,
+                                      attn_chunk_size=attn_chunk_size)
         self.ln_0 = LayerNorm(n_in)
         self.mlp = MLP(n_in=n_in, n_state=int(m_mlp * n_in),
                        resid_dropout=resid_dropout,
@@ -93,7 +95,7 @@ class Transformer(nn.Module):
                  m_attn=0.25, m_mlp=1.,
                  checkpoint_attn=0, checkpoint_mlp=0, checkpoint_res=0,
                  attn_order=0, blocks=None, spread=None,
-                 encoder_dims=None, prime_len=None):
+                 encoder_dims=None, prime_len=None, attn_chunk_size=0):
         super().__init__()
         self.n_in = n_in
         self.n_ctx = n_ctx
@@ -134,13 +136,15 @@ class Transformer(nn.Module):
                                   m_attn=m_attn, m_mlp=m_mlp,
                                   checkpoint_attn=checkpoint_attn, checkpoint_mlp=checkpoint_mlp,
                                   attn_func=attn_func(d), blocks=blocks, spread=spread,
-                                  encoder_dims=encoder_dims, prime_len=prime_len)
+                                  encoder_dims=encoder_dims, prime_len=prime_len,
+                                  attn_chunk_size=attn_chunk_size)
 
         self.checkpoint_res = checkpoint_res
         self._attn_mods = nn.ModuleList()
         for d in range(n_depth):
             self._attn_mods.append(attn_block(d))
         self.ws = []
+        self.sample_step = None # Last StaticSampleStep, see get_sample_step
 
 
     def set_record_attn(self, record_attn):
@@ -199,12 +203,47 @@ class Transformer(nn.Module):
         for l in self._attn_mods:
             l.attn.del_cache()
 
+    def set_encoder_kv_cache(self, cache, keys=None):
+        # Sample with the c_enc_kv projections of encoder_kv rows with these keys cached in cache (an EncoderKVCache),
+        # under each layer's index. A layer draft's layers have the same indices and share their c_enc_kv
+        for i, l in enumerate(self._attn_mods):
+            if l.attn.attn_func == 6:
+                l.attn.encoder_kv_cache, l.attn.encoder_kv_keys = cache, keys
+                l.attn.encoder_kv_layer = i
+
+    def get_sample_step(self, n_samples, fp16, compile=True):
+        # Fixed shape single token step, compiled if possible. Reused while n_samples and fp16 stay the same
+        step = self.sample_step
+        if step is None or (step.n_samples, step.fp16, step.transformer) != (n_samples, fp16, self):
+            self.sample_step = None # Free the old buffers first
+            step = self.sample_step = StaticSampleStep(self, n_samples, fp16=fp16, compile=compile)
+        return step
+
+    def save_cache(self):
+        for l in self._attn_mods:
+            l.attn.save_cache()
+
+    def rewind_cache(self, sample_t):
+        for l in self._attn_mods:
+            l.attn.rewind_cache(sample_t)
+
+    def cache_bytes(self):
+        # Bytes held by the kv caches, by attn_func
+        sizes = {}
+        for l in self._attn_mods:
+            tensors = [*l.attn.cache.values(), *l.attn.cache_buffers.values()]
+            bases = {id(v._base if v._base is not None else v): v._base if v._base is not None else v for v in tensors}
+            size = sum(v.numel() * v.element_size() for v in bases.values()) # Views share their base's memory
+            sizes[l.attn_func] = sizes.get(l.attn_func, 0) + size
+        return sizes
+
     def check_sample(self):
+        device = next(self.parameters()).device
         bs, l, s, d = (4, self.n_ctx, self.encoder_dims, self.n_in)
         prime = 5
         with t.no_grad():
-            encoder_kv = t.randn(bs, s, d).cuda()
-            x = t.randn(bs, l, d).cuda()
+            encoder_kv = t.randn(bs, s, d).to(device)
+            x = t.randn(bs, l, d).to(device)
             y_forw = self.forward(x, encoder_kv=encoder_kv, sample=True)
 
             self.del_cache()
@@ -222,6 +261,89 @@ class Transformer(nn.Module):
             max_err = t.max(t.abs(y_forw - y_forw_in_chunks))
             assert max_err <= 1e-6, f"Max err is {max_err} {[i for i in range(l) if t.max(t.abs(y_forw - y_forw_in_chunks)[:, i, :]) > 1e-6]}"
 
+    def check_rewind(self, n_draft=5, seed=0):
+        # Speculative sampling steps, tokens or chunks of up to n_draft + 1 positions, with a random number of them
+        # rewound after each, against one forward over the whole context
+        device = next(self.parameters()).device
+        rng = np.random.RandomState(seed)
+        bs, l, s, d = (2, self.n_ctx, self.encoder_dims, self.n_in)
+        with t.no_grad():
+            encoder_kv = t.randn(bs, s, d).to(device) if s else None
+            x = t.randn(bs, l, d).to(device)
+            self.del_cache()
+            y_forw = self.forward(x, encoder_kv=encoder_kv, sample=True)
+            self.del_cache()
+            y = t.zeros_like(y_forw)
+            n = 0
+            while n < l:
+                self.save_cache()
+                end = min(n + rng.randint(1, n_draft + 2), l)
+                if rng.rand() < 0.5:
+                    y[:, n:end] = self.forward(x[:, n:end], encoder_kv=encoder_kv, sample=True)
+                else:
+                    for i in range(n, end):
+                        y[:, i] = self.forward(x[:, i:i + 1], encoder_kv=encoder_kv, sample=True)[:, 0]
+                n = rng.randint(n + 1, end + 1)
+                self.rewind_cache(n)
+                self.check_cache(bs, n, False)
+            max_err = t.max(t.abs(y_forw - y))
+            assert max_err <= 1e-5, f"Max err is {max_err} after rewinds"
+            self.del_cache()
+
+
+def test_sample_speed(n_in=256, n_ctx=2048, n_head=2, n_depth=12, blocks=32, attn_order=2, bs=4, n_tokens=None,
+                      device='cpu'):
+    """
+    Tokens/sec sampling a small prior one token at a time through the kv cache
+    """
+    import time
+    t.manual_seed(0)
+    prior = Transformer(n_in, n_ctx, n_head, n_depth, mask=True, attn_order=attn_order, blocks=blocks).to(device)
+    prior.training = False
+    n_tokens = n_tokens or n_ctx
+    xs = t.randn(n_tokens, bs, 1, n_in, device=device)
+    prior.del_cache()
+    with t.no_grad():
+        start = time.time()
+        for x in xs:
+            prior(x, sample=True)
+        if device != 'cpu':
+            t.cuda.synchronize()
+        elapsed = time.time() - start
+    prior.check_cache(bs, n_tokens, False)
+    prior.del_cache()
+    print(f"attn_order {attn_order}, n_ctx {n_ctx}, depth {n_depth}, bs {bs}: {n_tokens / elapsed:.1f} tokens/sec")
+    return n_tokens / elapsed
+
+def test_cache_report(n_in=128, n_ctx=2048, blocks=32, depth_scale=12, bs=1, n_tokens=1024):
+    """
+    Cache memory and sampling latency per attn_func for the upsamplers and prior_5b configs,
+    scaled down to cpu size (width n_in, n_ctx and blocks keeping block_ctx, depth / depth_scale)
+    """
+    import time
+    from jukebox.hparams import HPARAMS_REGISTRY
+    for name in ['upsamplers', 'prior_5b']:
+        hps = HPARAMS_REGISTRY['upsampler_level_0' if name == 'upsamplers' else name]
+        t.manual_seed(0)
+        prior = Transformer(n_in, n_ctx, hps.heads, max(hps.prior_depth // depth_scale, 3), mask=True,
+                            attn_order=hps.attn_order, blocks=blocks)
+        prior.training = False
+        xs = t.randn(n_tokens, bs, 1, n_in)
+        prior.del_cache()
+        with t.no_grad():
+            start = time.time()
+            for x in xs:
+                prior(x, sample=True)
+            elapsed = time.time() - start
+        prior.check_cache(bs, n_tokens, False)
+        sizes = prior.cache_bytes()
+        full = 2 * bs * n_ctx * prior._attn_mods[0].attn.n_state * 4
+        print(f"{name} (attn_order {hps.attn_order}, depth {len(prior._attn_mods)}, block_ctx {n_ctx // blocks}): "
+              f"{n_tokens / elapsed:.1f} tokens/sec, {elapsed / n_tokens * 1000:.2f} ms/token")
+        for attn_func, size in sorted(sizes.items()):
+            n_layers = sum(l.attn_func == attn_func for l in prior._attn_mods)
+            print(f"  attn_func {attn_func}: {size / n_layers / 2**10:.1f} KB/layer ({size / n_layers / full:.3f} of a full context cache)")
+        prior.del_cache()
 
 if __name__ == '__main__':
     from jukebox.utils.dist_utils import setup_dist_from_mpi
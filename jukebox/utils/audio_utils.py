@@ -1,3 +1,9 @@
+import hashlib
+import json
+import os
+import pickle
+from multiprocessing import Pool
+
 import numpy as np
 import torch as t
 import jukebox.utils.dist_adapter as dist
@@ -19,42 +25,84 @@ class STFTValues:
         self.hop_length = hop_length
         self.window_size = window_size
 
-def calculate_bandwidth(dataset, hps, duration=600):
+def dataset_fingerprint(dataset):
+    # Changes whenever the files, their durations or the chunking of the dataset change
+    fingerprint = hashlib.sha1(f'{dataset.sr} {dataset.channels} {dataset.sample_length}\n'.encode('utf-8'))
+    for file, duration in zip(dataset.files, dataset.durations):
+        fingerprint.update(f'{file} {duration}\n'.encode('utf-8'))
+    return fingerprint.hexdigest()
+
+def get_bandwidth_stats(dataset, items, hps):
+    # Sums over items needed for calculate_bandwidth, with one batched stft over all of them
+    samples = np.stack([dataset.get_audio_chunk(*dataset.get_index_offset(item)) for item in items]).astype(np.float64)
+    mono = t.from_numpy(np.mean(samples, axis=2))
+    stft = t.stft(mono, hps.n_fft, hop_length=hps.hop_length, win_length=hps.window_size,
+                  window=t.hann_window(hps.window_size, dtype=t.float64), pad_mode='reflect', return_complex=True)
+    spec_norms = t.linalg.norm(t.abs(stft), dim=(1, 2))
+    return dict(l1=np.sum(np.abs(samples)), total=np.sum(samples), total_sq=np.sum(samples ** 2),
+                n_seen=int(np.prod(samples.shape)), spec_norm_total=spec_norms.sum().item(), spec_nelem=len(items))
+
+_bandwidth_worker_args = None
+
+def _init_bandwidth_worker(dataset, hps):
+    # Round trip through pickle so the worker doesn't share open files with the parent
+    global _bandwidth_worker_args
+    t.set_num_threads(1)
+    _bandwidth_worker_args = pickle.loads(pickle.dumps(dataset)), hps
+
+def _bandwidth_worker(items):
+    dataset, hps = _bandwidth_worker_args
+    return get_bandwidth_stats(dataset, items, hps)
+
+def calculate_bandwidth(dataset, hps, duration=600, nworkers=None, seed=0, chunk_size=16):
+    """
+    Mean l1, variance (l2) and mean spectrogram norm of the audio, over ~duration seconds
+    from a stratified random sample of items: one random item from each of n equal slices of the
+    dataset, so songs are covered in proportion to their length. Items are read by a process pool.
+    The result is cached in hps.bandwidth_cache_dir, keyed by dataset_fingerprint, stft params and sample.
+    """
+    cache_dir = getattr(hps, 'bandwidth_cache_dir', '')
     hps = DefaultSTFTValues(hps)
-    n_samples = int(dataset.sr * duration)
-    #l1, total, total_sq, n_seen, idx = 0.0, 0.0, 0.0, 0.0, dist.get_rank()
-    l1, total, total_sq, n_seen, idx = 0.0, 0.0, 0.0, 0.0, 0
-    spec_norm_total, spec_nelem = 0.0, 0.0
-    while n_seen < n_samples:
-        x = dataset[idx]
-        if isinstance(x, (tuple, list)):
-            x, y, midi = x
-        samples = x.astype(np.float64)
-        stft = librosa.core.stft(np.mean(samples, axis=1), hps.n_fft, hop_length=hps.hop_length, win_length=hps.window_size)
-        spec = np.absolute(stft)
-        spec_norm_total += np.linalg.norm(spec)
-        spec_nelem += 1
-        n_seen += int(np.prod(samples.shape))
-        l1 += np.sum(np.abs(samples))
-        total += np.sum(samples)
-        total_sq += np.sum(samples ** 2)
-        idx = max(16, 1)
-        #idx += max(16, dist.get_world_size())
-    #
-    # if dist.is_available():
-    #     from jukebox.utils.dist_utils import allreduce
-    #     n_seen = allreduce(n_seen)
-    #     total = allreduce(total)
-    #     total_sq = allreduce(total_sq)
-    #     l1 = allreduce(l1)
-    #     spec_nelem = allreduce(spec_nelem)
-    #     spec_norm_total = allreduce(spec_norm_total)
-
-    mean = total / n_seen
-    bandwidth = dict(l2 = total_sq / n_seen - mean ** 2,
-                     l1 = l1 / n_seen,
-                     spec = spec_norm_total / spec_nelem)
+    n_items = min(len(dataset), int(np.ceil(dataset.sr * duration / (dataset.sample_length * dataset.channels))))
+
+    if cache_dir:
+        key = hashlib.sha1(f'{dataset_fingerprint(dataset)} {hps.n_fft} {hps.hop_length} {hps.window_size} '
+                           f'{n_items} {seed}'.encode('utf-8')).hexdigest()[:16]
+        cache_path = os.path.join(os.path.expanduser(cache_dir), f'{key}.json')
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                bandwidth = json.load(f)
+            print_once(f'Loaded bandwidth from {cache_path}: {bandwidth}')
+            return bandwidth
+
+    rng = np.random.RandomState(seed)
+    bounds = np.linspace(0, len(dataset), n_items + 1).astype(np.int64)
+    items = [rng.randint(lo, max(hi, lo + 1)) for lo, hi in zip(bounds[:-1], bounds[1:])]
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    nworkers = min(nworkers or os.cpu_count() or 1, len(chunks))
+    if nworkers > 1:
+        with Pool(nworkers, initializer=_init_bandwidth_worker, initargs=(dataset, hps)) as pool:
+            stats = pool.map(_bandwidth_worker, chunks)
+    else:
+        stats = [get_bandwidth_stats(dataset, chunk, hps) for chunk in chunks]
+    stats = {key: sum(stat[key] for stat in stats) for key in stats[0]}
+
+    mean = stats['total'] / stats['n_seen']
+    bandwidth = dict(l2 = stats['total_sq'] / stats['n_seen'] - mean ** 2,
+                     l1 = stats['l1'] / stats['n_seen'],
+                     spec = stats['spec_norm_total'] / stats['spec_nelem'])
+    bandwidth = {key: float(val) for key, val in bandwidth.items()}
     print_once(bandwidth)
+
+    if cache_dir:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(bandwidth, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print_once(f'Could not save bandwidth to {cache_path}: {e}')
     return bandwidth
 
 def audio_preprocess(x, hps):
@@ -1,4 +1,7 @@
 import av
+import time
+from collections import OrderedDict
+
 import numpy as np
 import pretty_midi
 import torch as t
@@ -21,6 +24,14 @@ def get_duration_sec(file, cache=False):
         return duration
 
 
+def get_audio_info(file):
+    # Returns (duration in seconds, sample rate, channels) of the first audio stream
+    with av.open(file) as container:
+        audio = container.streams.get(audio=0)[0]
+        duration = audio.duration * float(audio.time_base)
+        return duration, audio.sample_rate, audio.channels
+
+
 def load_audio(file, sr, offset, duration, resample=True, approx=False, time_base='samples', check_duration=True):
     if time_base == 'sec':
         offset = offset * sr
@@ -62,78 +73,272 @@ def load_audio(file, sr, offset, duration, resample=True, approx=False, time_bas
     return sig, sr
 
 
-def load_midi(file, sr, offset, duration, dt=0.25):
-    def sec_to_idx(t, dt=0.25):
-        return int(t / dt)
-
-    # Load full midi file
-    n_notes = 128
+class AudioReader:
+    """
+    Streaming version of load_audio. Keeps an LRU of up to max_open open containers (with their
+    resampler and decoder) keyed by file. A read that starts where the previous read of the same
+    file stopped, or a little after it, continues decoding instead of reopening and seeking, so
+    reading a song window by window is linear in its length. Other reads seek like load_audio.
+    """
+    def __init__(self, sr, max_open=8, max_skip_in_seconds=10):
+        self.sr = sr
+        self.max_open = max_open
+        self.max_skip = int(max_skip_in_seconds * sr)
+        self.streams = OrderedDict()
+        self.seeks, self.reads = 0, 0
+
+    def open(self, file):
+        if file in self.streams:
+            self.streams.move_to_end(file)
+            return self.streams[file]
+        container = av.open(file)
+        audio = container.streams.get(audio=0)[0]  # Only first audio stream
+        stream = dict(container=container, audio=audio, duration=audio.duration * float(audio.time_base))
+        self.reset(stream, 0)
+        self.streams[file] = stream
+        while len(self.streams) > self.max_open:
+            _, old = self.streams.popitem(last=False)
+            old['container'].close()
+        return stream
+
+    def reset(self, stream, position):
+        # Fresh resampler and decoder, with decoded samples counted from position
+        stream['resampler'] = av.AudioResampler(format='fltp', layout='stereo', rate=self.sr)
+        stream['frames'] = stream['container'].decode(stream['audio'])
+        stream['position'], stream['buffer'] = position, np.zeros((2, 0), dtype=np.float32)
+
+    def seek(self, stream, offset):
+        audio = stream['audio']
+        stream['container'].seek(int(offset / self.sr / float(audio.time_base)), stream=audio)
+        self.reset(stream, offset)
+        self.seeks += 1
+
+    def decode(self, stream):
+        # Next decoded frame as [2, T] at sr, or None at the end of the stream
+        frame = next(stream['frames'], None)
+        if frame is None:
+            return None
+        frame.pts = None
+        frame = stream['resampler'].resample(frame)
+        return frame.to_ndarray(format='fltp')  # Convert to floats and not int16
+
+    def read(self, file, offset, duration, check_duration=True):
+        # Same as load_audio(file, sr, offset, duration), in samples
+        offset, duration = int(offset), int(duration)
+        stream = self.open(file)
+        if check_duration:
+            assert offset + duration <= stream['duration'] * self.sr, f"End {offset + duration} beyond duration {stream['duration'] * self.sr}"
+        if not stream['position'] <= offset <= stream['position'] + stream['buffer'].shape[-1] + self.max_skip:
+            self.seek(stream, offset)
+        self.reads += 1
+
+        skip = offset - stream['position']
+        frames, n = [stream['buffer']], stream['buffer'].shape[-1]
+        while n < skip + duration:
+            frame = self.decode(stream)
+            if frame is None:
+                break
+            frames.append(frame)
+            n += frame.shape[-1]
+        data = np.concatenate(frames, axis=-1) if len(frames) > 1 else frames[0]
+
+        sig = np.zeros((2, duration), dtype=np.float32)
+        read = data[:, skip:skip + duration]
+        sig[:, :read.shape[-1]] = read
+        # Keep the tail for the next window
+        stream['position'] += min(n, skip + duration)
+        stream['buffer'] = data[:, skip + duration:]
+        return sig, self.sr
+
+    def iter_windows(self, file, window, offset=0, duration=None, pad=False):
+        # Yields (offset, [2, window] audio) for consecutive windows from offset, up to offset + duration
+        # (default: the end of the song). The last partial window is zero padded if pad, else dropped
+        end = int(self.open(file)['duration'] * self.sr) if duration is None else offset + duration
+        while offset + window <= end or (pad and offset < end):
+            x, _ = self.read(file, offset, window, check_duration=offset + window <= end)
+            yield offset, x
+            offset += window
+
+    def close(self):
+        for stream in self.streams.values():
+            stream['container'].close()
+        self.streams.clear()
+
+    def __getstate__(self):
+        # Open containers can't be sent to DataLoader workers, each worker opens its own
+        state = self.__dict__.copy()
+        state['streams'] = OrderedDict()
+        return state
+
+
+def midi_sec_to_idx(t, dt=0.25):
+    return int(t / dt)
+
+
+def get_midi_notes(midi_format):
+    # Returns arrays of (instrument, pitch, velocity, start, end) for all notes, in order, with times in seconds
+    notes = [(i, note.pitch, note.velocity, note.start, note.end)
+             for i, instrument in enumerate(midi_format.instruments) for note in instrument.notes]
+    notes = np.array(notes, dtype=np.float64).reshape(-1, 5)
+    return notes[:, 0].astype(np.int64), notes[:, 1].astype(np.int64), notes[:, 2].astype(np.int64), notes[:, 3], notes[:, 4]
+
+
+def rasterize_notes(instruments, pitches, velocities, starts, ends, n_instruments, offset, duration, dt=0.25,
+                    pitch_range=(0, 128), dtype=np.int64):
+    """
+    Velocities at [time, notes] for frames [offset, offset + duration) of the dt grid, summed over instruments.
+    Within an instrument, a note covers frames [int(start / dt), int(end / dt)) (at least one frame) and the
+    last note wins where notes overlap, so this matches writing the notes one at a time into
+    [instruments, time, notes] and summing. Only the requested window is materialized.
+    """
+    low, high = pitch_range
+    start_idx = (starts / dt).astype(np.int64)
+    end_idx = (ends / dt).astype(np.int64)
+    end_idx = np.where(start_idx == end_idx, start_idx + 1, end_idx)
+    rank = np.arange(len(pitches), dtype=np.int64)  # Later notes overwrite earlier ones
+
+    # Clip notes to the window and pitch range
+    start_idx = np.maximum(start_idx, offset) - offset
+    end_idx = np.minimum(end_idx, offset + duration) - offset
+    keep = (end_idx > start_idx) & (pitches >= low) & (pitches < high)
+    instruments, pitches, velocities = instruments[keep], pitches[keep] - low, velocities[keep]
+    start_idx, end_idx, rank = start_idx[keep], end_idx[keep], rank[keep]
+
+    # Expand each note into the frames it covers
+    lengths = end_idx - start_idx
+    note = np.repeat(np.arange(len(lengths)), lengths)
+    frames = start_idx[note] + np.arange(len(note)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    # Keep the last note per touched (instrument, frame, pitch) cell by scattering max(rank, velocity) pairs,
+    # then sum the winners over instruments. Never allocates the dense [instruments, time, notes] array
+    n_pitches = high - low
+    cells = (instruments[note] * duration + frames) * n_pitches + pitches[note]
+    cells, inverse = np.unique(cells, return_inverse=True)
+    last = np.full(len(cells), -1, dtype=np.int64)
+    np.maximum.at(last, inverse.reshape(-1), rank[note] * 128 + velocities[note])
+    info = np.bincount(cells % (duration * n_pitches), weights=last % 128, minlength=duration * n_pitches)
+    return info.astype(dtype).reshape(duration, n_pitches)
+
+
+def get_midi_roll(file, dt=0.25, offset=0, duration=None, pitch_range=(0, 128), dtype=np.int64):
+    # Returns (velocities summed over instruments at [time, notes], number of instruments) for frames
+    # [offset, offset + duration), by default the whole song. Dividing by the number of instruments gives
+    # the instrument average used for conditioning
     midi_format = pretty_midi.PrettyMIDI(file)
-    midi_duration = midi_format.get_end_time()
+    if duration is None:
+        duration = int(midi_format.get_end_time() / dt) + 1 - offset
+    n_instruments = len(midi_format.instruments)
+    roll = rasterize_notes(*get_midi_notes(midi_format), n_instruments, offset, duration, dt, pitch_range, dtype)
+    return roll, n_instruments
 
-    # process midi file into velocities at [instruments, time, notes]
-    info = np.zeros((len(midi_format.instruments), int(midi_duration / dt) + 1, n_notes))
-    for i, instrument in enumerate(midi_format.instruments):
-        for note in instrument.notes:
-            start = sec_to_idx(note.start)
-            end = sec_to_idx(note.end)
-
-            if start == end:
-                info[i, start, note.pitch] = note.velocity
-            else:
-                info[i, start:end, note.pitch] = note.velocity
-
-    # average out all instruments
-    info = np.average(info, axis=0)
 
+def get_midi_chunk_from_roll(roll, n_instruments, sr, offset, duration, dt=0.25):
     # convert duration and offset from mp3 to midi
-    offset = sec_to_idx(offset / sr)  # convert mp3 offset to midi duration
-    duration = sec_to_idx(duration / sr)  # convert mp3 duration to midi duration
+    offset = midi_sec_to_idx(offset / sr, dt)  # convert mp3 offset to midi duration
+    duration = midi_sec_to_idx(duration / sr, dt)  # convert mp3 duration to midi duration
 
-    # extract required chunk adding zeros to any missing info
-    chunk = np.zeros((duration, n_notes))
-    required_info = info[offset: offset + duration]
+    # extract required chunk adding zeros to any missing info, and average out all instruments
+    chunk = np.zeros((duration, roll.shape[-1]))
+    required_info = roll[offset: offset + duration]
     chunk[: required_info.shape[0]] = required_info
+    return chunk / max(n_instruments, 1)
 
-    return chunk
 
+def load_midi(file, sr, offset, duration, dt=0.25):
+    # Only rasterize the frames of the chunk. Frames past the end of the song are zeros
+    offset = midi_sec_to_idx(offset / sr, dt)  # convert mp3 offset to midi duration
+    duration = midi_sec_to_idx(duration / sr, dt)  # convert mp3 duration to midi duration
+    roll, n_instruments = get_midi_roll(file, dt, offset, duration)
+    return roll / max(n_instruments, 1)
 
-def load_sample_midi(file, sr, duration, dt=0.25):
-    def sec_to_idx(t, dt=0.25):
-        return int(t / dt)
 
-    # Load full midi file
-    n_notes = 128
+def load_sample_midi(file, sr=None, duration=None, dt=0.25):
     midi_format = pretty_midi.PrettyMIDI(file)
-    midi_duration = midi_format.get_end_time()
-
-    # process midi file into velocities at [instruments, time, notes]
-    info = np.zeros((len(midi_format.instruments), int(midi_duration / dt) + 1, n_notes))
-    for i, instrument in enumerate(midi_format.instruments):
-        for note in instrument.notes:
-            start = sec_to_idx(note.start)
-            end = sec_to_idx(note.end)
-
-            if start == end:
-                info[i, start, note.pitch] = note.velocity
-            else:
-                info[i, start:end, note.pitch] = note.velocity
-
-    # average out all instruments
-    info = np.average(info, axis=0)
+    n_frames = int(midi_format.get_end_time() / dt) + 1
 
     duration = 95  # what does the midi embedding block take in array ids
 
     # randomly choose a chunk from the midi file
     num = np.random.rand()      # random between 0 - 1
-    offset = int(num * (len(info) - duration))
-
-    # extract required chunk adding zeros to any missing info
-    chunk = np.zeros((duration, n_notes))
-    required_info = info[offset: offset + duration]
-    chunk[: required_info.shape[0]] = required_info
-
-    return chunk
+    offset = int(num * (n_frames - duration))
+
+    # rasterize only the chunk, adding zeros to any missing info, and average out all instruments
+    n_instruments = len(midi_format.instruments)
+    roll = rasterize_notes(*get_midi_notes(midi_format), n_instruments, offset, duration, dt)
+    return roll / max(n_instruments, 1)
+
+
+def test_midi_rasterizer(n_songs=5, n_notes=5000, n_instruments=8, song_seconds=300, dt=0.25, seed=0):
+    """
+    Compare the per note loop with rasterize_notes on synthetic songs, for full songs and 95 frame windows.
+    """
+    rng = np.random.RandomState(seed)
+
+    def rasterize_loop(midi_format):
+        info = np.zeros((len(midi_format.instruments), int(midi_format.get_end_time() / dt) + 1, 128))
+        for i, instrument in enumerate(midi_format.instruments):
+            for note in instrument.notes:
+                start, end = midi_sec_to_idx(note.start, dt), midi_sec_to_idx(note.end, dt)
+                if start == end:
+                    info[i, start, note.pitch] = note.velocity
+                else:
+                    info[i, start:end, note.pitch] = note.velocity
+        return info.sum(axis=0)
+
+    loop_time, full_time, window_time = 0.0, 0.0, 0.0
+    for _ in range(n_songs):
+        midi_format = pretty_midi.PrettyMIDI()
+        for j in range(n_instruments):
+            instrument = pretty_midi.Instrument(program=j)
+            for start in rng.uniform(0, song_seconds, n_notes // n_instruments):
+                instrument.notes.append(pretty_midi.Note(velocity=int(rng.randint(1, 128)), pitch=int(rng.randint(0, 128)),
+                                                         start=start, end=start + rng.uniform(0.01, 4.0)))
+            midi_format.instruments.append(instrument)
+        n_frames = int(midi_format.get_end_time() / dt) + 1
+
+        start_time = time.time()
+        expected = rasterize_loop(midi_format)
+        loop_time += time.time() - start_time
+
+        start_time = time.time()
+        notes = get_midi_notes(midi_format)
+        actual = rasterize_notes(*notes, n_instruments, 0, n_frames, dt)
+        full_time += time.time() - start_time
+        assert np.array_equal(expected, actual), 'Rasterized roll differs from loop'
+
+        offset = rng.randint(0, n_frames - 95)
+        start_time = time.time()
+        window = rasterize_notes(*get_midi_notes(midi_format), n_instruments, offset, 95, dt)
+        window_time += time.time() - start_time
+        assert np.array_equal(expected[offset:offset + 95], window), 'Rasterized window differs from loop'
+
+    print(f'{n_notes} notes per song. Loop: {loop_time / n_songs * 1000:.1f} ms/song, '
+          f'vectorized: {full_time / n_songs * 1000:.1f} ms/song, 95 frame window: {window_time / n_songs * 1000:.1f} ms/song')
+
+
+def test_audio_reader(file, window=262144, n_windows=20, sr=44100):
+    """
+    Time reading consecutive windows of a song with load_audio vs AudioReader, and compare them to one long read.
+    """
+    reader = AudioReader(sr)
+    n_windows = min(n_windows, int(reader.open(file)['duration'] * sr) // window)
+
+    start_time = time.time()
+    expected = [load_audio(file, sr=sr, offset=i * window, duration=window)[0] for i in range(n_windows)]
+    load_time = time.time() - start_time
+
+    start_time = time.time()
+    actual = [x for _, x in reader.iter_windows(file, window, duration=n_windows * window)]
+    read_time = time.time() - start_time
+
+    seconds = n_windows * window / sr
+    print(f'load_audio: {seconds / load_time:.1f}x realtime, AudioReader: {seconds / read_time:.1f}x realtime, '
+          f'{reader.seeks} seeks for {reader.reads} reads')
+    # Seeking per window is only as exact as the container's seek, continuing the decode is exact
+    full, _ = load_audio(file, sr=sr, offset=0, duration=n_windows * window)
+    for name, xs in [('load_audio', expected), ('AudioReader', actual)]:
+        diff = max(np.abs(full[:, i * window:(i + 1) * window] - x).max() for i, x in enumerate(xs))
+        print(f'{name}: max abs diff to a single decode of all windows {diff:.2e}')
 
 
 def test_simple_loader():
@@ -0,0 +1,260 @@
+"""
+Keep prior weights on the device between levels and jobs, within a memory budget.
+
+_sample used to move each prior to the device with prior.cuda() before its level and back with
+prior.cpu() after, and SimplePrior.get_encoder_kv did the same with the lyrics encoder
+(prime_prior) on every window, so every job and window paid full parameter transfers.
+ModelResidency keeps a (pinned) host copy of every weight instead and moves them one transformer
+block at a time:
+
+- Levels whose weights fit in the budget together are resident: they're copied to the device the
+  first time they're loaded and stay there.
+- Other levels are copied by load() before their level and dropped by release() after, which is
+  free since the host copy is kept. The copies run in order on a side stream and each block only
+  waits for its own copy, so the first forward starts before the whole prior is on the device.
+- The prime_prior blocks of a level that isn't resident are streamed: a block prefetches the next
+  one before its forward and is dropped after it, so at most two of them are on the device.
+
+bytes_moved counts host to device copies, which sample.py reports per window.
+"""
+import itertools
+import torch as t
+import torch.nn as nn
+
+from jukebox.utils.dist_utils import print_once
+
+
+class WeightUnit:
+    # Parameters and buffers of a module (without the modules in skip), either on the device or as their host copy
+    def __init__(self, module, skip=()):
+        self.params, self.buffers = [], []
+        seen = set()
+        def walk(m):
+            if m in skip:
+                return
+            for p in m._parameters.values():
+                if p is not None and id(p) not in seen: # Tied weights are moved once
+                    seen.add(id(p))
+                    self.params.append(p)
+            self.buffers.extend((m, name) for name, b in m._buffers.items() if b is not None)
+            for child in m.children():
+                walk(child)
+        walk(module)
+        self.host = [p.data for p in self.params] + [m._buffers[name] for m, name in self.buffers]
+        self.nbytes = sum(x.numel() * x.element_size() for x in self.host)
+        self.on_device = False
+        self.event = None # Copy in flight on the side stream
+
+    def set(self, xs):
+        for p, x in zip(self.params, xs):
+            p.data = x
+        for (m, name), x in zip(self.buffers, xs[len(self.params):]):
+            m._buffers[name] = x
+
+    def copy_in(self, device, stream):
+        # Allocated on the compute stream, so freeing them later is ordered after the compute that used them
+        if device.type == 'cuda':
+            self.host = [x if x.is_pinned() else x.pin_memory() for x in self.host]
+        xs = [t.empty_like(x, device=device) for x in self.host]
+        if stream is None:
+            for x, host in zip(xs, self.host):
+                x.copy_(host)
+        else:
+            # The memory may have just been freed by compute that hasn't run yet
+            stream.wait_stream(t.cuda.current_stream(device))
+            with t.cuda.stream(stream):
+                for x, host in zip(xs, self.host):
+                    x.copy_(host, non_blocking=True)
+                self.event = t.cuda.Event()
+                self.event.record(stream)
+        self.set(xs)
+        self.on_device = True
+        return self.nbytes
+
+    def wait(self):
+        # Make the compute stream wait for the copy. Doesn't block the host
+        if self.event is not None:
+            t.cuda.current_stream().wait_event(self.event)
+            self.event = None
+
+    def release(self):
+        self.wait() # Don't free memory the copy is still writing
+        self.set(self.host)
+        self.on_device = False
+
+
+class LevelWeights:
+    def __init__(self, prior):
+        prime_prior = getattr(prior, 'prime_prior', None)
+        self.prior = prior
+        self.blocks = [WeightUnit(l) for l in prior.prior.transformer._attn_mods]
+        self.prime_blocks = [WeightUnit(l) for l in prime_prior.transformer._attn_mods] if prime_prior is not None else []
+        skip = set(prior.prior.transformer._attn_mods) | (set(prime_prior.transformer._attn_mods) if prime_prior is not None else set())
+        self.rest = WeightUnit(prior, skip) # Conditioners, embeddings and output layers
+        self.nbytes = sum(unit.nbytes for unit in [self.rest, *self.blocks, *self.prime_blocks])
+        self.resident = False
+        self.loaded = False
+        self.streaming = False # prime_prior blocks are streamed
+
+
+def get_resident(sizes, budget):
+    # Indices of the sizes with the largest total that fits in budget. Every level that isn't resident
+    # is copied once per job, so this copies the fewest bytes. There are only a few levels
+    best, best_total = (), 0
+    for n in range(1, len(sizes) + 1):
+        for subset in itertools.combinations(range(len(sizes)), n):
+            total = sum(sizes[i] for i in subset)
+            if best_total < total <= budget:
+                best, best_total = subset, total
+    return best
+
+
+class ModelResidency:
+    def __init__(self, priors, device='cuda', budget=0.0):
+        # budget: GB of device memory for the weights of resident levels
+        self.device = t.device(device)
+        self.stream = t.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.bytes_moved = 0
+        self.levels = {}
+        self.hooks = []
+        for prior in priors:
+            if prior is not None:
+                self.attach(prior)
+        levels = list(self.levels.values())
+        for i in get_resident([level.nbytes for level in levels], budget * 2**30):
+            levels[i].resident = True
+        for level in levels:
+            print_once(f"Level {level.prior.level}: {level.nbytes / 2**20:.0f} MB of weights, "
+                       f"{'resident' if level.resident else 'loaded for each level'}")
+
+    def attach(self, prior):
+        level = self.levels[prior] = LevelWeights(prior)
+        prior.residency = self
+        # The hooks do nothing unless the level was loaded, so moving the prior with .cuda() still works
+        for unit, l in zip(level.blocks, prior.prior.transformer._attn_mods):
+            self.hooks.append(l.register_forward_pre_hook(lambda module, inputs, unit=unit: unit.wait()))
+        if level.prime_blocks:
+            for i, l in enumerate(prior.prime_prior.transformer._attn_mods):
+                self.hooks.append(l.register_forward_pre_hook(lambda module, inputs, i=i: self.stream_in(level, i)))
+                self.hooks.append(l.register_forward_hook(lambda module, inputs, outputs, i=i: self.stream_out(level, i)))
+
+    def detach(self):
+        # Back to host weights and no hooks, resident levels included
+        for prior, level in self.levels.items():
+            level.resident = False
+            self.release(prior)
+            prior.residency = None
+        for hook in self.hooks:
+            hook.remove()
+        self.levels, self.hooks = {}, []
+
+    def copy_in(self, unit):
+        self.bytes_moved += unit.copy_in(self.device, self.stream)
+
+    def load(self, prior):
+        # Copy prior's weights to the device, unless they're there already. Returns without waiting for the copies
+        level = self.levels[prior]
+        if level.loaded:
+            return
+        self.copy_in(level.rest)
+        level.rest.wait() # Everything before the first block needs it
+        for unit in level.blocks:
+            self.copy_in(unit)
+        if level.resident:
+            for unit in level.prime_blocks:
+                self.copy_in(unit)
+        level.streaming = not level.resident
+        level.loaded = True
+
+    def wait(self, prior):
+        # Wait for all the copies of load, for code that reads the weights without calling the blocks
+        level = self.levels[prior]
+        for unit in [level.rest, *level.blocks, *level.prime_blocks]:
+            unit.wait()
+
+    def release(self, prior):
+        # Drop the device copies of a level that isn't resident
+        level = self.levels[prior]
+        if level.resident or not level.loaded:
+            return
+        for unit in [level.rest, *level.blocks, *level.prime_blocks]:
+            if unit.on_device:
+                unit.release()
+        level.loaded = level.streaming = False
+        prior.prior.transformer.sample_step = None # Its graph may hold the addresses of the old weights
+
+    def stream_in(self, level, i):
+        if not level.streaming:
+            return
+        units = level.prime_blocks
+        if not units[i].on_device:
+            self.copy_in(units[i])
+        units[i].wait()
+        next_unit = units[(i + 1) % len(units)] # After the last block, the first one for the next window
+        if not next_unit.on_device:
+            self.copy_in(next_unit)
+
+    def stream_out(self, level, i):
+        units = level.prime_blocks
+        if level.streaming and len(units) > 1:
+            units[i].release()
+
+
+def test_model_residency(n_levels=3, width=64, depth=4, n_ctx=64, n_tokens=32, n_samples=2, n_windows=4, n_jobs=2):
+    """
+    Jobs of n_windows per level on stand in priors, for budgets that fit no level, the largest level, and all of them.
+    Outputs should match the priors without a ModelResidency, with fewer bytes moved per window as more levels are resident.
+    """
+    from jukebox.transformer.transformer import Transformer
+
+    class StandInPrior(nn.Module):
+        # The parts of a SimplePrior that ModelResidency uses: prior.transformer, and prime_prior at the top level
+        def __init__(self, level):
+            super().__init__()
+            self.level = level
+            self.prior = nn.ModuleDict(dict(transformer=Transformer(width, n_ctx, 2, depth * (level + 1), mask=True),
+                                            x_out=nn.Linear(width, 16)))
+            self.prime_prior = nn.ModuleDict(dict(transformer=Transformer(width, n_tokens, 2, depth))) if level == n_levels - 1 else None
+            self.residency = None
+
+        def sample_window(self, x, tokens):
+            if self.prime_prior is not None:
+                x = x + self.prime_prior.transformer(tokens).mean(dim=1, keepdim=True)
+            return self.prior.x_out(self.prior.transformer(x))
+
+    device = 'cuda' if t.cuda.is_available() else 'cpu'
+    t.manual_seed(0)
+    priors = [StandInPrior(level).eval() for level in range(n_levels)]
+    xs = [t.randn(n_samples, n_ctx, width, device=device) for _ in range(n_windows)]
+    tokens = t.randn(n_samples, n_tokens, width, device=device)
+
+    def run_jobs(residency):
+        outputs = []
+        with t.no_grad():
+            for job in range(n_jobs):
+                for prior in reversed(priors):
+                    if residency is None:
+                        prior.to(device)
+                    else:
+                        residency.load(prior)
+                    outputs.extend(prior.sample_window(x, tokens) for x in xs)
+                    if residency is None:
+                        prior.cpu()
+                    else:
+                        residency.release(prior)
+        return outputs
+
+    expected = run_jobs(None)
+    sizes = sorted(LevelWeights(prior).nbytes for prior in priors)
+    for name, budget in [('none', 0.0), ('largest', sizes[-1]), ('all', sum(sizes))]:
+        residency = ModelResidency(priors, device, budget / 2**30)
+        outputs = run_jobs(residency)
+        assert all(t.equal(x, y) for x, y in zip(expected, outputs)), f'Outputs differ with {name} resident'
+        residency.detach()
+        print(f"Resident {name} ({budget / 2**20:.1f} MB budget): {residency.bytes_moved / 2**20:.1f} MB moved for {n_jobs} jobs, "
+              f"{residency.bytes_moved / (n_jobs * n_levels * n_windows) / 2**20:.2f} MB per window")
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_model_residency)
@@ -1,3 +1,4 @@
+import numpy as np
 import torch as t
 
 def split_batch(obj, n_samples, split_size):
@@ -20,3 +21,47 @@ def get_starts(total_length, n_ctx, hop_length):
             start = total_length - n_ctx
         starts.append(start)
     return starts
+
+# Group the windows of a level into waves. A window conditions on the tokens of the level from its start up to
+# what has been sampled so far, so it has to wait for the windows that sampled them. Windows in the same wave
+# don't depend on each other and can be sampled together. Returns list of waves, each a list of
+# (start, sample_tokens, conditioning_tokens) in window order. windows is a list of (start, sample_tokens).
+def get_waves(windows, length):
+    waves, sampled = [], [] # sampled: (wave, end) of windows so far
+    for start, sample_tokens in windows:
+        end = start + sample_tokens
+        if end <= length:
+            continue # Nothing new to sample
+        wave = max([w + 1 for w, sampled_end in sampled if sampled_end > start], default=0)
+        if wave == len(waves):
+            waves.append([])
+        waves[wave].append((start, sample_tokens, length - start))
+        sampled.append((wave, end))
+        length = end
+    return waves
+
+# One generator per sample, seeded by (seed, level, start, sample index), so a sample's codes for a window
+# don't depend on how samples and windows are batched. seed can also be a list of (seed, sample index) for
+# each sample, when samples of different jobs are batched together
+def get_sample_generators(seed, level, start, n_samples, device):
+    seeds = seed if isinstance(seed, (list, tuple)) else [(seed, i) for i in range(n_samples)]
+    assert len(seeds) == n_samples, f"Expected {n_samples} seeds, got {len(seeds)}"
+    generators = []
+    for seed, i in seeds:
+        state = int(np.random.SeedSequence([seed, level, start, i]).generate_state(1)[0])
+        generators.append(t.Generator(device=device).manual_seed(state))
+    return generators
+
+# Rough memory per sampled row of a window: the kv caches at their largest, x_cond and the logits
+def get_row_bytes(prior, fp16):
+    n_ctx = prior.n_ctx
+    cache_itemsize = 2 if fp16 else 4
+    total = 0
+    for l in prior.prior.transformer._attn_mods:
+        attn = l.attn
+        cache_len = {1: attn.block_ctx if attn.blocks else n_ctx, 3: 2 * attn.block_ctx if attn.blocks else n_ctx,
+                     6: attn.encoder_dims}.get(attn.attn_func, attn.n_ctx)
+        total += 2 * cache_len * attn.n_state * cache_itemsize
+    total += n_ctx * prior.prior.width * 4 # x_cond
+    total += prior.prior.bins * 4 * 3 # logits, filtered logits and their softmax
+    return total
@@ -0,0 +1,144 @@
+"""
+Incremental decode of a level's codes while they are being sampled.
+
+The decoders are convolutional, so the audio for code t only depends on codes within the
+decoder's receptive field around t. Each time sampling appends codes, StreamingDecoder decodes
+from receptive field codes before the audio emitted so far up to the newest code, and emits
+the audio of every code whose right context is complete. flush emits the rest at the end.
+Each span is decoded with the same context the full decode would see, so the stitched audio
+matches VQVAE.decode without seams, and is appended to growing wav files and/or returned as
+numpy chunks.
+"""
+import math
+import os
+import time
+import numpy as np
+import soundfile
+import torch as t
+import torch.nn as nn
+
+from jukebox.utils.dist_utils import print_once
+
+
+def get_receptive_field(decoder):
+    # Number of input frames on either side of an input frame whose decoder outputs it can affect
+    radius, scale = 0.0, 1 # scale: output frames per input frame so far
+    def walk(module):
+        nonlocal radius, scale
+        if isinstance(module, nn.ConvTranspose1d):
+            radius += math.ceil(module.kernel_size[0] / module.stride[0]) / scale
+            scale *= module.stride[0]
+        elif isinstance(module, nn.Conv1d):
+            radius += (module.kernel_size[0] - 1) * module.dilation[0] / scale / module.stride[0]
+        else:
+            for child in module.children():
+                walk(child)
+    for level_block in reversed(decoder.level_blocks): # Decoder.forward runs the levels top down
+        walk(level_block)
+    walk(decoder.out)
+    return int(math.ceil(radius))
+
+
+class StreamingDecoder:
+    def __init__(self, vqvae, level, logdir=None, sr=None):
+        self.vqvae = vqvae
+        self.level = level
+        self.hop_length = int(vqvae.hop_lengths[level])
+        self.receptive_field = get_receptive_field(vqvae.decoders[level])
+        self.logdir = logdir
+        self.sr = sr
+        self.files = None
+        self.emitted = 0 # Codes whose audio has been emitted
+        self.start_time = time.time()
+        self.first_audio_time = None
+        self.decode_time = 0.0
+        self.n_spans = 0
+
+    def decode_span(self, z, end):
+        # Audio of codes [self.emitted, end), from codes [self.emitted - receptive_field, z.shape[1])
+        start = max(self.emitted - self.receptive_field, 0)
+        start_time = time.time()
+        with t.no_grad():
+            x = self.vqvae.decode([z[:, start:]], start_level=self.level, end_level=self.level + 1)
+        x = x[:, (self.emitted - start) * self.hop_length:(end - start) * self.hop_length]
+        x = t.clamp(x, -1, 1).cpu().numpy()
+        self.decode_time += time.time() - start_time
+        self.n_spans += 1
+        self.emitted = end
+        if self.first_audio_time is None:
+            self.first_audio_time = time.time() - self.start_time
+        if self.logdir is not None:
+            self.write(x)
+        return x
+
+    def update(self, z):
+        # z: codes sampled so far (N, T). Returns audio (N, T, C) of the newly final codes, or None
+        end = z.shape[1] - self.receptive_field
+        if end <= self.emitted:
+            return None
+        return self.decode_span(z, end)
+
+    def flush(self, z):
+        x = self.decode_span(z, z.shape[1]) if z.shape[1] > self.emitted else None
+        if self.files is not None:
+            for f in self.files:
+                f.close()
+            self.files = None
+        print_once(f"Streamed level {self.level} in {self.n_spans} spans: first audio after {self.first_audio_time or 0:.1f}s, "
+                   f"{self.decode_time:.1f}s decoding")
+        return x
+
+    def write(self, x):
+        if self.files is None:
+            os.makedirs(self.logdir, exist_ok=True)
+            self.files = [soundfile.SoundFile(f'{self.logdir}/item_{i}.wav', 'w', samplerate=self.sr,
+                                              channels=x.shape[2], format='WAV') for i in range(x.shape[0])]
+        for f, x_i in zip(self.files, x):
+            f.write(x_i)
+            f.flush()
+
+
+def test_streaming_decode(level=0, n_samples=2, n_tokens=2048, window=512, hop=256, window_time=1.0, width=32, depth=4):
+    """
+    Stream the decode of a small random vqvae as windows of codes arrive, vs one decode at the end.
+    window_time simulates the time to sample a window, for time to first audio.
+    """
+    import tempfile
+    from jukebox.vqvae.vqvae import VQVAE
+    t.manual_seed(0)
+    vqvae = VQVAE(input_shape=(n_tokens * 128, 1), levels=3, downs_t=(3, 2, 2), strides_t=(2, 2, 2), emb_width=64,
+                  l_bins=2048, mu=0.99, commit=0.02, spectral=0.0, multispectral=1.0, width=width, depth=depth, m_conv=1.0,
+                  dilation_growth_rate=3, dilation_cycle=None, reverse_decoder_dilation=True).eval()
+    for p in vqvae.parameters():
+        p.data.normal_(std=0.1) # zero_out convs would hide parts of the receptive field
+    z = t.randint(0, 2048, (n_samples, n_tokens))
+    ends = sorted(set(min(start + window, n_tokens) for start in range(0, n_tokens - window + hop, hop)))
+
+    start_time = time.time()
+    with t.no_grad():
+        x_full = vqvae.decode([z], start_level=level, end_level=level + 1).numpy()
+    full_time = time.time() - start_time
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stream = StreamingDecoder(vqvae, level, logdir=tmp, sr=44100)
+        chunks = []
+        for end in ends:
+            stream.start_time -= window_time # As if the window took window_time to sample
+            x = stream.update(z[:, :end])
+            if x is not None:
+                chunks.append(x)
+        chunks.append(stream.flush(z))
+        x_stream = np.concatenate([x for x in chunks if x is not None], axis=1)
+        x_wav = soundfile.read(f'{tmp}/item_0.wav')[0]
+
+    assert x_stream.shape == x_full.shape, f'{x_stream.shape} != {x_full.shape}'
+    print(f"Receptive field {stream.receptive_field} codes, {stream.n_spans} spans. Max abs diff vs full decode "
+          f"{np.abs(x_stream - np.clip(x_full, -1, 1)).max():.2e} (wav {np.abs(x_wav - x_stream[0, :, 0]).max():.2e} after 16 bit)")
+    print(f"Full decode after sampling: first audio after {len(ends) * window_time + full_time:.1f}s, {full_time:.2f}s decoding")
+    print(f"Streamed: first audio after {stream.first_audio_time:.1f}s, {stream.decode_time:.2f}s decoding "
+          f"({stream.decode_time / full_time:.2f}x the full decode)")
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_streaming_decode)